@@ -1,3 +1,3 @@
 
-from trr import TRR
+from trr import TRR, TRRWriter
 
@@ -10,9 +10,10 @@ class CoordSet(numpy.ndarray):
 
 class TRRFrame:
 
-    def __init__(self,trr,nr,offset,time,lmb,box,x,v,f):
+    def __init__(self,trr,nr,offset,time,lmb,box,x,v,f,step=0):
         self.nr     = 0
         self.offset = offset
+        self.step   = step
         self.time   = time
         self.lmb    = lmb
         self._idx   = (box,x,v,f)
@@ -29,7 +30,7 @@ class TRRFrame:
         if not self._idx[0][0]:
             return None
 
-        if self._box == None:
+        if self._box is None:
             if not self._trr.stream.tell() == self._idx[0][1]:
                 self._trr.stream.seek(self._idx[0][1])
             self._box = numpy.fromfile(self._trr.stream,dtype=self._trr.dtypeE,count=self._idx[0][0]).reshape((3,3))
@@ -43,7 +44,7 @@ class TRRFrame:
         if not self._idx[1][0]:
             return None
 
-        if self._x == None:
+        if self._x is None:
             if not self._trr.stream.tell() == self._idx[1][1]:
                 self._trr.stream.seek(self._idx[1][1])
             self._x = numpy.fromfile(self._trr.stream,dtype=self._trr.dtypeE,count=self._idx[1][0])
@@ -57,7 +58,7 @@ class TRRFrame:
         if not self._idx[2][0]:
             return None
 
-        if self._v == None:
+        if self._v is None:
             if not self._trr.stream.tell() == self._idx[2][1]:
                 self._trr.stream.seek(self._idx[2][1])
             self._v = numpy.fromfile(self._trr.stream,dtype=self._trr.dtypeE,count=self._idx[2][0])
@@ -71,7 +72,7 @@ class TRRFrame:
         if not self._idx[3][0]:
             return None
 
-        if self._f == None:
+        if self._f is None:
             if not self._trr.stream.tell() == self._idx[3][1]:
                 self._trr.stream.seek(self._idx[3][1])
             self._f = numpy.fromfile(self._trr.stream,dtype=self._trr.dtypeE,count=self._idx[3][0])
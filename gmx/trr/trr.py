@@ -120,7 +120,7 @@ class TRR:
         f          = (stuff[9]//self.float, self.pos+hsize+sum(stuff[:9]))
 
         self.pos += bytesize
-        self.index.append(TRRFrame(self,nr=len(self.index),offset=offset,time=time,lmb=lmb,box=box,x=x,v=v,f=f))
+        self.index.append(TRRFrame(self,nr=len(self.index),offset=offset,time=time,lmb=lmb,box=box,x=x,v=v,f=f,step=stuff[11]))
 
         # Go to next frame
         self.stream.seek(self.pos)
@@ -130,3 +130,54 @@ class TRR:
 
     def close(self):
         self.stream.close()
+
+
+class TRRWriter:
+    """Class for writing Gromacs' TRR trajectory files"""
+
+    _tag = b'\x00\x00\x07\xc9\x00\x00\x00\r\x00\x00\x00\x0cGMX_trn_file'
+
+    def __init__(self,stream,precision=4,dim=3):
+        if type(stream) == str:
+            self.stream = open(stream,'wb')
+        else:
+            self.stream = stream
+
+        self.float  = precision
+        self.dtype  = (self.float == 4 and "f") or (self.float == 8 and "d")
+        if not self.dtype:
+            raise IOError("Unable to write TRR file with float size {}".format(self.float))
+        self.dtypeE = '>' + self.dtype # With Endianness
+        self.dim    = dim
+
+
+    def __del__(self):
+        self.close()
+
+
+    def write(self,x=None,box=None,step=0,time=0,lmb=0,v=None,f=None):
+        """Write a frame. Arrays are written in the precision of the file."""
+
+        if box is None:
+            box = numpy.zeros((self.dim,self.dim))
+
+        # Convert to big-endian byte strings
+        data   = [ i is not None and numpy.asarray(i,dtype=self.dtypeE).tostring() or b''
+                   for i in (box,x,v,f) ]
+        natoms = [ len(i)//(self.dim*self.float) for i in data[1:] if i ] 
+        natoms = natoms and natoms[0] or 0
+
+        # Sizes of input record, energies, box, virial, pressure, topology,
+        # symbol table, x, v, f, followed by natoms, step, nre, time and lambda
+        sizes  = (0,0,len(data[0]),0,0,0,0,len(data[1]),len(data[2]),len(data[3]))
+        header = struct.pack(">"+13*"l"+2*self.dtype,*(sizes+(natoms,step,0,time,lmb)))
+
+        self.stream.write(self._tag)
+        self.stream.write(header)
+        for i in data:
+            self.stream.write(i)
+
+
+    def close(self):
+        if not self.stream.closed:
+            self.stream.close()
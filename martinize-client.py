@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+# Client for martinize running as a server (martinize.py --serve socket).
+# The job is sent with the current directory and the command line options,
+# and the output of martinize is written as if it was run directly.
+#
+#   martinize-client.py socket -f protein.pdb -o topol.top -x cg.pdb
+#
+# The program is kept small, as the point of the server is to avoid 
+# the time needed for loading martinize for every job.
+
+import json,os,socket,sys
+
+def main(args):
+    if len(args) < 1:
+        sys.stderr.write("Usage: %s socket [martinize options]\n"%os.path.basename(sys.argv[0]))
+        return 1
+    connection = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        connection.connect(args[0])
+    except socket.error, e:
+        sys.stderr.write("Can not connect to martinize server at %s: %s\n"%(args[0],e))
+        return 1
+    stream = connection.makefile("rw")
+    stream.write(json.dumps({"cwd": os.getcwd(), "args": args[1:]})+"\n")
+    stream.flush()
+    reply = stream.readline()
+    if not reply:
+        sys.stderr.write("No reply from martinize server.\n")
+        return 1
+    reply = json.loads(reply)
+    sys.stdout.write(reply["stdout"].encode("utf-8"))
+    sys.stderr.write(reply["stderr"].encode("utf-8"))
+    return reply["status"]
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
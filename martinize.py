@@ -96,6 +96,8 @@ lists = {
     'merges'  : [],
     'links'   : [],
     'multi'   : [],
+    'mutations': [],
+    'sscounts' : [],
     }
 
 # List of Help text and options. 
@@ -119,18 +121,30 @@ format. The format is inferred from the structure of the file. The
 input can also be provided through stdin, allowing piping of 
 structures. The input structure can have multiple frames/models. If an output
 structure file (-x) is given, each frame will be coarse grained,
-resulting in a multimodel output structure. Having multiple frames may
+resulting in a multimodel output structure. The format follows from
+the extension: PDB, GRO or TRR. Having multiple frames may
 also affect the topology. If secondary structure is determined
 internally, the structure will be averaged over the frames. Likewise,
 interatomic distances, as used for backbone bond lengths in Elnedyn
 and in elastic networks, are also averaged over the frames available.
 
+An atomistic trajectory in TRR format (-traj), with atoms matching the
+input structure, can be coarse grained to a TRR trajectory (-xo). The
+mapping is set up once from the input structure, after which the frames
+are read, mapped and written one at a time. The order of the beads
+matches that of the coarse grained structure (-x).
+
 If an output file (-o) is indicated for the topology, that file will
 be used for the master topology, using #include statements to link the
 moleculetype definitions, which are written to separate files. If no
 output filename is given, the topology and the moleculetype
 definitions are written to stdout.
 
+The chains are processed independently up to the point where they are
+combined in moleculetypes. With -j, the determination of the secondary
+structure, the coarse graining and the construction of the moleculetype
+topologies are distributed over the given number of processes.
+
 Secondary structure
 -------------------
 The secondary structure plays a central role in the assignment of atom
@@ -139,7 +153,9 @@ specification of the secondary structure as a string (-ss), or as a
 file containing a specification in GROMACS' ssdump format
 (-ss). Alternatively, DSSP can be used for an on-the-fly assignment of
 the secondary structure. For this, the option -dssp has to be used
-giving the location of the executable as the argument. 
+giving the location of the executable as the argument. Giving the 
+keyword 'builtin' as argument will use the internal implementation of
+DSSP instead, which does not require an external program.
 The option -collagen will set the whole structure to collagen. If this
 is not what you want (eg only part of the structure is collagen, you
 can give a secondary structure file/string (-ss) and specifiy collagen
@@ -148,7 +164,10 @@ J. Chem. Theory Comput., 2010, 6, 1210-1218.
 With multimodel input files, the secondary structure as determined with
 DSSP will be averaged over the frames. In this case, a cutoff
 can be specified (-ssc) indicating the fraction of frames to match a
-certain secondary structure type for designation.
+certain secondary structure type for designation. The counts of the
+secondary structure types per residue can be written to a file (-sso).
+Counts from other runs, e.g. over other parts of a trajectory, can be
+added (-ssi), to take the consensus over all frames.
 
 Topology
 --------
@@ -191,6 +210,13 @@ molecule, inferred from the sequence and the secondary structure
 definition. It is possible to force writing a moleculetype definition
 for every single molecule, using -sep.
 
+With -cache, the moleculetype definitions are stored in the directory
+given, and reused when the same moleculetype is encountered in a later 
+run. A topology is reused if the sequence, the secondary structure,
+the force field and the options affecting the topology match, and, if
+an elastic network is used, the coordinates. The size of the cache is
+limited with -cachesize, removing the least recently used topologies.
+
 The option -p can be used to write position restraints, using the 
 force constant specified with -pf, which is set to 1000 kJ/mol 
 by default.
@@ -213,6 +239,15 @@ network is specified (eg. Elnedyn) with -ff, -elastic in implied and
 the default values for the force constant and upper cutoff are used.
 However, these can be overwritten.
 
+For a structure file with several frames (e.g. NMR models), the elastic
+network is normally set up from the last frame. With -eavg, the mean
+distances over all frames are used instead. Bonds can then be removed
+if the standard deviation of the distance exceeds the value given with
+-esd (nm). With -et, the force constants are limited to kT over the
+variance of the distance, at the temperature given (K), as with an
+elastic network derived from the fluctuations (ED-ENM). With -eavg, the
+coarse grained coordinates of every frame are kept in memory.
+
 Multiscaling
 ------------
 Martinize can process a structure to yield a multiscale system,
@@ -224,18 +259,81 @@ be appended to the atomistic moleculetype definitions.
 The option -multi can be specified multiple times, and takes a chain
 identifier as argument. Alternatively, the keyword 'all' can be given
 as argument, causing all chains to be multiscaled.
+
+Mutations
+---------
+The topology for a mutant can be derived from the topology (.itp) of
+the wild type, written by martinize in an earlier run, without a
+structure. The topology is given with -reuse and each mutation with
+-mutate, listing the residue, its number in the moleculetype and the 
+new residue, e.g. -mutate A123W. The options affecting the topology,
+like the force field and the secondary structure, are those of the
+earlier run, and should be given again. Only the terms involving the
+mutated residue are set up again; the elastic network, cystine bridges
+and links are kept for beads that are also in the new residue.
+
+Profiling
+---------
+With -profile, the time spent in the stages of a run (reading, setting
+up chains, secondary structure, mapping, topology, elastic network,
+writing, ...) is written to the file given, as JSON. For each stage, the
+wall time, the CPU time, the increase of the peak memory use (kB) during
+the stage and counts of the items processed are listed, with the totals
+for the run and its peak memory use. The reading stage is entered once
+per frame, and once more to find the end of the file. When topologies are
+built in parallel (-j), the stages within building the topologies are
+counted for the topology stage. With -cprofile, the function calls are
+profiled as well, and the statistics are written per stage, to files
+named after the profile, e.g. prof.read.prof for prof.json. These can
+be inspected with the pstats module.
+
+Server
+------
+For processing many structures, martinize can be run as a server on a
+Unix domain socket, using 
+  martinize.py --serve socket [-j n]
+The server keeps the program and force fields loaded, and runs each job
+in a process forked from it, with at most n jobs at the same time 
+(default: 1). A job is a single line of JSON, with the working directory
+and the command line options, e.g.
+  {"cwd": "/data/run1", "args": ["-f", "1ubq.pdb", "-o", "topol.top"]}
+The reply is a line of JSON with the exit status and the output of the
+job ("status", "stdout" and "stderr"). The script martinize-client.py 
+sends a job from the command line, taking the socket and the options.
+
+Batch processing
+----------------
+A list of structures can be processed with 
+  martinize.py -batch manifest [-j n] [options]
+Each line of the manifest lists an input structure, an output prefix and,
+optionally, options for that structure, separated by tabs. Up to n jobs
+are run at the same time, each in a separate process, in the directory
+of the output prefix. The topology is written to prefix.top, and the
+name of the prefix is used as the moleculetype name (-name). Other
+options given on the command line apply to all jobs. Input files given
+with options are taken relative to the current directory. Other output
+files are named after the prefix, e.g. -x cg.pdb writes prefix.cg.pdb.
+The output of each job is written to prefix.log, and the status of each
+job is added to manifest.status, as a line of JSON. When the manifest is
+processed again, jobs that completed before, with all their output files
+present, are skipped.
 ========================================================================\n
 """,
     ("-f",        Option(str,                      1,     None, "Input file (PDB|GRO)")),
     ("-o",        Option(str,                      1,     None, "Output topology (TOP)")),
-    ("-x",        Option(str,                      1,     None, "Output coarse grained structure (PDB)")),
+    ("-x",        Option(str,                      1,     None, "Output coarse grained structure (PDB|GRO|TRR)")),
+    ("-traj",     Option(str,                      1,     None, "Input atomistic trajectory (TRR), matching the input structure")),
+    ("-xo",       Option(str,                      1,     None, "Output coarse grained trajectory (TRR), from -traj")),
     ("-n",        Option(str,                      1,     None, "Output index file with CG (and multiscale) beads.")),
     ("-nmap",     Option(str,                      1,     None, "Output index file containing per bead mapping.")),
+    ("-j",        Option(int,                      1,        1, "Number of processes for processing chains (default: 1)")),
     ("-v",        Option(bool,                     0,    False, "Verbose. Be load and noisy.")), 
     ("-h",        Option(bool,                     0,    False, "Display this help.")),
     ("-ss",       Option(str,                      1,     None, "Secondary structure (File or string)")),
     ("-ssc",      Option(float,                    1,      0.5, "Cutoff fraction for ss in case of ambiguity (default: 0.5).")),
-    ("-dssp",     Option(str,                      1,     None, "DSSP executable for determining structure")),
+    ("-sso",      Option(str,                      1,     None, "Output secondary structure counts over the frames (JSON)")),
+    ("-ssi",      Option(lists['sscounts'].append, 1,     None, "Secondary structure counts to add, from -sso (+)")),
+    ("-dssp",     Option(str,                      1,     None, "DSSP executable for determining structure, or 'builtin'")),
 #    ("-pymol",    Option(str,                      1,     None, "PyMOL executable for determining structure")),
     ("-collagen", Option(bool,                     0,    False, "Use collagen parameters")),
     ("-his",      Option(bool,                     0,    False, "Interactively set the charge of each His-residue.")),
@@ -250,6 +348,12 @@ as argument, causing all chains to be multiscaled.
     ("-pf",       Option(float,                    1,     1000, "Position restraints force constant (default: 1000 kJ/mol/nm^2)")),
     ("-ed",       Option(bool,                     0,    False, "Use dihedrals for extended regions rather than elastic bonds)")),
     ("-sep",      Option(bool,                     0,    False, "Write separate topologies for identical chains.")),
+    ("-cache",    Option(str,                      1,     None, "Directory for caching moleculetype topologies")),
+    ("-cachesize",Option(float,                    1,      100, "Maximum size of the topology cache (default: 100 MB)")),
+    ("-profile",  Option(str,                      1,     None, "Output timing of the stages of the run (JSON)")),
+    ("-cprofile", Option(bool,                     0,    False, "With -profile, also write cProfile statistics per stage")),
+    ("-reuse",    Option(str,                      1,     None, "Topology (ITP) from an earlier run, to apply mutations to")),
+    ("-mutate",   Option(lists['mutations'].append,1,     None, "Mutation for -reuse, e.g. A123W (+)")),
     ("-ff",       Option(str,                      1,'martini21', "Which forcefield to use: "+' ,'.join(n for n in forcefields[:-1]))),
 # Fij = Fc exp( -a (rij - lo)**p )
     ("-elastic",  Option(bool,                     0,    False, "Write elastic bonds")),
@@ -260,6 +364,9 @@ as argument, causing all chains to be multiscaled.
     ("-ep",       Option(float,                    1,        1, "Elastic bond decay power p")),
     ("-em",       Option(float,                    1,        0, "Remove elastic bonds with force constant lower than this")),
     ("-eb",       Option(str,                      1,     'BB', "Comma separated list of bead names for elastic bonds")),
+    ("-eavg",     Option(bool,                     0,    False, "Elastic bonds from the mean distances over the frames")),
+    ("-esd",      Option(float,                    1,     None, "With -eavg, remove elastic bonds with a larger standard deviation (nm)")),
+    ("-et",       Option(float,                    1,     None, "With -eavg, limit the force constants to kT/variance at this temperature (K)")),
 #    ("-hetatm",   Option(bool,                     0,    False, "Include HETATM records from PDB file (Use with care!)")),
     ("-multi",    Option(lists['multi'].append,    1,     None, "Chain to be set up for multiscaling (+)")),
     ]
@@ -321,6 +428,27 @@ def str2atom(a):
             return (a[2],a[0],int(a[1]),None)
     return (a[3],a[1],int(a[2]),a[0])
 
+# Force field instances, by name. A force field is set up the first time it 
+# is asked for and shared after that. When running jobs in forked processes
+# (server, batch), the force fields are set up before forking.
+forceFields = {}
+
+# Get the force field with the name given, or None if it does not exist. 
+# The force field class is taken from a file with the same name, if that
+# defines it, and otherwise from the classes defined here.
+def forceField(name):
+    if not name in forceFields:
+        try:
+            try:
+                # Try to load the forcefield class from a different file
+                forceFields[name] = getattr(__import__(name),name)()
+            except:
+                # Try to load the forcefield class from the current file
+                forceFields[name] = globals()[name]()
+        except:
+            return None
+    return forceFields[name]
+
 def option_parser(args,options,lists,version=0):
 
     # Check whether there is a request for help
@@ -333,7 +461,12 @@ def option_parser(args,options,lists,version=0):
     # This information we would like to print to some files, so let's put it in our information class
     options['Version']             = version
     options['Arguments']           = args[:]
-   
+    # The number of processes does not change the output, and is left out,
+    # so that the files written are the same for any number of processes.
+    if '-j' in args:
+        i = options['Arguments'].index('-j')
+        del options['Arguments'][i:i+2]
+
     while args:
         ar = args.pop(0)
         options[ar].setvalue([args.pop(0) for i in range(options[ar].num)])
@@ -350,17 +483,8 @@ def option_parser(args,options,lists,version=0):
      
     # The make the program flexible, the forcefield parameters are defined
     # for multiple forcefield. Check if a existing one is defined:
-    ###_tmp  = __import__(options['-ff'].value.lower())
-    ###options['ForceField']  = getattr(_tmp,options['-ff'].value.lower())()
-    try:
-        try:
-            # Try to load the forcefield class from a different file
-            _tmp  = __import__(options['-ff'].value.lower())
-            options['ForceField']  = getattr(_tmp,options['-ff'].value.lower())()
-        except:
-            # Try to load the forcefield class from the current file
-            options['ForceField']  = globals()[options['-ff'].value.lower()]()
-    except:
+    options['ForceField'] = forceField(options['-ff'].value.lower())
+    if not options['ForceField']:
         logging.error("Forcefield '%s' can not be found."%(options['-ff']))
         sys.exit()
    
@@ -384,6 +508,9 @@ def option_parser(args,options,lists,version=0):
     options['ElasticDecayFactor']  = options['-ea'].value
     options['ElasticDecayPower']   = options['-ep'].value
     options['ElasticBeads']        = options['-eb'].value.split(',')
+    options['ElasticAverage']      = options['-eavg']
+    options['ElasticDeviation']    = options['-esd'].value
+    options['ElasticTemperature']  = options['-et'].value
     options['PosResForce']         = options['-pf'].value
 
     options['PosRes']              = [i.lower() for i in options['-p'].value.split(",")]
@@ -444,6 +571,8 @@ def option_parser(args,options,lists,version=0):
     options['CystineCheckBonds'] = CystineCheckBonds
     options['CystineMaxDist2']   = CystineMaxDist2
     options['multi']             = lists['multi']
+    options['mutations']         = lists['mutations']
+    options['SSCounts']          = lists['sscounts']
 
     logging.info("Chain termini will%s be charged"%(options['NeutralTermini'] and " not" or ""))
     
@@ -478,7 +607,7 @@ def option_parser(args,options,lists,version=0):
 ## 3 # HELPER FUNCTIONS, CLASSES AND SHORTCUTS ##  -> @FUNC <-
 #################################################
 
-import math
+import math,multiprocessing,numpy,sys
 
 #----+------------------+
 ## A | STRING FUNCTIONS |
@@ -516,6 +645,13 @@ def formatString(i):
         return str(i)                                                         
 
 
+# A float written with six decimals, as the force constants of rubber
+# bands. These are kept as numbers and only formatted when written.
+class Fixed(float):
+    def __str__(self):
+        return "%f"%self
+
+
 #----+----------------+
 ## B | MATH FUNCTIONS |
 #----+----------------+
@@ -539,10 +675,156 @@ def distance2(a,b):
     return (a[0]-b[0])**2+(a[1]-b[1])**2+(a[2]-b[2])**2
 
 
+#----+------------------+
+## C | NEIGHBOUR SEARCH |
+#----+------------------+
+
+
+# Cell list search for pairs of points within a cutoff distance.
+# The points are sorted over cubic cells with an edge equal to the cutoff,
+# after which only points in the same or neighbouring cells are tested.
+# The cells are padded on either side, so that the cell index of a neighbour 
+# can be obtained by simply adding an offset. 
+# Returns arrays i, j and d2, with i < j and d2 the squared distance, 
+# calculated as in distance2, sorted on i and then j. Pairs with j-i <= skip
+# are not listed. Pairs closer than the cutoff are all listed, but pairs 
+# at the cutoff may be included too, because of rounding. The caller 
+# should apply the exact criterion, using d2. The search is done in
+# chunks of points, to keep the memory usage limited. 
+# If a second set of points is given (other), the pairs between the two 
+# sets are listed instead, with i indexing coordinates and j indexing other,
+# without the restrictions i < j and j-i > skip.
+def cellPairs(coordinates,cutoff,skip=0,chunk=10000,other=None):
+    x   = numpy.asarray(coordinates,dtype=float).reshape((-1,3))
+    y   = x
+    if other is not None:
+        y = numpy.asarray(other,dtype=float).reshape((-1,3))
+    n   = len(x)
+    out = ([],[],[])
+    if n < 2 and other is None or not n or not len(y) or cutoff <= 0:
+        return [numpy.array(i,dtype=t) for i,t in zip(out,(int,int,float))]
+    # Cell indices, padded
+    size  = cutoff*1.0001
+    low   = numpy.minimum(x.min(axis=0),y.min(axis=0))
+    cell  = numpy.floor((x-low)/size).astype(int)+1
+    ycell = numpy.floor((y-low)/size).astype(int)+1
+    dim   = numpy.maximum(cell.max(axis=0),ycell.max(axis=0))+2
+    key   = (cell[:,0]*dim[1]+cell[:,1])*dim[2]+cell[:,2]
+    ykey  = (ycell[:,0]*dim[1]+ycell[:,1])*dim[2]+ycell[:,2]
+    order = numpy.argsort(ykey,kind="mergesort")
+    skey  = ykey[order]
+    # Offsets of the neighbouring cells (including the cell itself)
+    shift = [(a*dim[1]+b)*dim[2]+c for a in (-1,0,1) for b in (-1,0,1) for c in (-1,0,1)]
+    c2    = size*size
+    for start in range(0,n,chunk):
+        i0 = numpy.arange(start,min(start+chunk,n))
+        ii, jj = [], []
+        for s in shift:
+            lo    = numpy.searchsorted(skey,key[i0]+s,side="left")
+            hi    = numpy.searchsorted(skey,key[i0]+s,side="right")
+            count = hi-lo
+            total = count.sum()
+            if not total:
+                continue
+            # Expand the ranges lo:hi to a flat array of positions in the sorted list
+            first = numpy.cumsum(count)-count
+            pos   = numpy.repeat(lo-first,count)+numpy.arange(total)
+            i     = numpy.repeat(i0,count)
+            j     = order[pos]
+            if other is None:
+                keep  = j-i > skip
+                i, j  = i[keep], j[keep]
+            ii.append(i)
+            jj.append(j)
+        if not ii:
+            continue
+        i, j = numpy.concatenate(ii), numpy.concatenate(jj)
+        # The squares are taken with pow, like in distance2, to get identical results
+        d    = x[i]-y[j]
+        two  = numpy.full(len(d),2.0)
+        d2   = numpy.power(d[:,0],two)+numpy.power(d[:,1],two)+numpy.power(d[:,2],two)
+        keep = d2 < c2
+        i, j, d2 = i[keep], j[keep], d2[keep]
+        srt  = numpy.lexsort((j,i))
+        out[0].append(i[srt])
+        out[1].append(j[srt])
+        out[2].append(d2[srt])
+    if not out[0]:
+        return [numpy.array(i,dtype=t) for i,t in zip(out,(int,int,float))]
+    return [numpy.concatenate(i) for i in out]
+
+
+# Pairs of points coming within a cutoff distance in any of a number of
+# frames. The coordinates are given as an array of shape (frames,points,3).
+# Candidate pairs are found with the cell list search for each frame, 
+# after which the minimal squared distance over all frames is calculated
+# for these pairs only. Returns arrays i, j and d2, with i < j and d2 the 
+# minimal squared distance (as in distance2), for pairs with d2 <= cutoff2, 
+# sorted on i and then j.
+def contactPairs(coordinates,cutoff2):
+    x = numpy.asarray(coordinates,dtype=float)
+    n = x.shape[1]
+    keys = [i*n+j for i,j,d2 in [cellPairs(frame,math.sqrt(cutoff2)) for frame in x]]
+    keys = numpy.unique(numpy.concatenate(keys+[numpy.array([],dtype=int)]))
+    i, j = keys//n, keys%n
+    d    = x[:,i]-x[:,j]
+    two  = numpy.full(d.shape[:2],2.0)
+    d2   = (numpy.power(d[:,:,0],two)+numpy.power(d[:,:,1],two)+numpy.power(d[:,:,2],two)).min(axis=0)
+    keep = d2 <= cutoff2
+    return i[keep], j[keep], d2[keep]
+
+
+
+#----+---------------------+
+## D | PARALLEL PROCESSING |
+#----+---------------------+
+
+
+# Jobs for the worker processes. The jobs are set before the pool is
+# started, so that the workers inherit them when forked. This way, only
+# the job indices and the results are passed between processes, and jobs
+# can be bound methods, which cannot be pickled.
+poolJobs = []
+
+
+def poolWorker(i):
+    func, args = poolJobs[i]
+    # Errors are logged and followed by sys.exit, which would take down 
+    # the worker without a result, leaving the pool waiting forever.
+    try:
+        return True, func(*args)
+    except SystemExit:
+        return False, None
+
+
+# Run func(*args) for all (func,args) in jobs, using a pool of nproc 
+# processes, and return the results in the order of the jobs. With one 
+# process or one job, the jobs are run in this process. Side effects of 
+# the jobs are lost when run in a pool; what is needed should be returned. 
+def poolMap(jobs,nproc=1):
+    global poolJobs
+    jobs = list(jobs)
+    if nproc < 2 or len(jobs) < 2:
+        return [func(*args) for func,args in jobs]
+    poolJobs = jobs
+    pool     = multiprocessing.Pool(min(nproc,len(jobs)))
+    try:
+        results = pool.map(poolWorker,range(len(jobs)),chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        poolJobs = []
+    if not all([ok for ok,result in results]):
+        sys.exit(1)
+    return [result for ok,result in results]
+
+
+
 
 ##########################
 ## 4 # FG -> CG MAPPING ##  -> @MAP <-
 ##########################
+import numpy
 
 
 dnares3 = " DA DC DG DT" 
@@ -681,41 +963,163 @@ class CoarseGrained:
     # This will probably give only minor deviations, while also giving less headache
     mass = {'H': 1,'C': 12,'N': 14,'O': 16,'S': 32,'P': 31,'M': 0}
 
-# Determine average position for a set of weights and coordinates
-# This is a rather specific function that requires a list of items
-# [(m,(x,y,z),id),..] and returns the weighted average of the 
-# coordinates and the list of ids mapped to this bead
-def aver(b):
-    mwx,ids = zip(*[((m*x,m*y,m*z),i) for m,(x,y,z),i in b])              # Weighted coordinates     
-    tm  = sum(zip(*b)[0])                                                 # Sum of weights           
-    return [sum(i)/tm for i in zip(*mwx)],ids                             # Centre of mass           
+# Table of bead indices for each atom name in a residue, derived from the
+# mapping above. An atom name can be listed for more than one bead. 
+# Elnedyn maps BB to CA, which gives a different table. The tables are 
+# cached, keyed by residue name and ca2bb flag, so that the shared mapping
+# dictionary is never modified.
+_mappingTables = {}
+def mappingTable(resname,ca2bb=False):
+    key = (resname,ca2bb)
+    if not key in _mappingTables:
+        p = list(CoarseGrained.mapping[resname])                                   # Mapping for this residue 
+        if ca2bb: p[0] = ["CA"]                                                    # Elnedyn maps BB to CA, ca2bb is False or True
+        table = {}
+        for bead,names in enumerate(p):
+            for name in names:
+                table.setdefault(name,[]).append(bead)
+        _mappingTables[key] = (len(p),table)
+    return _mappingTables[key]
+
+
+# The mapping of a list of residues, compiled into a sparse weight matrix 
+# (beads x atoms), stored as three matched arrays (bead index, atom index
+# and weight). The positions of all beads are then obtained with a single
+# weighted sum over the atoms, for which numpy.bincount is used. Within a bead 
+# the atoms are summed in the order of the residue, which gives the same 
+# result as a straightforward centre of mass calculation.
+# The residues are lists of atoms [ name, resname, resid, chain, x, y, z ].
+# The residue name is taken from the first atom of each residue.
+class MappingMatrix:
+    def __init__(self,residuelist,ca2bb=False):
+        beads, atoms, weights = [], [], []
+        # Number of beads per residue
+        self.nbeads   = []
+        # For each bead, the list of atom indices (within the residue) mapped to it
+        self.ids      = []
+        self.natoms   = 0
+        for r in residuelist:
+            nb, table = mappingTable(r[0][1],ca2bb)
+            first     = len(self.ids)
+            ids       = [[] for i in range(nb)]
+            for i,atom in enumerate(r):
+                for b in table.get(atom[0],()):
+                    ids[b].append(i)
+                    beads.append(first+b)
+                    atoms.append(self.natoms+i)
+                    weights.append(CoarseGrained.mass.get(atom[0][0],0))
+            self.nbeads.append(nb)
+            self.ids.extend(ids)
+            self.natoms  += len(r)
+        self.beads   = numpy.array(beads,dtype=int)
+        self.atoms   = numpy.array(atoms,dtype=int)
+        self.weights = numpy.array(weights,dtype=float)
+        # Total mass per bead
+        self.mass    = numpy.bincount(self.beads,weights=self.weights,minlength=len(self.ids))
+        # Residues with beads without atoms (or without mass) cannot be mapped
+        residue      = numpy.repeat(numpy.arange(len(self.nbeads)),self.nbeads)
+        self.missing = [residuelist[k] for k in sorted(set(residue[self.mass == 0]))]
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Bead positions for an array of atom coordinates (natoms x 3)
+    def __call__(self,coordinates):
+        x   = numpy.asarray(coordinates,dtype=float)[self.atoms]*self.weights[:,None]
+        out = numpy.empty((len(self.ids),3))
+        for k in range(3):
+            out[:,k] = numpy.bincount(self.beads,weights=x[:,k],minlength=len(self.ids))
+        return out/self.mass[:,None]
+
+    # Iterate over residues, returning the bead positions and atom ids
+    def residues(self,positions):
+        start = 0
+        for nb in self.nbeads:
+            yield positions[start:start+nb], self.ids[start:start+nb]
+            start += nb
+
 
 # Return the CG beads for an atomistic residue, using the mapping specified above
 # The residue 'r' is simply a list of atoms, and each atom is a list:
 # [ name, resname, resid, chain, x, y, z ]
 def map(r,ca2bb = False):
-    p = CoarseGrained.mapping[r[0][1]]                                             # Mapping for this residue 
-    if ca2bb: p[0] = ["CA"]                                                        # Elnedyn maps BB to CA, ca2bb is False or True
-    # Get the name, mass and coordinates for all atoms in the residue
-    a = [(i[0],CoarseGrained.mass.get(i[0][0],0),i[4:]) for i in r]                    
-    # Store weight, coordinate and index for atoms that match a bead
-    q = [[(m,coord,a.index((atom,m,coord))) for atom,m,coord in a if atom in i] for i in p]
-
+    m = MappingMatrix([r],ca2bb)
+    if m.missing:
+        raise ValueError("Too many atoms missing from residue")
     # Bead positions      
-    return zip(*[aver(i) for i in q])
+    return [tuple(i) for i in m([i[4:7] for i in r]).tolist()], [tuple(i) for i in m.ids]
 
 # Mapping for index file
 def mapIndex(r,ca2bb = False):
-    p = CoarseGrained.mapping[r[0][1]]                                             # Mapping for this residue 
-    if ca2bb: p[0] = ["CA"]                                                        # Elnedyn maps BB to CA, ca2bb is False or True
-    # Get the name, mass and coordinates for all atoms in the residue
-    a = [(i[0],CoarseGrained.mass.get(i[0][0],0),i[4:]) for i in r]                    
+    m = MappingMatrix([r],ca2bb)
     # Store weight, coordinate and index for atoms that match a bead
-    return [[(m,coord,a.index((atom,m,coord))) for atom,m,coord in a if atom in i] for i in p]
+    return [[(CoarseGrained.mass.get(r[i][0][0],0),r[i][4:],i) for i in j] for j in m.ids]
+# Mapping of complete frames, for coarse graining trajectories. 
+# The mapping is compiled once from a reference structure, given as the 
+# list of atoms and the list of chains (in output order). Calling the 
+# instance with the coordinates of all atoms of a frame gives the 
+# coordinates of the output (multiscaled atoms and beads), in the order 
+# of the coarse grained structure as written with -x. 
+# Dummy beads, as used in polarizable force fields, are placed at the 
+# same offset from the preceding bead as in the reference.
+class TrajectoryMapping:
+    def __init__(self,chains,atoms,forcefield):
+        index    = dict([(id(a),k) for k,a in enumerate(atoms)])
+        residues = []
+        columns  = []
+        rows     = []  # (0, i) for multiscaled atoms, (1, i) for beads, (2, i) for dummies
+        msatoms  = []  # Multiscaled atoms
+        dummies  = []  # (bead, offset)
+        nbeads   = 0
+        self.natoms = len(atoms)
+        for chain in chains:
+            if chain.multiscale:
+                for residue in chain.residues:
+                    for a in residue:
+                        rows.append((0,len(msatoms)))
+                        msatoms.append(index[id(a)])
+            # The coarse grained structure is generated first, as that may 
+            # update the atoms of the residues (DNA O3')
+            cg = chain.cg(com=True)
+            k  = 0
+            for residue,resname in zip(chain.residues,chain.sequence):
+                if resname in ("SOL","HOH","TIP") or not resname in CoarseGrained.mapping:
+                    continue
+                residues.append([(atom[0],resname)+atom[2:] for atom in residue])
+                columns.extend([index[id(atom)] for atom in residue])
+                nb = min(mappingTable(resname,forcefield.ca2bb)[0],len(CoarseGrained.names[resname]))
+                rows.extend([(1,nbeads+i) for i in range(nb)])
+                nd = (resname in forcefield.polar and 2) or (resname in forcefield.charged and 1) or 0
+                for i in range(nd):
+                    # Offset relative to the last real bead, in nm
+                    offset = [(a-b)/10. for a,b in zip(cg[k+nb+i][4:7],cg[k+nb-1][4:7])]
+                    rows.append((2,len(dummies)))
+                    dummies.append((nbeads+nb-1,offset))
+                nbeads += mappingTable(resname,forcefield.ca2bb)[0]
+                k      += nb+nd
+        self.matrix  = MappingMatrix(residues,forcefield.ca2bb)
+        self.columns = numpy.array(columns,dtype=int)
+        self.atoms   = numpy.array(msatoms,dtype=int)
+        self.dummies = numpy.array([i for i,j in dummies],dtype=int)
+        self.offsets = numpy.array([j for i,j in dummies],dtype=float).reshape((-1,3))
+        # Indices into the stacked array of atoms, beads and dummies
+        start        = (0,len(msatoms),len(msatoms)+nbeads)
+        self.rows    = numpy.array([start[i]+j for i,j in rows],dtype=int)
+
+    def __len__(self):
+        return len(self.rows)
+
+    # Output coordinates for a frame with coordinates of all atoms (natoms x 3) 
+    def __call__(self,coordinates):
+        x     = numpy.asarray(coordinates,dtype=float)
+        beads = self.matrix(x[self.columns])
+        return numpy.concatenate((x[self.atoms],beads,beads[self.dummies]+self.offsets))[self.rows]
+
+
 #############################
 ## 5 # SECONDARY STRUCTURE ##  -> @SS <-
 #############################
-import logging,os,sys
+import json,logging,os,sys,numpy
 import subprocess as subp
 
 #----+--------------------------------------+
@@ -754,6 +1158,7 @@ bbss     =    spl("  F     E     H     1     2     3     T     S     C")  # SS o
 #                                                                                           
 ssdefs = {
     "dssp":  list(".HGIBETSC~"),             # DSSP one letter secondary structure code     #@#
+    "builtin": list(".HGIBETSC~"),           # Built-in DSSP, using the same codes as DSSP  #@#
     "pymol": list(".H...S...L"),             # Pymol one letter secondary structure code    #@# 
     "gmx":   list(".H...ETS.C"),             # Gromacs secondary structure dump code        #@#    
     "self":  list("FHHHEETSCC")              # Internal CG secondary structure codes        #@#
@@ -888,10 +1293,272 @@ def call_dssp(chain,atomlist,executable='dsspcmbi'):
       if main and not line[13] == "!": ss+=line[16]
       if line[:15] == '  #  RESIDUE AA': main=1
     return ss
-     
+
+
+# The following is a built-in implementation of DSSP (Kabsch and Sander,
+# Biopolymers, 1983, 22, 2577-2637), following the rules as implemented 
+# in mkdssp. It works on arrays of backbone coordinates, so no external
+# program needs to be called. One letter is returned for each residue. 
+# Residues lacking backbone atoms are set to coil and are treated as 
+# chain breaks. The priority of the assignments is H > B > E > G > I > T > S.
+
+# Extract the N, CA, C and O positions of the residues as an (n,4,3) array,
+# together with masks for residues with a complete backbone and for prolines.
+def dsspBackbone(residues):
+    n   = len(residues)
+    bb  = numpy.zeros((n,4,3))
+    ok  = numpy.ones(n,dtype=bool)
+    pro = numpy.zeros(n,dtype=bool)
+    for r,residue in enumerate(residues):
+        for a,name in enumerate(("N","CA","C","O")):
+            atom = residue[name] or (name == "O" and residue["O1"])
+            if atom:
+                bb[r,a] = atom[4:7]
+            else:
+                ok[r] = False
+        pro[r] = residue[0][1] == "PRO"
+    return bb, ok, pro
+
+
+# Electrostatic hydrogen bond energy (kcal/mol) between N-H groups
+# and C=O groups, given as arrays of positions.
+def dsspEnergy(n,h,c,o):
+    d  = [numpy.sqrt(((a-b)**2).sum(axis=1)) for a,b in ((h,o),(h,c),(n,c),(n,o))]
+    with numpy.errstate(divide="ignore"):
+        e = -27.888*(1/d[0]-1/d[1]+1/d[2]-1/d[3])
+    e = numpy.round(e*1000)/1000
+    e[(d[0]<0.5)|(d[1]<0.5)|(d[2]<0.5)|(d[3]<0.5)] = -9.9
+    return numpy.maximum(e,-9.9)
+
+
+def call_builtin(chain,atomlist=None,executable=None):
+    '''Get the secondary structure, using the built-in DSSP implementation'''
+    bb, ok, pro = dsspBackbone(chain.residues)
+    n  = len(bb)
+    ss = numpy.array(n*[" "])
+    if ok.sum() < 2:
+        return "".join(ss)
+
+    # Chain breaks: brk[k] is set if residues k and k+1 are not connected.
+    # Residues with missing backbone atoms break the chain on both sides.
+    cn  = numpy.sqrt(((bb[1:,0]-bb[:-1,2])**2).sum(axis=1))
+    brk = (cn > 2.5) | ~ok[1:] | ~ok[:-1]
+    cb  = numpy.concatenate(([0],numpy.cumsum(brk)))
+    def nobreak(i,j):
+        return cb[i] == cb[j]
+
+    # Amide hydrogens, placed along the C=O vector of the preceding residue
+    co       = bb[:-1,2]-bb[:-1,3]
+    hpos     = bb[:,0].copy()
+    hpos[1:] = hpos[1:] + co/numpy.sqrt((co**2).sum(axis=1))[:,None]
+    donor    = ok & ~pro & numpy.concatenate(([False],~brk))
+
+    # Hydrogen bonds between residues with CA atoms within 9 A.
+    # Bonds are stored as donor*n+acceptor, keeping for each 
+    # donor only the two best acceptors, as in mkdssp.
+    idx    = numpy.nonzero(ok)[0]
+    i, j, d2 = cellPairs(bb[idx,1],9.0)
+    keep   = d2 < 81
+    i, j   = idx[i[keep]], idx[j[keep]]
+    don    = numpy.concatenate((i,j[j-i>1]))
+    acc    = numpy.concatenate((j,i[j-i>1]))
+    sel    = donor[don]
+    don, acc = don[sel], acc[sel]
+    energy = dsspEnergy(bb[don,0],hpos[don],bb[acc,2],bb[acc,3])
+    sel    = energy < -0.5
+    don, acc, energy = don[sel], acc[sel], energy[sel]
+    srt    = numpy.lexsort((energy,don))
+    don, acc = don[srt], acc[srt]
+    first  = numpy.concatenate(([True],don[1:] != don[:-1]))
+    start  = numpy.maximum.accumulate(numpy.where(first,numpy.arange(len(don)),0))
+    best   = numpy.arange(len(don))-start < 2
+    bonds  = numpy.unique(don[best]*n+acc[best])
+    def hbond(d,a):
+        d, a = numpy.asarray(d), numpy.asarray(a)
+        valid = (d >= 0) & (d < n) & (a >= 0) & (a < n)
+        return valid & numpy.in1d(d*n+a,bonds)
+
+    # n-turns: turn[s][i] is set if the C=O of residue i is 
+    # hydrogen bonded to the N-H of residue i+s
+    res  = numpy.arange(n)
+    turn = {}
+    for s in (3,4,5):
+        t = numpy.zeros(n,dtype=bool)
+        t[:n-s] = hbond(res[:n-s]+s,res[:n-s]) & nobreak(res[:n-s],res[:n-s]+s)
+        turn[s] = t
+
+    # Bridges. Candidate pairs are derived from the hydrogen bonds 
+    # and are tested for the parallel and antiparallel patterns.
+    d, a = bonds//n, bonds%n
+    pi   = numpy.concatenate((d-1,a,d-1,a))
+    pj   = numpy.concatenate((a,d-1,a+1,d))
+    pi, pj = numpy.minimum(pi,pj), numpy.maximum(pi,pj)
+    sel  = (pj-pi >= 3) & (pi >= 1) & (pj <= n-2)
+    pair = numpy.unique(pi[sel]*n+pj[sel])
+    pi, pj = pair//n, pair%n
+    sel  = nobreak(pi-1,pi+1) & nobreak(pj-1,pj+1)
+    pi, pj = pi[sel], pj[sel]
+    para = ((hbond(pi+1,pj) & hbond(pj,pi-1)) | 
+            (hbond(pj+1,pi) & hbond(pi,pj-1)))
+    anti = ((hbond(pi+1,pj-1) & hbond(pj+1,pi-1)) | 
+            (hbond(pj,pi) & hbond(pi,pj))) & ~para
+
+    # Ladders: consecutive bridges of the same type
+    ladders = []
+    for bi,bj,bp,ba in zip(pi.tolist(),pj.tolist(),para.tolist(),anti.tolist()):
+        if not (bp or ba):
+            continue
+        for ladder in ladders:
+            if ladder[0] != bp or bi != ladder[1][-1]+1:
+                continue
+            if bp and ladder[2][-1]+1 == bj:
+                ladder[1].append(bi)
+                ladder[2].append(bj)
+                break
+            if ba and ladder[2][0]-1 == bj:
+                ladder[1].append(bi)
+                ladder[2].insert(0,bj)
+                break
+        else:
+            ladders.append([bp,[bi],[bj]])
+
+    # Ladders joined by beta bulges. The differences between residue 
+    # numbers are unsigned in mkdssp, so negative gaps never match.
+    ladders.sort(key=lambda x: x[1][0])
+    u = 0
+    while u < len(ladders):
+        v = u+1
+        while v < len(ladders):
+            lu, lv = ladders[u], ladders[v]
+            ibi, iei, jbi, jei = lu[1][0], lu[1][-1], lu[2][0], lu[2][-1]
+            ibj, iej, jbj, jej = lv[1][0], lv[1][-1], lv[2][0], lv[2][-1]
+            if (lu[0] != lv[0] or 
+                not nobreak(min(ibi,ibj),max(iei,iej)) or
+                not nobreak(min(jbi,jbj),max(jei,jej)) or
+                not 0 <= ibj-iei < 6 or (iei >= ibj and ibi <= iej)):
+                v += 1
+                continue
+            gap = lu[0] and jbj-jei or jbi-jej
+            bulge = (0 <= gap < 6 and ibj-iei < 3) or 0 <= gap < 3
+            if bulge:
+                lu[1].extend(lv[1])
+                lu[2] = lu[0] and lu[2]+lv[2] or lv[2]+lu[2]
+                del ladders[v]
+            else:
+                v += 1
+        u += 1
+
+    for ladder in ladders:
+        code = len(ladder[1]) > 1 and "E" or "B"
+        for strand in ladder[1:]:
+            stretch = ss[min(strand):max(strand)+1]
+            stretch[stretch != "E"] = code
+
+    # Helices: two consecutive n-turns. Alpha helices take precedence
+    # over other structure, 3-10 and pi helices only fill unassigned stretches.
+    for s,code in ((4,"H"),(3,"G"),(5,"I")):
+        for i in numpy.nonzero(turn[s][1:] & turn[s][:-1])[0]+1:
+            if code == "H" or (numpy.in1d(ss[i:i+s],[" ",code])).all():
+                ss[i:i+s] = code
+
+    # Turns and bends on the remaining residues
+    isturn = numpy.zeros(n,dtype=bool)
+    for s in (3,4,5):
+        for l in range(1,s):
+            isturn[l:] |= turn[s][:-l]
+    ca    = bb[:,1]
+    v1    = ca[2:-2]-ca[:-4]
+    v2    = ca[4:]-ca[2:-2]
+    cos   = (v1*v2).sum(axis=1)/numpy.sqrt((v1**2).sum(axis=1)*(v2**2).sum(axis=1))
+    bend  = numpy.zeros(n,dtype=bool)
+    bend[2:-2] = (cos < numpy.cos(numpy.radians(70))) & nobreak(res[:-4],res[4:])
+    ss[(ss == " ") & bend & ~isturn] = "S"
+    ss[(ss == " ") & isturn] = "T"
+    ss[~ok] = " "
+    return "".join(ss)
+
+
 ssDetermination = {
-    "dssp": call_dssp
+    "dssp":    call_dssp,
+    "builtin": call_builtin
     }
+
+
+#----+-----------+
+## D | CONSENSUS |
+#----+-----------+
+
+# Counts of the secondary structure types per residue over the frames, for
+# taking the consensus. The counts are kept in an array with a row for each
+# residue and a column for each type, in the order the types were found. 
+# Residues beyond the shortest secondary structure added are dropped. 
+# The counts can be written to and read from a file (JSON), to combine the
+# counts from runs over different parts of a trajectory.
+class SSCounts:
+    def __init__(self):
+        self.types  = ""
+        self.counts = numpy.zeros((0,0),dtype=numpy.int32)
+        self.frames = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    # Add columns for types not seen before
+    def _addTypes(self,types):
+        new = "".join(sorted(set(types)-set(self.types)))
+        if new:
+            self.types  += new
+            self.counts  = numpy.hstack((self.counts,numpy.zeros((len(self.counts),len(new)),dtype=numpy.int32)))
+
+    # Count the secondary structure of a frame, given as a string
+    def add(self,ss):
+        self._addTypes(ss)
+        if not self.frames:
+            self.counts = numpy.zeros((len(ss),len(self.types)),dtype=numpy.int32)
+        n = min(len(ss),len(self.counts))
+        self.counts = self.counts[:n]
+        column = numpy.zeros(256,dtype=int)
+        column[numpy.frombuffer(self.types,dtype=numpy.uint8)] = numpy.arange(len(self.types))
+        self.counts[numpy.arange(n),column[numpy.frombuffer(ss[:n],dtype=numpy.uint8)]] += 1
+        self.frames += 1
+
+    # Add the counts of another instance
+    def __iadd__(self,other):
+        if not other.frames:
+            return self
+        if not self.frames:
+            self.counts = numpy.zeros((len(other),len(self.types)),dtype=numpy.int32)
+        self._addTypes(other.types)
+        n = min(len(self),len(other))
+        self.counts = self.counts[:n]
+        self.counts[:,[self.types.index(i) for i in other.types]] += other.counts[:n]
+        self.frames += other.frames
+        return self
+
+    # The consensus secondary structure. A residue gets the type found most 
+    # often if that is found for more than the given fraction of the frames,
+    # or if it is the only one found. Otherwise it is left blank. Of types 
+    # found equally often, the last in alphabetical order is taken.
+    def consensus(self,cutoff):
+        if not len(self):
+            return ""
+        order  = sorted(range(len(self.types)),key=lambda i: self.types[i],reverse=True)
+        counts = self.counts[:,order]
+        best   = counts.argmax(axis=1)
+        top    = counts[numpy.arange(len(counts)),best]
+        keep   = ((counts > 0).sum(axis=1) == 1) | (top/counts.sum(axis=1).astype(float) > cutoff)
+        types  = numpy.array([self.types[i] for i in order])
+        return "".join(numpy.where(keep,types[best]," "))
+
+    def write(self,stream):
+        json.dump({"types": self.types, "frames": self.frames, "counts": self.counts.tolist()},stream)
+        stream.write("\n")
+
+    def read(self,stream):
+        data        = json.load(stream)
+        self.types  = str(data["types"])
+        self.frames = data["frames"]
+        self.counts = numpy.array(data["counts"],dtype=numpy.int32).reshape((len(data["counts"]),len(self.types)))
 ################################
 ## 6 # FORCE FIELD PARAMETERS ##  -> @FF <-
 ################################
@@ -3027,7 +3694,7 @@ class martini22dna:
 #########################
 ## 7 # ELASTIC NETWORK ##  -> @ELN <-
 #########################
-import math
+import math,numpy
 
 ## ELASTIC NETWORK ##
 
@@ -3041,24 +3708,181 @@ import math
 def decayFunction(distance,shift,rate,power):
     return math.exp(-rate*math.pow(distance-shift,power))
 
-def rubberBands(atomList,lowerBound,upperBound,decayFactor,decayPower,forceConstant,minimumForce):
+# Rotation and centers for the least squares fit of y onto x (Kabsch).
+# The fitted coordinates are numpy.dot(y-cy,r)+cx.
+def superposition(x,y):
+    cx, cy = x.mean(axis=0), y.mean(axis=0)
+    u,s,vt = numpy.linalg.svd(numpy.dot((y-cy).T,x-cx))
+    if numpy.linalg.det(numpy.dot(u,vt)) < 0:
+        u[:,-1] = -u[:,-1]
+    return numpy.dot(u,vt), cy, cx
+
+# Pairs of points within a cutoff distance for an assembly of chains, given
+# as blocks (start,end) of the coordinates, with the same output as cellPairs
+# on the whole set. Chains with the same key and a structure deviating at most
+# tolerance (A) from the first such chain, after fitting the points selected 
+# with fit, are copies. The pairs within a copy are taken from the candidates
+# found once for the first chain, with the cutoff extended by twice the 
+# tolerance. Pairs between chains are only searched for chains that can come 
+# within the cutoff, based on their centers and radii, and then only for the
+# points of either chain that can reach the other. For all pairs, the distances
+# are calculated from the coordinates of the assembly.
+def assemblyPairs(coordinates,cutoff,blocks,keys,fit,skip=0,tolerance=1.0):
+    x      = numpy.asarray(coordinates,dtype=float).reshape((-1,3))
+    size   = cutoff*1.0001
+    out    = ([],[],[])
+    # Candidate pairs within chains, as local indices, for each key
+    first  = {}
+    for (start,end),key in zip(blocks,keys):
+        y = x[start:end]
+        f = fit[start:end]
+        if f.sum() < 3:
+            f = numpy.ones(len(y),dtype=bool)
+        if key in first:
+            tx, ti, tj = first[key]
+            r, cy, cx  = superposition(tx[f],y[f])
+            deviation  = numpy.sqrt(((numpy.dot(y-cy,r)+cx-tx)**2).sum(axis=1)).max()
+            if deviation > tolerance:
+                ti, tj = cellPairs(y,cutoff,skip)[:2]
+        else:
+            ti, tj = cellPairs(y,cutoff+2*tolerance,skip)[:2]
+            first[key] = (y,ti,tj)
+        # The squares are taken with pow, as in cellPairs
+        d    = y[ti]-y[tj]
+        two  = numpy.full(len(d),2.0)
+        d2   = numpy.power(d[:,0],two)+numpy.power(d[:,1],two)+numpy.power(d[:,2],two)
+        keep = d2 < size*size
+        out[0].append(ti[keep]+start)
+        out[1].append(tj[keep]+start)
+        out[2].append(d2[keep])
+    # Pairs between chains, searched for at once for the points that can
+    # reach a neighbouring chain
+    centers = numpy.array([x[start:end].mean(axis=0) for start,end in blocks])
+    radii   = numpy.array([numpy.sqrt(((x[start:end]-c)**2).sum(axis=1)).max() for (start,end),c in zip(blocks,centers)])
+    reach   = size+tolerance
+    surface = numpy.zeros(len(x),dtype=bool)
+    for a,b,d2 in zip(*cellPairs(centers,2*radii.max()+reach)):
+        if d2 > (radii[a]+radii[b]+reach)**2:
+            continue
+        (sa,ea),(sb,eb) = blocks[a], blocks[b]
+        surface[sa:ea] |= ((x[sa:ea]-centers[b])**2).sum(axis=1) < (radii[b]+reach)**2
+        surface[sb:eb] |= ((x[sb:eb]-centers[a])**2).sum(axis=1) < (radii[a]+reach)**2
+    surface = numpy.nonzero(surface)[0]
+    chain   = numpy.repeat(numpy.arange(len(blocks)),[end-start for start,end in blocks])
+    i,j,d2  = cellPairs(x[surface],cutoff)
+    i,j     = surface[i], surface[j]
+    keep    = (chain[i] != chain[j]) & (j-i > skip)
+    out[0].append(i[keep])
+    out[1].append(j[keep])
+    out[2].append(d2[keep])
+    i,j,d2 = [numpy.concatenate(k) for k in out]
+    srt    = numpy.lexsort((j,i))
+    return i[srt], j[srt], d2[srt]
+
+# The elastic network is determined using a cell list search, which only
+# tests pairs within the upper bound. The distances and force constants are
+# calculated for all candidate pairs at once and returned as arrays i, j, 
+# distance (nm) and force constant. The pairs are ordered by first atom, 
+# then by second atom, skipping the two nearest neighbours in the list, 
+# as with a direct loop over all pairs. Coordinates are in Angstrom.
+# For assemblies, the blocks, keys and fit selection are passed on 
+# to assemblyPairs. 
+def elasticNetwork(coordinates,lowerBound,upperBound,decayFactor,decayPower,forceConstant,minimumForce,blocks=None,keys=None,fit=None):
+    u2     = upperBound**2
+    # Mind the nm/A conversion -- This has to be standardized! Global use of nm?
+    if blocks and len(blocks) > 1:
+        i,j,d2 = assemblyPairs(coordinates,10*upperBound,blocks,keys,fit,skip=2)
+    else:
+        i,j,d2 = cellPairs(coordinates,10*upperBound,skip=2)
+    d2     = d2/100
+    keep   = d2 < u2
+    i,j,d2 = i[keep], j[keep], d2[keep]
+    dij    = numpy.sqrt(d2)
+    if decayFactor:
+        fscl = forceConstant*numpy.exp(-decayFactor*numpy.power(dij-lowerBound,decayPower))
+    else:
+        fscl = forceConstant*numpy.ones(len(dij))
+    keep   = fscl > minimumForce
+    return i[keep], j[keep], dij[keep], fscl[keep]
+
+# Mean and standard deviation of the distances between points over an 
+# ensemble of structures, given as an array (frames,points,3), for the pairs
+# with a mean distance below the cutoff. The distance between two points of
+# the mean structure is at most their mean distance, so the candidate pairs
+# are searched for in the mean structure, after fitting the frames onto the
+# first one. The distances are then calculated for the candidates only, for 
+# blocks of frames at once, at a cost linear in the number of frames times 
+# the number of candidates. The pairs are ordered as with cellPairs.
+def ensembleDistances(frames,cutoff,skip=0,chunk=1000000):
+    x    = numpy.asarray(frames,dtype=float)
+    mean = x[0].copy()
+    for frame in x[1:]:
+        r, cy, cx = superposition(x[0],frame)
+        mean += numpy.dot(frame-cy,r)+cx
+    mean /= len(x)
+    i, j  = cellPairs(mean,cutoff,skip)[:2]
+    s, s2 = numpy.zeros(len(i)), numpy.zeros(len(i))
+    step  = max(1,chunk//max(1,len(i)))
+    for start in range(0,len(x),step):
+        d   = x[start:start+step,i]-x[start:start+step,j]
+        d2  = (d*d).sum(axis=2)
+        s  += numpy.sqrt(d2).sum(axis=0)
+        s2 += d2.sum(axis=0)
+    mean = s/len(x)
+    sd   = numpy.sqrt(numpy.maximum(s2/len(x)-mean*mean,0))
+    keep = mean < cutoff
+    return i[keep], j[keep], mean[keep], sd[keep]
+
+# The elastic network over an ensemble of structures, as elasticNetwork,
+# using the mean distances. Bonds with a standard deviation of the distance
+# (nm) above maxDeviation are removed. With a temperature (K), the force 
+# constants are limited to kT over the variance of the distance, as with
+# an elastic network fitted to the fluctuations (ED-ENM).
+def ensembleNetwork(frames,lowerBound,upperBound,decayFactor,decayPower,forceConstant,minimumForce,maxDeviation=None,temperature=None):
+    i,j,dij,sd = ensembleDistances(frames,10*upperBound,skip=2)
+    dij, sd    = dij/10, sd/10
+    if maxDeviation is not None:
+        keep   = sd <= maxDeviation
+        i,j,dij,sd = i[keep], j[keep], dij[keep], sd[keep]
+    if decayFactor:
+        fscl = forceConstant*numpy.exp(-decayFactor*numpy.power(dij-lowerBound,decayPower))
+    else:
+        fscl = forceConstant*numpy.ones(len(dij))
+    if temperature:
+        # Boltzmann constant in kJ/mol/K
+        with numpy.errstate(divide="ignore"):
+            fscl = numpy.minimum(fscl,0.0083144626*temperature/(sd*sd))
+    keep   = fscl > minimumForce
+    return i[keep], j[keep], dij[keep], fscl[keep]
+
+# The atom list can be divided in chains, giving the number of atoms per 
+# chain as sizes. Chains with the same residues and beads are checked for
+# being copies, fitting on the backbone beads. If the coordinates of the 
+# atoms are given for an ensemble, as an array (frames,atoms,3), the network 
+# is set up with ensembleNetwork instead.
+def rubberBands(atomList,lowerBound,upperBound,decayFactor,decayPower,forceConstant,minimumForce,sizes=None,
+                frames=None,maxDeviation=None,temperature=None):
+    if len(atomList) < 4:
+        return []
+    beads, coords = zip(*atomList)
+    blocks, keys, fit = None, None, None
+    if sizes and sum(sizes) == len(beads):
+        ends   = numpy.cumsum(sizes).tolist()
+        blocks = [(end-size,end) for end,size in zip(ends,sizes) if size]
+        keys   = [tuple([(bead[3],bead[4]) for bead in beads[start:end]]) for start,end in blocks]
+        fit    = numpy.array([bead[4] == "BB" for bead in beads])
+    if frames is not None:
+        i,j,dij,fscl = ensembleNetwork(frames,lowerBound,upperBound,decayFactor,decayPower,forceConstant,minimumForce,maxDeviation,temperature)
+    else:
+        i,j,dij,fscl = elasticNetwork(coords,lowerBound,upperBound,decayFactor,decayPower,forceConstant,minimumForce,blocks,keys,fit)
     out = []
-    u2  = upperBound**2
-    while len(atomList) > 3:
-        bi,xi = atomList.pop(0)
-        for bj,xj in atomList[2:]:
-            # Mind the nm/A conversion -- This has to be standardized! Global use of nm?
-            d2 = distance2(xi,xj)/100
-            
-            if d2 < u2:
-                dij  = math.sqrt(d2)
-                fscl = forceConstant*decayFunction(dij,lowerBound,decayFactor,decayPower)
-                if fscl > minimumForce:
-                    out.append({
-                        "atoms":(bi[0],bj[0]),
-                        "parameters": (dij,"%f"%fscl),
-                        "comments": "%s%d%s(%s)-%s%d%s(%s)"%(bi[3],bi[2],bi[4],bi[7],bj[3],bj[2],bj[4],bj[7])
-                    })
+    for a,b,d,f in zip(i.tolist(),j.tolist(),dij.tolist(),fscl.tolist()):
+        bi, bj = beads[a], beads[b]
+        out.append({
+            "atoms":(bi[0],bj[0]),
+            "parameters": (d,Fixed(f)),
+            "comments": "%s%d%s(%s)-%s%d%s(%s)"%(bi[3],bi[2],bi[4],bi[7],bj[3],bj[2],bj[4],bj[7])
+        })
     return out
 
 
@@ -3066,7 +3890,7 @@ def rubberBands(atomList,lowerBound,upperBound,decayFactor,decayPower,forceConst
 #######################
 ## 8 # STRUCTURE I/O ##  -> @IO <-
 #######################
-import logging,math,random,sys
+import logging,math,numpy,os,random,sys
 
 #----+---------+
 ## A | PDB I/O |
@@ -3153,21 +3977,35 @@ def pdbChains(pdbAtomList):
         yield chain
 
 
+# Read the atoms of a frame from the columns of the ATOM/HETATM lines at once.
+# This gives the same atoms as pdbAtom for each line.
+def pdbAtoms(lines):
+    chars          = fixedColumns(lines,54)
+    names, codes   = strippedField(chars[:,12:16])
+    resn, resnames = strippedField(chars[:,17:20])
+    resids         = integerField(chars[:,22:26])+(chars[:,26].view(numpy.uint8).astype(int)<<20)
+    chain          = fixedField(chars[:,21:22])
+    xyz            = fixedFloats(chars[:,30:54],8)
+    x,y,z          = xyz.T
+    return AtomList(zip(names.tolist(),resn.tolist(),resids.tolist(),chain.tolist(),x.tolist(),y.tolist(),z.tolist()),
+                    resnames,resids,chain.view(numpy.uint8),xyz)
+
+
 # Simple PDB iterator
 def pdbFrameIterator(streamIterator):  
     title, atoms, box = [], [], []
     for i in streamIterator:
         if i.startswith("ENDMDL"):
-            yield "".join(title), atoms, box
+            yield "".join(title), pdbAtoms(atoms), box
             title, atoms, box = [], [], []            
         elif i.startswith("TITLE"):
             title.append(i)
         elif i.startswith("CRYST1"):
             box = pdbBoxRead(i)
         elif i.startswith("ATOM") or i.startswith("HETATM"):
-            atoms.append(pdbAtom(i))
+            atoms.append(i)
     if atoms:
-        yield "".join(title), atoms, box
+        yield "".join(title), pdbAtoms(atoms), box
 
 
 #----+---------+
@@ -3192,6 +4030,18 @@ def groAtom(a):
     ##               x,                 y,                 z       
             10*float(a[20:28]),10*float(a[28:36]),10*float(a[36:44]))
 
+# Read the atoms of a frame from the columns of the atom lines at once.
+# This gives the same atoms as groAtom for each line.
+def groAtoms(lines):
+    chars          = fixedColumns(lines,44)
+    names, codes   = strippedField(chars[:,10:15])
+    resn, resnames = strippedField(chars[:,5:10])
+    resids         = integerField(chars[:,:5])+(32<<20)
+    xyz            = 10*fixedFloats(chars[:,20:44],8)
+    x,y,z          = xyz.T
+    return AtomList(zip(names.tolist(),resn.tolist(),resids.tolist(),len(lines)*[" "],x.tolist(),y.tolist(),z.tolist()),
+                    resnames,resids,numpy.zeros(len(lines),dtype=int),xyz)
+
 # Simple GRO iterator
 def groFrameIterator(streamIterator):
     while True:
@@ -3203,15 +4053,176 @@ def groFrameIterator(streamIterator):
         if not natoms:
             break
         natoms = int(natoms)
-        atoms  = [groAtom(streamIterator.next())  for i in range(natoms)] 
+        atoms  = groAtoms([streamIterator.next() for i in range(natoms)])
         box    = groBoxRead(streamIterator.next())
         yield title, atoms, box
 
 
+#----+---------+
+## C | TRR I/O |
+#----+---------+
+
+# Coarse grain an atomistic trajectory, using a TrajectoryMapping.
+# The frames are read one at a time and written directly after mapping,
+# in the precision of the input trajectory. Returns the number of frames.
+def mapTrajectory(trajectory,output,mapping):
+    # The TRR reader/writer is only needed here, and requires numpy
+    from gmx.trr import TRR, TRRWriter
+    trr = TRR(trajectory)
+    if trr.atoms != mapping.natoms:
+        logging.error("Number of atoms in trajectory (%d) does not match the structure (%d)."%(trr.atoms,mapping.natoms))
+        sys.exit(1)
+    out = TRRWriter(output,precision=trr.float)
+    n   = 0
+    for frame in trr:
+        out.write(mapping(frame.x()),box=frame.box(),step=frame.step,time=frame.time,lmb=frame.lmb)
+        # Release the data read for this frame
+        frame.clear()
+        n += 1
+    out.close()
+    return n
+
+
 #----+-------------+
-## C | GENERAL I/O |
+## D | GENERAL I/O |
 #----+-------------+
 
+# Fixed width columns of lines as an array of characters, with one row per line.
+# Lines are cut or padded (with null characters) to the given width.
+def fixedColumns(lines,width):
+    return numpy.array(lines,dtype="S%d"%width).view("S1").reshape((len(lines),width))
+
+
+# The strings from a block of columns
+def fixedField(chars):
+    return numpy.ascontiguousarray(chars).view("S%d"%chars.shape[1]).ravel()
+
+
+# The stripped strings from a block of columns, together with codes that are
+# equal for equal strings. Only the distinct strings are stripped one by one.
+def strippedField(chars):
+    field, index   = numpy.unique(fixedField(chars),return_inverse=True)
+    strings, codes = numpy.unique([i.strip() for i in field],return_inverse=True)
+    return numpy.array(strings.tolist(),dtype=object)[codes][index], codes[index]
+
+
+# The integers from a block of columns, converted with int() per distinct field
+def integerField(chars):
+    field, index = numpy.unique(fixedField(chars),return_inverse=True)
+    return numpy.array([int(i) for i in field],dtype=int)[index]
+
+
+# Classes of characters in fixed point numbers: blanks, signs, digits and others
+fixedKinds = numpy.full(256,7,dtype=numpy.uint8)
+fixedKinds[32], fixedKinds[45], fixedKinds[48:58] = 0, 1, 3
+
+
+# The floating point numbers from blocks of columns of the given width, as an
+# array with one row per line. Fixed point numbers (like %8.3f) are taken from
+# the digits directly, which gives the same value as float(), as the division 
+# by the power of ten is rounded correctly. Anything else is left to float().
+def fixedFloats(chars,width):
+    shape  = (len(chars),chars.shape[1]//width)
+    # One row per character position, for contiguous access
+    fields = numpy.ascontiguousarray(chars).view(numpy.uint8).reshape((-1,width)).T.copy()
+    point  = numpy.flatnonzero(fields[:,0] == 46) if fields.size else [0]
+    if len(point) == 1 and point[0] > 0:
+        # The decimal point should be at the same position in all fields,
+        # preceded by blanks, an optional sign and at least one digit, and 
+        # followed by digits only.
+        p      = point[0]
+        kinds  = fixedKinds.take(fields[:p])
+        digits = fields[p+1:]-48
+        if ((fields[p] == 46).all() and (digits < 10).all() and (kinds[-1] == 3).all() and
+            (kinds[1:] >= kinds[:-1]).all() and (kinds[1:]+kinds[:-1] != 2).all()):
+            value = numpy.zeros(fields.shape[1])
+            for j in range(p):
+                value *= 10
+                value += (fields[j]-48)*(kinds[j] == 3)
+            for j in range(width-p-1):
+                value *= 10
+                value += digits[j]
+            value /= 10.0**(width-p-1)
+            value[(kinds == 1).any(axis=0)] *= -1
+            return value.reshape(shape)
+    return numpy.ascontiguousarray(chars).view("S%d"%width).astype(float).reshape(shape)
+
+
+# Writer for the coarse grained structure (-x), as PDB, GRO or TRR, 
+# depending on the extension of the file name. A frame is formatted at once,
+# using a format string in which the columns that are the same for all 
+# frames (atom numbers, names, residue names and numbers) are filled in
+# already, leaving only the coordinates and the B-factor. The format 
+# string is only set up again if the atoms differ from those of the 
+# previous frame. The atoms are given as tuples (name,resn,resi,chain,x,y,z,b), 
+# with a TER statement following the atoms with the indices given.
+class StructureWriter:
+    def __init__(self,filename):
+        self.format = os.path.splitext(filename)[1].lower()[1:]
+        if self.format not in ("gro","trr"):
+            self.format = "pdb"
+        if self.format == "trr":
+            # The TRR writer is only needed here
+            from gmx.trr import TRRWriter
+            self.stream = TRRWriter(filename)
+        else:
+            self.stream = open(filename,"w")
+        self.frame    = 0
+        self.atoms    = None
+        self.template = None
+
+    # The format string for the lines of the atoms of a frame
+    def setup(self,atoms,ter):
+        lines = []
+        for atid,(name,resn,resi,chain) in enumerate(atoms,1):
+            insc  = resi>>20
+            resid = resi - (insc<<20)
+            if resid > 1000000:
+                insc += 1
+                resid = resi - (insc<<20)
+            if self.format == "gro":
+                line = groline.split("%8.3f")[0]%(resid%100000,resn[:5],name[:5],atid%100000)
+                lines.append(line.replace("%","%%")+"%8.3f%8.3f%8.3f\n")
+            else:
+                line = pdbAtomLine.split("%8.3f")[0]%(atid,name,resn[:3],chain,resid,chr(insc))
+                lines.append(line.replace("%","%%")+"%8.3f%8.3f%8.3f  1.00%6.2f\n")
+        if self.format == "pdb":
+            for i in ter:
+                lines[i] += "TER\n"
+        self.atoms    = atoms
+        self.template = "".join(lines)
+
+    def write(self,title,box,atoms,ter=()):
+        self.frame += 1
+        x = numpy.array([a[4:8] for a in atoms],dtype=float).reshape((-1,4))
+        if self.format == "trr":
+            box = numpy.reshape(box or 9*[0],(3,3))
+            self.stream.write(0.1*x[:,:3],box=box,step=self.frame-1)
+            return
+        ids = [a[:4] for a in atoms]
+        if ids != self.atoms:
+            self.setup(ids,ter)
+        if self.format == "gro":
+            box   = list(box or 9*[0])
+            title = title.strip().split("\n")
+            if title[0].startswith("TITLE"):
+                # PDB TITLE records, with the text from column 11
+                title = [" ".join([line[10:].strip() for line in title])]
+            text  = [title[0] or "Coarse grained structure","\n%5d\n"%len(atoms),
+                    self.template%tuple((0.1*x[:,:3]).ravel().tolist())]
+            if any(box[1:4]+box[5:8]):
+                text.append((9*"%10.5f"+"\n")%tuple(box[i] for i in (0,4,8,1,2,3,5,6,7)))
+            else:
+                text.append((3*"%10.5f"+"\n")%tuple(box[0::4]))
+        else:
+            text = ["MODEL %8d\n"%self.frame,title,pdbBoxString(box),
+                    self.template%tuple(x.ravel().tolist()),"ENDMDL\n"]
+        self.stream.write("".join(text))
+
+    def close(self):
+        self.stream.close()
+
+
 # It is not entirely clear where this fits in best.
 # Called from main. 
 def getChargeType(resname,resid,choices):
@@ -3268,7 +4279,7 @@ def streamTag(stream):
 
 
 #----+-----------------+
-## D | STRUCTURE STUFF |
+## E | STRUCTURE STUFF |
 #----+-----------------+
 
 
@@ -3276,24 +4287,148 @@ def streamTag(stream):
 # If standard, dictionary type indexing is used, only exact matches are
 # returned. Alternatively, partial matching can be achieved by setting
 # a second 'True' argument. 
+# Atoms are looked up by name through a dictionary, which is built when 
+# first needed. The coordinates of the atoms are likewise available as an 
+# (n,3) array. Both are dropped when the list is changed.
 class Residue(list):
+    _names       = None
+    _coordinates = None
+
+    def _changed(self):
+        self._names       = None
+        self._coordinates = None
+
+    # Indices of the atoms with the names given, in the order of the residue.
+    # The dictionary holds the index of the first atom with each name, so 
+    # the residue is only scanned if it has atoms with the same name.
+    def indices(self,*names):
+        if self._names is None:
+            atoms = [atom[0] for atom in self]
+            self._names = dict(zip(atoms,range(len(atoms))))
+            if len(self._names) < len(atoms):
+                self._names = dict(zip(atoms[::-1],range(len(atoms)-1,-1,-1)))
+        if len(self._names) == len(self):
+            return sorted([self._names[i] for i in names if i in self._names])
+        return [i for i,atom in enumerate(self) if atom[0] in names]
+
+    # The coordinates of the atoms as an array
+    def coordinates(self):
+        if self._coordinates is None:
+            self._coordinates = numpy.array([atom[4:7] for atom in self],dtype=float).reshape((-1,3))
+        return self._coordinates
+
     def __getitem__(self,tag): 
         if type(tag) == int:
             # Call the parent class __getitem__
             return list.__getitem__(self,tag)
         if type(tag) == str:
-            for i in self:
-                if i[0] == tag:
-                    return i
-            else:
-                return 
+            names = self._names
+            if names is None:
+                self.indices()
+                names = self._names
+            i = names.get(tag)
+            if i is not None:
+                return list.__getitem__(self,i)
+            return 
         if tag[1]:
             return [i for i in self if tag[0] in i[0]] # Return partial matches
         else:
-            return [i for i in self if i[0] == tag[0]] # Return exact matches only
+            return [list.__getitem__(self,i) for i in self.indices(tag[0])] # Return exact matches only
+
+    def __setitem__(self,index,item):
+        list.__setitem__(self,index,item)
+        self._changed()
+
+    def __delitem__(self,index):
+        list.__delitem__(self,index)
+        self._changed()
+
+    def __setslice__(self,i,j,items):
+        list.__setslice__(self,i,j,items)
+        self._changed()
+
+    def __delslice__(self,i,j):
+        list.__delslice__(self,i,j)
+        self._changed()
+
+    def __iadd__(self,items):
+        self.extend(items)
+        return self
+
+    def append(self,item):
+        list.append(self,item)
+        self._changed()
+
+    def extend(self,items):
+        list.extend(self,items)
+        self._changed()
+
+    def insert(self,index,item):
+        list.insert(self,index,item)
+        self._changed()
+
+    def pop(self,*args):
+        self._changed()
+        return list.pop(self,*args)
+
+    def remove(self,item):
+        list.remove(self,item)
+        self._changed()
+
+    def sort(self,*args,**kwargs):
+        list.sort(self,*args,**kwargs)
+        self._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
+
+
+# A list of atom tuples, as read from the columns of a frame. The residue names
+# (as codes), residue numbers and chain identifiers are kept as arrays, to find
+# the residue and chain boundaries at once, rather than atom by atom.
+class AtomList(list):
+    def __init__(self,atoms,resnames,resids,chains,coordinates=None):
+        list.__init__(self,atoms)
+        self.resnames    = resnames
+        self.resids      = resids
+        self.chainids    = chains
+        self.coordinates = coordinates
+
+    # Indices of the first atoms of stretches with the same values in the columns
+    def starts(self,*columns):
+        change = numpy.zeros(max(len(self)-1,0),dtype=bool)
+        for column in columns:
+            change |= column[1:] != column[:-1]
+        return [0]+(numpy.flatnonzero(change)+1).tolist()
+
+    # The same residues as given by the function residues() 
+    def residues(self):
+        if not self:
+            return []
+        starts   = self.starts(self.resnames,self.resids,self.chainids)+[len(self)]
+        residues = [Residue(self[i:j]) for i,j in zip(starts[:-1],starts[1:])]
+        # The coordinates of the residues are views of those of the frame
+        if self.coordinates is not None:
+            for residue,i,j in zip(residues,starts[:-1],starts[1:]):
+                residue._coordinates = self.coordinates[i:j]
+        return residues
+
+    # The residues per chain, with chains split on the chain identifier as by pdbChains
+    def chains(self):
+        if not self:
+            return []
+        residues = self.residues()
+        starts   = numpy.searchsorted(self.starts(self.resnames,self.resids,self.chainids),
+                                      self.starts(self.chainids)).tolist()+[len(residues)]
+        return [residues[i:j] for i,j in zip(starts[:-1],starts[1:])]
 
 
 def residues(atomList):
+    if isinstance(atomList,AtomList):
+        for residue in atomList.residues():
+            yield residue
+        return
     residue = [atomList[0]]
     for atom in atomList[1:]:
         if (atom[1] == residue[-1][1] and # Residue name check
@@ -3310,16 +4445,49 @@ def residueDistance2(r1,r2):
     return min([distance2(i,j) for i in r1 for j in r2])
 
 
+# Squared minimal distances between the atoms of consecutive residues, for
+# coordinates with shape (atoms,3) or (frames,atoms,3), given the (increasing)
+# residue index of each atom. The atoms of the residues are padded to arrays 
+# of equal size, to get all distances between neighbouring residues at once.
+def residueDistances2(coordinates,index):
+    x      = numpy.asarray(coordinates,dtype=float)
+    frames = x.reshape((-1,)+x.shape[-2:])
+    index  = numpy.asarray(index,dtype=int)
+    counts = numpy.bincount(index)
+    first  = numpy.concatenate(([0],numpy.cumsum(counts)[:-1]))
+    slot   = numpy.arange(len(index))-first[index]
+    shape  = (len(counts),counts.max())
+    padded = numpy.zeros((len(frames),)+shape+(3,))
+    padded[:,index,slot] = frames
+    filled = numpy.zeros(shape,dtype=bool)
+    filled[index,slot] = True
+    # Differences between all atoms of each residue and those of the next
+    d    = padded[:,:-1,:,None]-padded[:,1:,None,:]
+    two  = numpy.full(d.shape[:-1],2.0)
+    d2   = numpy.power(d[...,0],two)+numpy.power(d[...,1],two)+numpy.power(d[...,2],two)
+    d2[:,~(filled[:-1,:,None] & filled[1:,None,:])] = numpy.inf
+    return d2.min(axis=3).min(axis=2).reshape(x.shape[:-2]+(len(counts)-1,))
+
+
 def breaks(residuelist,selection=("N","CA","C"),cutoff=2.5):
-    # Extract backbone atoms coordinates
-    bb = [[atom[4:] for atom in residue if atom[0] in selection] for residue in residuelist]
+    # Extract backbone atoms indices
+    bb = [residue.indices(*selection) for residue in residuelist]
     # Needed to remove waters residues from mixed residues.
-    bb = [res for res in bb if res != []]
+    bb = [(residue,res) for residue,res in zip(residuelist,bb) if res]
+    if len(bb) < 2:
+        return []
+
+    # Take the coordinates of the backbone atoms from those of all atoms
+    # of the residues at once
+    first = numpy.cumsum([0]+[len(residue) for residue,res in bb]).tolist()
+    index = [i+k for (residue,res),k in zip(bb,first) for i in res]
+    x     = numpy.concatenate([residue.coordinates() for residue,res in bb])[index]
 
     # We cannot rely on some standard order for the backbone atoms.
     # Therefore breaks are inferred from the minimal distance between
     # backbone atoms from adjacent residues.
-    return [ i+1 for i in range(len(bb)-1) if residueDistance2(bb[i],bb[i+1]) > cutoff]
+    d2 = residueDistances2(x,numpy.repeat(numpy.arange(len(bb)),[len(res) for residue,res in bb]))
+    return (numpy.flatnonzero(d2 > cutoff)+1).tolist()
 
 
 def contacts(atoms,cutoff=5):
@@ -3377,6 +4545,21 @@ def check_merge(chains, m_list=[], l_list=[], ss_cutoff=0):
     # Rearrange merge list to a list of pairs
     pairs = [(i[j],i[k]) for i in merges for j in range(len(i)-1) for k in range(j+1,len(i))]
 
+    # Find the cystine bridges between chains, based on the distance 
+    # between the SG atoms. For each pair of chains the first contact
+    # is stored.
+    contacts = {}
+    if ss_cutoff:
+        sulphur  = [(k,cys["SG"]) for k in chainIndex for cys in chains[k]["CYS"] if cys["SG"]]
+        if sulphur:
+            owner, sg = zip(*sulphur)
+            for a,b,d2 in zip(*[i.tolist() for i in contactPairs([[atom[4:7] for atom in sg]],ss_cutoff)]):
+                if owner[a] != owner[b] and not (owner[a],owner[b]) in contacts:
+                    contacts[(owner[a],owner[b])] = d2
+
+    # Find the chains containing either atom of each link
+    linked = [([k for k in chainIndex if a in chains[k]],[k for k in chainIndex if b in chains[k]]) for a,b in l_list]
+
     # Check each combination of chains for connections based on
     # ss-bridges, links and distance restraints
     for i in chainIndex[:-1]:
@@ -3384,9 +4567,9 @@ def check_merge(chains, m_list=[], l_list=[], ss_cutoff=0):
             if (i,j) in pairs:
                 continue
             # Check whether any link links these two groups
-            for a,b in l_list:                
-                if ((a in chains[i] and b in chains[j]) or 
-                    (a in chains[j] and b in chains[i])):
+            for (a,b),(ina,inb) in zip(l_list,linked):
+                if ((i in ina and j in inb) or 
+                    (j in ina and i in inb)):
                     logging.info("Merging chains %d and %d to allow link %s"%(i+1,j+1,str((a,b))))
                     pairs.append( i<j and (i,j) or (j,i) )
                     break
@@ -3402,19 +4585,9 @@ def check_merge(chains, m_list=[], l_list=[], ss_cutoff=0):
             #if (i,j) in pairs:
             #    continue
             # Check for cystine bridges based on distance
-            if not ss_cutoff:
-                continue
-            # Get SG atoms from cysteines from either chain
-            # Check this pair of chains
-            for cysA in chains[i]["CYS"]:
-                for cysB in chains[j]["CYS"]:
-                    d2 = distance2(cysA["SG"][4:7],cysB["SG"][4:7]) 
-                    if d2 <= ss_cutoff:
-                        logging.info("Found SS contact linking chains %d and %d (%f nm)"%(i+1,j+1,math.sqrt(d2)/10))
-                        pairs.append((i,j))
-                    break
-                if (i,j) in pairs:
-                    break
+            if (i,j) in contacts:
+                logging.info("Found SS contact linking chains %d and %d (%f nm)"%(i+1,j+1,math.sqrt(contacts[(i,j)])/10))
+                pairs.append((i,j))
 
     # Sort the combinations
     pairs.sort(reverse=True)
@@ -3499,6 +4672,9 @@ class Chain:
 
         # Container for coarse grained beads
         self._cg        = None
+
+        # Dictionaries for looking up atoms and beads (see _lookup)
+        self._indices   = {}
         
     def __len__(self):
         # Return the number of residues
@@ -3526,6 +4702,10 @@ class Chain:
                 self.links      == other.links  and
                 self.multiscale == other.multiscale)
 
+    # Hashable signature of the chain; chains are equal if their signatures are.
+    def signature(self):
+        return (self.seq,self.ss,tuple(self.breaks),tuple(self.links),self.multiscale)
+
     # Extract a residue by number or the list of residues of a given type
     # This facilitates selecting residues for links, like chain["CYS"]
     def __getitem__(self,other):
@@ -3537,15 +4717,8 @@ class Chain:
             # This functionality is set up for links
             # between coarse grained beads. So these are
             # checked first,
-            for i in self.cg():
-                if other == i[:4]:
-                    return i
-            else:
-                for i in self.atoms():
-                    if other[:3] == i[:3]:
-                        return i
-                else:
-                    return []
+            return (self._lookup(self.cg(),(1,1,1,1)).get(other) or 
+                    self._lookup(self.atoms(),(1,1,1)).get(other[:3]) or [])
         return self.sequence[other]
 
     # Extract a piece of a chain as a new chain
@@ -3566,6 +4739,21 @@ class Chain:
         # Return the chain slice
         return newchain
 
+    # Dictionary of the items in atomlist (atoms or beads), keyed by the 
+    # fields selected by mask, e.g. (1,0,1) for (name,resi). Each key 
+    # refers to the first matching item. The dictionaries are built on 
+    # first use and are kept until the atom or bead list is regenerated.
+    def _lookup(self,atomlist,mask):
+        if not atomlist:
+            return {}
+        key = (id(atomlist),mask)
+        if not key in self._indices:
+            index = {}
+            for item in atomlist:
+                index.setdefault(tuple([f for f,m in zip(item,mask) if m]),item)
+            self._indices[key] = (atomlist,index)
+        return self._indices[key][1]
+
     def _contains(self,atomlist,atom):
         atnm,resn,resi,chn = atom
         
@@ -3575,24 +4763,13 @@ class Chain:
 
         # Check if the whole tuple is in
         if atnm and resn and resi:
-            return (atnm,resn,resi) in self.atoms()
-
-        # Fetch atoms with matching residue id
-        match = (not resi) and atomlist or [j for j in atomlist if j[2] == resi]
-        if not match:
-            return False
-
-        # Select atoms with matching residue name
-        match = (not resn) and match or [j for j in match if j[1] == resn]
-        if not match:
-            return False
+            return (atnm,resn,resi) in self._lookup(self.atoms(),(1,1,1))
 
-        # Check whether the atom is given and listed
-        if not atnm or [j for j in match if j[0] == atnm]:
-            return True
-
-        # It just is not in the list!
-        return False
+        # Match the fields that are given; if none is, any atom will do
+        mask = (atnm and 1 or 0, resn and 1 or 0, resi and 1 or 0)
+        if not any(mask):
+            return bool(atomlist)
+        return tuple([f for f,m in zip(atom,mask) if m]) in self._lookup(atomlist,mask)
 
     def __contains__(self,other):
         return self._contains(self.atoms(),other) or self._contains(self.cg(),other)
@@ -3602,7 +4779,8 @@ class Chain:
 
     def atoms(self):
         if not self._atoms:
-            self._atoms = [atom[:3] for residue in self.residues for atom in residue]
+            self._atoms   = [atom[:3] for residue in self.residues for atom in residue]
+            self._indices = {}
         return self._atoms
 
     # Split a chain based on residue types; each subchain can have only one type
@@ -3636,13 +4814,17 @@ class Chain:
         # Infer the Martini backbone secondary structure types
         self.ssclass, self.sstypes = ssClassification(self.ss,source)
 
-    def dss(self,method=None,executable=None):
+    def dss(self,method=None,executable=None,ss=None):
         # The method should take a list of atoms and return a 
         # string of secondary structure classifications       
+        # If the classification was already determined, e.g. by
+        # a worker process, it can be given as ss.
         if self.type() == "Protein":
             if method:
-                atomlist = [atom for residue in self.residues for atom in residue]
-                self.set_ss(ssDetermination[method](self,atomlist,executable),source=method)
+                if ss is None:
+                    atomlist = [atom for residue in self.residues for atom in residue]
+                    ss = ssDetermination[method](self,atomlist,executable)
+                self.set_ss(ss,source=method)
             else:
                 self.set_ss(len(self)*"C")
         else:
@@ -3668,11 +4850,10 @@ class Chain:
         # unless regeneration is forced.
         if self._cg and not force:
             return self._cg
-        self._cg = []
-        atid     = 1
-        bb       = [1]
-        fail     = False
+        self._cg      = []
+        self._indices = {}
         previous = ''
+        mapped   = []
         for residue,rss,resname in zip(self.residues,self.sstypes,self.sequence):
             # For DNA we need to get the O3' to the following residue when calculating COM
             # The force and com options ensure that this part does not affect itp generation or anything else
@@ -3698,23 +4879,33 @@ class Chain:
             if not residue[0][1] in CoarseGrained.mapping.keys():
                 logging.warning("Skipped unknown residue %s\n"%residue[0][1])
                 continue
-            # Get the mapping for this residue
-            # CG.map returns bead coordinates and mapped atoms
-            # This will fail if there are (too many) atoms missing, which is
-            # only problematic if a mapped structure is written; the topology
-            # is inferred from the sequence. So this is the best place to raise 
-            # an error
-            try:
-                beads, ids = map(residue,ca2bb=self.options['ForceField'].ca2bb)
-                beads      = zip(CoarseGrained.names[residue[0][1]],beads,ids)
-                if residue[0][1] in self.options['ForceField'].polar:
-                    beads = add_dummy(beads,dist=0.14,n=2)
-                elif residue[0][1] in self.options['ForceField'].charged:
-                    beads = add_dummy(beads,dist=0.11,n=1)
-            except ValueError:
+            mapped.append((residue,rss))
+
+        if not mapped:
+            return self._cg
+
+        # Get the mapping for the residues of this chain, as a single weight 
+        # matrix giving all bead positions in one go.
+        # This will fail if there are (too many) atoms missing, which is
+        # only problematic if a mapped structure is written; the topology
+        # is inferred from the sequence. So this is the best place to raise 
+        # an error
+        matrix = MappingMatrix([residue for residue,rss in mapped],ca2bb=self.options['ForceField'].ca2bb)
+        if matrix.missing:
+            for residue in matrix.missing:
                 logging.error("Too many atoms missing from residue %s %d(ch:%s):",residue[0][1],residue[0][2]-(32<<20),residue[0][3])
                 logging.error(repr([ i[0] for i in residue ]))
-                fail = True
+            logging.error("Unable to generate coarse grained structure due to missing atoms.")
+            sys.exit(1)
+        positions = matrix([atom[4:7] for residue,rss in mapped for atom in residue]).tolist()
+
+        atid = 1
+        for (residue,rss),(coords,ids) in zip(mapped,matrix.residues(positions)):
+            beads = zip(CoarseGrained.names[residue[0][1]],coords,ids)
+            if residue[0][1] in self.options['ForceField'].polar:
+                beads = add_dummy(beads,dist=0.14,n=2)
+            elif residue[0][1] in self.options['ForceField'].charged:
+                beads = add_dummy(beads,dist=0.11,n=1)
 
             for name,(x,y,z),ids in beads:                    
                 # Add the bead with coordinates and secondary structure id to the list
@@ -3725,13 +4916,6 @@ class Chain:
             # Increment the atom id; This pertains to the atoms that are included in the output.
             atid += len(residue)
 
-            # Keep track of the numbers for CONECTing
-            bb.append(bb[-1]+len(beads))
-
-        if fail:
-            logging.error("Unable to generate coarse grained structure due to missing atoms.")
-            sys.exit(1)
-
         return self._cg
 
     def conect(self):
@@ -3748,7 +4932,7 @@ class Chain:
 ##################
 ## 7 # TOPOLOGY ##  -> @TOP <-
 ##################
-import logging,math
+import array,hashlib,logging,math,numpy,os,re,sys,tempfile
 
 # This is a generic class for Topology Bonded Type definitions
 class Bonded:
@@ -3921,33 +5105,398 @@ class Dihedral(Bonded):
 # If standard, dictionary type indexing is used, only exact matches are
 # returned. Alternatively, partial matching can be achieved by setting
 # a second 'True' argument. 
+# The items are also kept in buckets per category, so that selecting a 
+# category does not require scanning the whole list. The buckets are 
+# updated when items are appended or extended; other changes to the list
+# cause the buckets to be rebuilt when needed.
 class CategorizedList(list):
+    def __init__(self,*args):
+        list.__init__(self,*args)
+        self._buckets = None
+
+    def _bucket(self,item):
+        self._buckets.setdefault(getattr(item,"category",None),[]).append(item)
+
+    def _rebuild(self):
+        self._buckets = {}
+        for item in self:
+            self._bucket(item)
+
+    def append(self,item):
+        list.append(self,item)
+        if self._buckets is not None:
+            self._bucket(item)
+
+    def extend(self,items):
+        start = len(self)
+        list.extend(self,items)
+        if self._buckets is not None:
+            for item in list.__getslice__(self,start,len(self)):
+                self._bucket(item)
+
+    def __iadd__(self,items):
+        self.extend(items)
+        return self
+
+    def __setitem__(self,index,item):
+        if list.__getitem__(self,index) is not item:
+            self._buckets = None
+        list.__setitem__(self,index,item)
+
+    def __delitem__(self,index):
+        list.__delitem__(self,index)
+        self._buckets = None
+
+    def __setslice__(self,i,j,items):
+        list.__setslice__(self,i,j,items)
+        self._buckets = None
+
+    def __delslice__(self,i,j):
+        list.__delslice__(self,i,j)
+        self._buckets = None
+
+    def insert(self,index,item):
+        list.insert(self,index,item)
+        self._buckets = None
+
+    def pop(self,*args):
+        self._buckets = None
+        return list.pop(self,*args)
+
+    def remove(self,item):
+        list.remove(self,item)
+        self._buckets = None
+
+    def sort(self,*args,**kwargs):
+        list.sort(self,*args,**kwargs)
+        self._buckets = None
+
+    def reverse(self):
+        list.reverse(self)
+        self._buckets = None
+
+    # Iterate over the items of a category, or over those of which the
+    # category contains the tag, if a tuple (tag,True) is given.
+    def select(self,tag):
+        if self._buckets is None:
+            self._rebuild()
+        if type(tag) == str:
+            return iter(self._buckets.get(tag,[]))
+        if not tag[1]:
+            return iter(self._buckets.get(tag[0],[]))
+        keys = [key for key in self._buckets if key is not None and tag[0] in key]
+        if len(keys) == 1:
+            return iter(self._buckets[keys[0]])
+        # With partial matches from different buckets, keep the order of the list
+        return (i for i in self if i.category in keys)
+
     def __getitem__(self,tag): 
         if type(tag) == int:
             # Call the parent class __getitem__
             return list.__getitem__(self,tag)
+        return list(self.select(tag))
+
+
+# Compact storage for bonded terms of one interaction type. Rather than
+# keeping a Bonded instance for each term, the atom indices, the bonded
+# type and the numerical parameters are stored in flat arrays, while
+# classes, categories, comments and the layout of the parameters (which
+# values are ints, floats, strings or None) are stored once and referred
+# to by index. The table behaves like a CategorizedList: terms are added
+# as Bonded instances, and are returned as (new) Bonded instances when 
+# indexing or iterating. Changes to a returned term are only stored if 
+# it is assigned back, as happens with table[-1] += shift.
+class TermTable:
+    # Categories of terms with a comment of their own, like the rubber bands
+    # listing the beads they connect. These are stored for each term, as
+    # looking them up as shared objects costs more than it saves.
+    uniqueComments = ("Rubber band",)
+
+    def __init__(self,terms=[]):
+        self._start    = array.array('l')  # Offset in _atoms for each term
+        self._count    = array.array('b')  # Number of atoms for each term
+        self._atoms    = array.array('l')  # Atom indices, flat
+        self._type     = array.array('i')  # Bonded type
+        self._pstart   = array.array('l')  # Offset in _values for each term
+        self._values   = array.array('d')  # Numerical parameters, flat
+        self._layout   = array.array('i')  # Ids of shared objects ...
+        self._class    = array.array('i')
+        self._comment  = array.array('i')
+        self._category = array.array('i')
+        self._objects  = []                # ... which are listed here 
+        self._ids      = {}
+        self._buckets  = None
+        self.extend(terms)
 
-        if type(tag) == str:
-            return [i for i in self if i.category == tag]
+    def __len__(self):
+        return len(self._type)
 
-        if tag[1]:
-            return [i for i in self if tag[0] in i.category]
+    def __nonzero__(self):
+        return len(self._type) > 0
+
+    # Return the id of a shared object, using the key for lookup.
+    # Unhashable objects (or a key None) are stored for each term separately.
+    def _intern(self,key,obj):
+        try:
+            if key is not None:
+                if key in self._ids:
+                    return self._ids[key]
+                self._ids[key] = len(self._objects)
+        except TypeError:
+            pass
+        self._objects.append(obj)
+        return len(self._objects)-1
+
+    def append(self,term):
+        parameters = term.parameters
+        if parameters is None:
+            layout, values = None, []
         else:
-            return [i for i in self if i.category == tag[0]]
+            layout, values = [type(parameters) == tuple and tuple or list], []
+            for p in parameters:
+                if p is None:
+                    layout.append(None)
+                elif type(p) in (int,float,Fixed):
+                    layout.append(type(p))
+                    values.append(p)
+                elif type(p) == str:
+                    layout.append(p)
+                else:
+                    layout.append(("object",p))
+            layout = tuple(layout)
+        comments = term.comments
+        if type(comments) != str:
+            comments = list(comments)
+        self._start.append(len(self._atoms))
+        self._count.append(len(term.atoms))
+        self._atoms.extend([int(i) for i in term.atoms])
+        self._type.append(term.type)
+        self._pstart.append(len(self._values))
+        self._values.extend(values)
+        self._layout.append(self._intern(("layout",layout),layout))
+        self._class.append(self._intern(("class",term.__class__),term.__class__))
+        self._comment.append(self._intern(term.category not in self.uniqueComments and
+                                          ("comment",type(comments),type(comments) == list and tuple(comments) or comments) or None,comments))
+        self._category.append(self._intern(("category",term.category),term.category))
+        if self._buckets is not None:
+            self._buckets.setdefault(term.category,array.array('l')).append(len(self)-1)
+
+    # Add terms, shifting the atom indices. If the terms are given as 
+    # a TermTable, this is done on the arrays, without creating terms.
+    def extend(self,terms,shift=0):
+        if not isinstance(terms,TermTable):
+            for term in terms:
+                if shift:
+                    term = term+shift
+                self.append(term)
+            return
+        if not len(terms):
+            return
+        # Map the ids of shared objects of the other table to ids in this one
+        keys = dict([(i,key) for key,i in terms._ids.items()])
+        ids  = numpy.array([self._intern(keys.get(i),obj) for i,obj in enumerate(terms._objects)],dtype=numpy.intc)
+        if self._buckets is not None:
+            first = len(self)
+            for k,c in enumerate(terms._category):
+                self._buckets.setdefault(terms._objects[c],array.array('l')).append(first+k)
+        self._start.fromstring((numpy.frombuffer(terms._start,dtype=int)+len(self._atoms)).tostring())
+        self._count.extend(terms._count)
+        self._atoms.fromstring((numpy.frombuffer(terms._atoms,dtype=int)+shift).tostring())
+        self._type.extend(terms._type)
+        self._pstart.fromstring((numpy.frombuffer(terms._pstart,dtype=int)+len(self._values)).tostring())
+        self._values.extend(terms._values)
+        for mine,other in ((self._layout,terms._layout),(self._class,terms._class),
+                           (self._comment,terms._comment),(self._category,terms._category)):
+            mine.fromstring(ids[numpy.frombuffer(other,dtype=numpy.intc)].tostring())
+
+    # Add the terms of a series of tables, shifting the atom indices of
+    # each by the corresponding shift. The tables can be repeated, like the
+    # residue templates along a chain. The arrays of each distinct table 
+    # are taken once, after which the result is assembled at once.
+    def tile(self,tables,shifts):
+        distinct = {}
+        for t in tables:
+            if len(t) and id(t) not in distinct:
+                keys = dict([(i,key) for key,i in t._ids.items()])
+                ids  = numpy.array([self._intern(keys.get(i),obj) for i,obj in enumerate(t._objects)],dtype=numpy.intc)
+                distinct[id(t)] = (numpy.frombuffer(t._start,dtype=int),numpy.frombuffer(t._count,dtype=numpy.int8),
+                                   numpy.frombuffer(t._atoms,dtype=int),numpy.frombuffer(t._type,dtype=numpy.intc),
+                                   numpy.frombuffer(t._pstart,dtype=int),numpy.frombuffer(t._values),
+                                   ids[numpy.frombuffer(t._layout,dtype=numpy.intc)],ids[numpy.frombuffer(t._class,dtype=numpy.intc)],
+                                   ids[numpy.frombuffer(t._comment,dtype=numpy.intc)],ids[numpy.frombuffer(t._category,dtype=numpy.intc)])
+        shifts = [s for t,s in zip(tables,shifts) if id(t) in distinct]
+        parts  = [distinct[id(t)] for t in tables if id(t) in distinct]
+        if not parts:
+            return
+        start,count,atoms,types,pstart,values,layout,cls,comment,category = [numpy.concatenate(i) for i in zip(*parts)]
+        # Number of terms, atoms and parameter values per table
+        nterms  = numpy.array([len(p[0]) for p in parts])
+        natoms  = numpy.array([len(p[2]) for p in parts])
+        nvalues = numpy.array([len(p[5]) for p in parts])
+        atoms   = atoms + numpy.repeat(shifts,natoms)
+        start   = start + numpy.repeat(numpy.cumsum(natoms)-natoms+len(self._atoms),nterms)
+        pstart  = pstart + numpy.repeat(numpy.cumsum(nvalues)-nvalues+len(self._values),nterms)
+        self._start.fromstring(start.astype(int).tostring())
+        self._count.fromstring(count.tostring())
+        self._atoms.fromstring(atoms.astype(int).tostring())
+        self._type.fromstring(types.tostring())
+        self._pstart.fromstring(pstart.astype(int).tostring())
+        self._values.fromstring(values.tostring())
+        for mine,other in ((self._layout,layout),(self._class,cls),(self._comment,comment),(self._category,category)):
+            mine.fromstring(other.astype(numpy.intc).tostring())
+        self._buckets = None
+
+    def _parameters(self,k):
+        layout = self._objects[self._layout[k]]
+        if layout is None:
+            return None
+        start  = self._pstart[k]
+        values = iter(self._values[start:start+len([p for p in layout[1:] if p in (int,float,Fixed)])])
+        out    = []
+        for p in layout[1:]:
+            if p in (int,float,Fixed):
+                out.append(p(values.next()))
+            elif type(p) == tuple:
+                out.append(p[1])
+            else:
+                out.append(p)
+        return layout[0](out)
+
+    # Create a Bonded instance for term k
+    def _term(self,k):
+        term            = self._objects[self._class[k]]()
+        start           = self._start[k]
+        term.atoms      = tuple(self._atoms[start:start+self._count[k]])
+        term.type       = self._type[k]
+        term.parameters = self._parameters(k)
+        term.comments   = self._objects[self._comment[k]]
+        term.category   = self._objects[self._category[k]]
+        return term
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self._term(k)
+
+    def _index(self,k):
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("TermTable index out of range")
+        return k
+
+    # Replace term k. The terms following it are moved, which is cheap
+    # for the last term, as in table[-1] += shift.
+    def __setitem__(self,k,term):
+        k    = self._index(k)
+        tail = [term]+[self._term(i) for i in range(k+1,len(self))]
+        self.__delslice__(k,len(self))
+        self.extend(tail)
+
+    def __delitem__(self,k):
+        k    = self._index(k)
+        tail = [self._term(i) for i in range(k+1,len(self))]
+        self.__delslice__(k,len(self))
+        self.extend(tail)
+
+    # Remove the terms from i onwards
+    def __delslice__(self,i,j):
+        if j < len(self):
+            raise ValueError("only trailing terms can be removed from a TermTable")
+        i = max(0,min(i,len(self)))
+        if i == len(self):
+            return
+        a, p = self._start[i], self._pstart[i]
+        del self._atoms[a:]
+        del self._values[p:]
+        for column in (self._start,self._count,self._type,self._pstart,self._layout,
+                       self._class,self._comment,self._category):
+            del column[i:]
+        self._buckets = None
+
+    def __contains__(self,other):
+        if not len(self):
+            return False
+        if type(other) in (list,tuple):
+            n     = len(other)
+            count = numpy.frombuffer(self._count,dtype=numpy.int8)
+            start = numpy.frombuffer(self._start,dtype=int)[count == n]
+            atoms = numpy.frombuffer(self._atoms,dtype=int)
+            match = numpy.ones(len(start),dtype=bool)
+            for i,a in enumerate(other):
+                match &= atoms[start+i] == a
+            return bool(match.any())
+        return other in list(self)
+
+    # Iterate over the terms of a category, or over those of which the
+    # category contains the tag, if a tuple (tag,True) is given.
+    def select(self,tag):
+        if self._buckets is None:
+            self._buckets = {}
+            for k,c in enumerate(self._category):
+                self._buckets.setdefault(self._objects[c],array.array('l')).append(k)
+        if type(tag) == str:
+            keys = [tag]
+        elif not tag[1]:
+            keys = [tag[0]]
+        else:
+            keys = [key for key in self._buckets if key is not None and tag[0] in key]
+        index = [self._buckets.get(key,[]) for key in keys]
+        if len(index) == 1:
+            index = index[0]
+        else:
+            # Keep the order of the table for terms from different buckets
+            index = sorted([k for i in index for k in i])
+        for k in index:
+            yield self._term(k)
+
+    def __getitem__(self,tag):
+        if type(tag) == int:
+            return self._term(self._index(tag))
+        return list(self.select(tag))
+
+
+# Header of a topology (include) file, listing the force field, the
+# version and the options used. 
+def itpHeader(name,options,multiscale=False):
+    if multiscale:
+        return '; MARTINI (%s) Multiscale virtual sites topology section for "%s"' %(options['ForceField'].name,name)
+    string  = '; MARTINI (%s) Coarse Grained topology file for "%s"' %(options['ForceField'].name,name)
+    string += '\n; Created by py version %s \n; Using the following options:  ' %(options['Version'])
+    string += ' '.join(options['Arguments'])
+    return string
 
 
 class Topology:
+    # Categories of bonded terms, with the descriptions in the topology file
+    bondCategories       = (("BB","Backbone bonds"),
+                            ("SC","Sidechain bonds"),
+                            ("Elastic short", "Short elastic bonds for extended regions"),
+                            ("Elastic long", "Long elastic bonds for extended regions"),
+                            ("Cystine","Cystine bridges"),
+                            ("Link","Links"))
+    constraintCategories = (("Cystine","Cystine bridges"),
+                            ("Link","Links"))
+    angleCategories      = (("BBB","Backbone angles"),
+                            ("BBS","Backbone-sidechain angles"),
+                            ("SC","Sidechain angles"))
+    dihedralCategories   = (("BBBB","Backbone dihedrals"),
+                            ("SC","Sidechain improper dihedrals"))
+
+    # Residue templates, by force field and residue name (bonded terms) or 
+    # by force field, residue name, backbone bead type and multiscaling (atoms)
+    residueTemplates = {}
+
     def __init__(self,other=None,options=None,name=""):
         self.name        = ''
         self.nrexcl      = 1
         self.atoms       = CategorizedList()
-        self.vsites      = CategorizedList() 
-        self.exclusions  = CategorizedList() 
-        self.bonds       = CategorizedList()
-        self.angles      = CategorizedList()
-        self.dihedrals   = CategorizedList()
-        self.impropers   = CategorizedList()
-        self.constraints = CategorizedList()
+        self.vsites      = TermTable() 
+        self.exclusions  = TermTable() 
+        self.bonds       = TermTable()
+        self.angles      = TermTable()
+        self.dihedrals   = TermTable()
+        self.impropers   = TermTable()
+        self.constraints = TermTable()
         self.posres      = CategorizedList()
         self.sequence    = []
         self.secstruc    = ""
@@ -4008,8 +5557,9 @@ class Topology:
             atom[2] += last[2]  # Update residue numbers
             atom[5] += last[5]  # Update charge group numbers
             self.atoms.append(tuple(atom))
-        for attrib in ["bonds","vsites","angles","dihedrals","impropers","constraints","posres"]:
-            getattr(self,attrib).extend([source+shift for source in getattr(other,attrib)])
+        for attrib in ["bonds","vsites","angles","dihedrals","impropers","constraints"]:
+            getattr(self,attrib).extend(getattr(other,attrib),shift)
+        self.posres.extend([source+shift for source in other.posres])
         return self
 
     def __add__(self,other):
@@ -4020,126 +5570,188 @@ class Topology:
         return out
 
     def __str__(self):
-        if self.multiscale:
-             out  = [ '; MARTINI (%s) Multiscale virtual sites topology section for "%s"' %(self.options['ForceField'].name,self.name) ]
-        else:
-             string  = '; MARTINI (%s) Coarse Grained topology file for "%s"' %(self.options['ForceField'].name, self.name)
-             string += '\n; Created by py version %s \n; Using the following options:  ' %(self.options['Version'])
-             string += ' '.join(self.options['Arguments'])
-             out  = [ string ]
+        return "\n".join(self.lines())
+
+    # Write the topology to a stream, section by section, 
+    # without building the whole text first.
+    def write(self,stream):
+        lines = self.lines()
+        for line in lines:
+            stream.write(line)
+            break
+        for line in lines:
+            stream.write("\n")
+            stream.write(line)
+
+    # Generator for the lines of the topology
+    def lines(self):
+        yield itpHeader(self.name,self.options,self.multiscale)
         if self.sequence:
-            out += [
-                '; Sequence:',
-                '; ' + ''.join([ AA321.get(AA) for AA in self.sequence ]),
-                '; Secondary Structure:',
-                '; ' + self.secstruc,
-                ]
+            yield '; Sequence:'
+            yield '; ' + ''.join([ AA321.get(AA) for AA in self.sequence ])
+            yield '; Secondary Structure:'
+            yield '; ' + self.secstruc
         
         # Do not print a molecule name when multiscaling
         # In that case, the topology created here needs to be appended
         # at the end of an atomistic moleculetype
         if not self.multiscale:
-            out += [ '\n[ moleculetype ]',
-                     '; Name         Exclusions',  
-                     '%-15s %3d' % (self.name,self.nrexcl)]
+            yield '\n[ moleculetype ]'
+            yield '; Name         Exclusions'
+            yield '%-15s %3d' % (self.name,self.nrexcl)
 
-        out.append('\n[ atoms ]')
+        yield '\n[ atoms ]'
 
         # For virtual sites and dummy beads we have to be able to specify the mass.
         # Thus we need two different format strings:
         fs8 = '%5d %5s %5d %5s %5s %5d %7.4f ; %s'  
         fs9 = '%5d %5s %5d %5s %5s %5d %7.4f %7.4f ; %s'  
-        out.extend([len(i)==9 and fs9%i or fs8%i for i in self.atoms])
+        for i in self.atoms:
+            yield len(i)==9 and fs9%i or fs8%i
 
         # Print out the vsites only if they excist. Right now it can only be type 1 virual sites.
-        vsites = [str(i) for i in self.vsites]
-        if vsites:
-            out.append('\n[ virtual_sites2 ]')
-            out.extend(vsites)
+        if self.vsites:
+            yield '\n[ virtual_sites2 ]'
+            for i in self.vsites:
+                yield str(i)
 
         # Print out the exclusions only if they excist.
-        exclusions = [str(i) for i in self.exclusions]
-        if exclusions:
-            out.append('\n[ exclusions ]')
-            out.extend(exclusions)
+        if self.exclusions:
+            yield '\n[ exclusions ]'
+            for i in self.exclusions:
+                yield str(i)
 
         if self.multiscale:
-            out += ['\n;\n; Coarse grained to atomistic mapping\n;',
-                    '#define mapping virtual_sitesn',
-                    '[ mapping ]']
+            yield '\n;\n; Coarse grained to atomistic mapping\n;'
+            yield '#define mapping virtual_sitesn'
+            yield '[ mapping ]'
             for i,j in self.mapping:
-                out.append( ("%5d     2 "%i)+" ".join(["%5d"%k for k in j]) )
+                yield ("%5d     2 "%i)+" ".join(["%5d"%k for k in j])
             
             logging.info('Created virtual sites section for multiscaled topology')
-            return "\n".join(out)
+            return
 
         # Bonds in order: backbone, backbone-sidechain, sidechain, short elastic, long elastic        
-        out.append("\n[ bonds ]")       
-        for bondType,bondDesc in (
-                ("BB","Backbone bonds"),
-                ("SC","Sidechain bonds"),
-                ("Elastic short", "Short elastic bonds for extended regions"),
-                ("Elastic long", "Long elastic bonds for extended regions"),
-                ("Cystine","Cystine bridges"),
-                ("Link","Links")):
-            bonds = [ str(i) for i in self.bonds[bondType] if not i.parameters[1] == None ]
-            if bonds:
-                out.append("; "+bondDesc)
-                out.extend(bonds)
+        yield "\n[ bonds ]"
+        for bondType,bondDesc in self.bondCategories:
+            header = "; "+bondDesc
+            for i in self.bonds.select(bondType):
+                if not i.parameters[1] == None:
+                    if header:
+                        yield header
+                        header = None
+                    yield str(i)
 
         # Rubber Bands
-        bonds = [str(i) for i in self.bonds["Rubber",True]]
-        if bonds:
-            # Add a CPP style directive to allow control over the elastic network
-            out.append("#ifndef NO_RUBBER_BANDS")
-            # The GMX preprocessor keeps refusing to correctly parse equations or macros... TAW160730
-            # out.append("#ifndef RUBBER_FC\n#define RUBBER_FC %f\n#endif"%self.options['ElasticMaximumForce'])
-            out.extend(bonds)
-            out.append("#endif")
+        header = True
+        for i in self.bonds.select(("Rubber",True)):
+            if header:
+                # Add a CPP style directive to allow control over the elastic network
+                yield "#ifndef NO_RUBBER_BANDS"
+                # The GMX preprocessor keeps refusing to correctly parse equations or macros... TAW160730
+                # yield "#ifndef RUBBER_FC\n#define RUBBER_FC %f\n#endif"%self.options['ElasticMaximumForce']
+                header = False
+            yield str(i)
+        if not header:
+            yield "#endif"
 
         # Constraints
-        out.append("\n[ constraints ]")
-        out.extend([str(i) for i in self.bonds["Constraint"]])
-        for bondType,bondDesc in (
-                ("Cystine","Cystine bridges"),
-                ("Link","Links")):
-            bonds = [ str(i) for i in self.bonds[bondType] if i.parameters[1] == None ]
-            if bonds:
-                out.append("; "+bondDesc)
-                out.extend(bonds)
+        yield "\n[ constraints ]"
+        for i in self.bonds.select("Constraint"):
+            yield str(i)
+        for bondType,bondDesc in self.constraintCategories:
+            header = "; "+bondDesc
+            for i in self.bonds.select(bondType):
+                if i.parameters[1] == None:
+                    if header:
+                        yield header
+                        header = None
+                    yield str(i)
 
         # Angles
-        out.append("\n[ angles ]")
-        out.append("; Backbone angles")
-        out.extend([str(i) for i in self.angles["BBB"]])
-        out.append("; Backbone-sidechain angles")
-        out.extend([str(i) for i in self.angles["BBS"]])
-        out.append("; Sidechain angles")
-        out.extend([str(i) for i in self.angles["SC"]])
+        yield "\n[ angles ]"
+        for category,description in self.angleCategories:
+            yield "; "+description
+            for i in self.angles.select(category):
+                yield str(i)
 
         # Dihedrals
-        out.append("\n[ dihedrals ]")
-        out.append("; Backbone dihedrals")
-        out.extend([str(i) for i in self.dihedrals["BBBB"] if i.parameters])
-        out.append("; Sidechain improper dihedrals")
-        out.extend([str(i) for i in self.dihedrals["SC"] if i.parameters])
+        yield "\n[ dihedrals ]"
+        for category,description in self.dihedralCategories:
+            yield "; "+description
+            for i in self.dihedrals.select(category):
+                if i.parameters:
+                    yield str(i)
 
         # Postition Restraints
         if self.posres:
-            out.append("\n#ifdef POSRES")
-            out.append("#ifndef POSRES_FC\n#define POSRES_FC %.2f\n#endif"%self.options['PosResForce'])
-            out.append(" [ position_restraints ]")
-            out.extend(['  %5d    1    POSRES_FC    POSRES_FC    POSRES_FC'%i for i in self.posres])
-            out.append("#endif")
+            yield "\n#ifdef POSRES"
+            yield "#ifndef POSRES_FC\n#define POSRES_FC %.2f\n#endif"%self.options['PosResForce']
+            yield " [ position_restraints ]"
+            for i in self.posres:
+                yield '  %5d    1    POSRES_FC    POSRES_FC    POSRES_FC'%i
+            yield "#endif"
 
         logging.info('Created coarsegrained topology')
-        return "\n".join(out)
 
   
     # The sequence function can be used to generate the topology for 
     # a sequence :) either given as sequence or as chain
+    # Without a chain, the Calpha positions can be given, which are needed for
+    # force fields taking the backbone parameters from the structure.
+    # The side chain bonds, angles, dihedrals and virtual sites of a residue,
+    # as term tables with the atom numbers relative to the backbone bead.
+    # The templates are set up once per force field and residue name.
+    def sidechainTemplate(self,resname):
+        ff  = self.options['ForceField']
+        key = (ff,resname)
+        if key not in Topology.residueTemplates:
+            scatoms, bon_par, ang_par, dih_par, vsite_par = (ff.sidechains[resname]+5*[[]])[:5]
+            bon_con,ang_con,dih_con,vsite_con = (ff.connectivity[resname]+4*[[]])[:4]
+            bonds, angles, dihedrals, vsites = TermTable(), TermTable(), TermTable(), TermTable()
+            # Side Chain Bonds/Constraints
+            for atids,par in zip(bon_con,bon_par):
+                if par[1] == None:
+                    bonds.append(Bond(atoms=tuple(atids),parameters=[par[0]],type=1,comments=resname,category="Constraint"))
+                else:
+                    bonds.append(Bond(atoms=tuple(atids),parameters=par,type=1,comments=resname,category="SC"))
+            # Side Chain Angles
+            for atids,par in zip(ang_con,ang_par):
+                angles.append(Angle(atoms=tuple(atids),parameters=par,type=2,comments=resname,category="SC"))
+            # Side Chain Dihedrals
+            for atids,par in zip(dih_con,dih_par):
+                dihedrals.append(Dihedral(atoms=tuple(atids),parameters=par,type=2,comments=resname,category="SC"))
+            # Side Chain V-Sites
+            for atids,par in zip(vsite_con,vsite_par):
+                vsites.append(Vsite(atoms=tuple(atids),parameters=par,type=1,comments=resname,category="SC"))
+            Topology.residueTemplates[key] = (bonds,angles,dihedrals,vsites)
+        return Topology.residueTemplates[key]
+
+    # The atoms of a residue, as (type,name,charge[,mass]), given the type of
+    # the backbone bead. The atom number, residue number and name, charge 
+    # group and secondary structure are added for each residue.
+    def atomTemplate(self,resname,bbb):
+        ff  = self.options['ForceField']
+        key = (ff,resname,bbb,bool(self.multiscale))
+        if key not in Topology.residueTemplates:
+            scatoms  = (ff.sidechains[resname]+[[]])[0]
+            template = []
+            for counter,(atype,aname) in enumerate(zip([bbb]+list(scatoms),CoarseGrained.residue_bead_names)):
+                if self.multiscale:
+                    atype,aname = "v"+atype,"v"+aname
+                # If mass or charge diverse, we adopt it here. 
+                # We don't want to do this for BB beads because of charged termini.
+                if resname in ff.mass_charge.keys() and counter != 0:
+                    M,Q = ff.mass_charge[resname]
+                    aname = Q[counter-1]>0 and 'SCP' or Q[counter-1]<0 and 'SCN' or aname
+                    template.append((atype,aname,Q[counter-1],M[counter-1]))
+                else:
+                    template.append((atype,aname,ff.charges.get(atype,0)))
+            Topology.residueTemplates[key] = template
+        return Topology.residueTemplates[key]
+
     def fromAminoAcidSequence(self,sequence,secstruc=None,links=None,breaks=None,
-                              mapping=None,rubber=False,multi=False):
+                              mapping=None,rubber=False,multi=False,positions=None):
         # Shift for the atom numbers of the atomistic part in a chain 
         # that is being multiscaled
         shift = 0
@@ -4164,11 +5776,14 @@ class Topology:
         elif not secstruc:
             # If no secondary structure is provided, set all to coil
             chain         = None
+            self.sequence = list(sequence)
             self.secstruc = len(self.sequence)*"C"
         else:
             # If a secondary structure is provided, use that. chain is none.
             chain         = None
+            self.sequence = list(sequence)
             self.secstruc = secstruc
+        breaks = breaks or []
 
         logging.debug(self.secstruc)
         logging.debug(self.sequence)
@@ -4199,10 +5814,11 @@ class Topology:
         # The old method (line above) assumed no hydrogens: Ca would always be
         # the second atom of the residue. Now we look at the name.
         positionCa = []
-        for residue in chain.residues:
-            for atom in residue:
-                if atom[0] == "CA":
-                    positionCa.append(atom[4:])
+        if chain:
+            for residue in chain.residues:
+                positionCa.extend([residue[i][4:] for i in residue.indices("CA")])
+        else:
+            positionCa = positions or len(self.sequence)*[None]
 
         # Residue numbers for this moleculetype topology
         resid = range(startResi,startResi+len(self.sequence))     
@@ -4226,6 +5842,9 @@ class Topology:
                 bb[i]   = "Qd"
                 bb[i-1] = "Qa"
 
+        # The short elastic bonds added, to avoid listing a pair twice
+        elastic = set()
+
         # For backbone parameters, iterate over fragments, inferred from breaks
         for i,j in zip([0]+breaks,breaks+[-1]):
             # Extract the fragment
@@ -4249,10 +5868,11 @@ class Topology:
                     # Maybe do local elastic networks
                     if ss == ("E","E","E","E") and not self.options['ExtendedDihedrals']:
                         # This one may already be listed as the 2-4 bond of a previous one
-                        if not (id[0],id[2]) in self.bonds:
+                        if not (id[0],id[2]) in elastic:
                             self.bonds.append(Bond(options=self.options,atoms=(id[0],id[2]),parameters=self.options['ForceField'].ebonds['short'],type=1,
                                                    comments="%s(%s)-%s(%s) 1-3"%(rn[0],id[0],rn[2],id[2]),
                                                    category="Elastic short"))
+                        elastic.add((id[1],id[3]))
                         self.bonds.append(Bond(options=self.options,atoms=(id[1],id[3]),parameters=self.options['ForceField'].ebonds['short'],type=1,
                                                comments="%s(%s)-%s(%s) 2-4"%(rn[1],id[1],rn[3],id[3]),
                                                category="Elastic short"))
@@ -4287,45 +5907,16 @@ class Topology:
         #
         # AtomID AtomType ResidueID ResidueName AtomName ChargeGroup Charge ; Comments
         # 
-        atid  = startAtom
+        atid      = startAtom
+        templates = []
+        shifts    = []
         for resi,resname,bbb,sidechn,ss in zip(resid,self.sequence,bb,sc,self.secstruc):
-            scatoms, bon_par, ang_par, dih_par, vsite_par = sidechn
-
-            # Side chain bonded terms
-            # Collect bond, angle and dihedral connectivity
-            bon_con,ang_con,dih_con,vsite_con = (self.options['ForceField'].connectivity[resname]+4*[[]])[:4]
-
-            # Side Chain Bonds/Constraints
-            for atids,par in zip(bon_con,bon_par):
-                if par[1] == None:
-                    self.bonds.append(Bond(options=self.options,atoms=atids,parameters=[par[0]],type=1,
-                                           comments=resname,category="Constraint"))
-                else:
-                    self.bonds.append(Bond(options=self.options,atoms=atids,parameters=par,type=1,
-                                           comments=resname,category="SC"))
-                # Shift the atom numbers
-                self.bonds[-1] += atid
-
-            # Side Chain Angles
-            for atids,par in zip(ang_con,ang_par):
-                self.angles.append(Angle(options=self.options,atoms=atids,parameters=par,type=2,
-                                         comments=resname,category="SC"))
-                # Shift the atom numbers
-                self.angles[-1] += atid
-
-            # Side Chain Dihedrals
-            for atids,par in zip(dih_con,dih_par):
-                self.dihedrals.append(Dihedral(options=self.options,atoms=atids,parameters=par,type=2,
-                                               comments=resname,category="SC"))
-                # Shift the atom numbers
-                self.dihedrals[-1] += atid
+            scatoms = sidechn[0]
 
-            # Side Chain V-Sites
-            for atids,par in zip(vsite_con,vsite_par):
-                self.vsites.append(Vsite(options=self.options,atoms=atids,parameters=par,type=1,
-                                               comments=resname,category="SC"))
-                # Shift the atom numbers
-                self.vsites[-1] += atid
+            # Side chain bonded terms, from the template of the residue,
+            # which are added for all residues at once after the loop
+            templates.append(self.sidechainTemplate(resname))
+            shifts.append(atid)
             
             # Side Chain exclusions
             # The new polarizable forcefield give problems with the charges in the sidechain, if the backbone is also charged.
@@ -4336,17 +5927,9 @@ class Topology:
 
             # All residue atoms
             counter = 0  # Counts over beads
-            for atype,aname in zip([bbb]+list(scatoms),CoarseGrained.residue_bead_names):
-                if self.multiscale:
-                    atype,aname = "v"+atype,"v"+aname
-                # If mass or charge diverse, we adopt it here. 
-                # We don't want to do this for BB beads because of charged termini.
-                if resname in self.options['ForceField'].mass_charge.keys() and counter != 0:
-                    M,Q = self.options['ForceField'].mass_charge[resname]
-                    aname = Q[counter-1]>0 and 'SCP' or Q[counter-1]<0 and 'SCN' or aname
-                    self.atoms.append((atid,atype,resi,resname,aname,atid,Q[counter-1],M[counter-1],ss))
-                else:
-                    self.atoms.append((atid,atype,resi,resname,aname,atid,self.options['ForceField'].charges.get(atype,0),ss))
+            for atom in self.atomTemplate(resname,bbb):
+                aname = atom[1]
+                self.atoms.append((atid,atom[0],resi,resname,aname,atid)+atom[2:]+(ss,))
                 # Doing this here save going over all the atoms onesmore.
                 # Generate position restraints for all atoms or Backbone beads only.
                 if 'all' in self.options['PosRes']:
@@ -4358,6 +5941,10 @@ class Topology:
                 atid    += 1
                 counter += 1
 
+        # Side Chain Bonds/Constraints, Angles, Dihedrals and V-Sites
+        for k,table in enumerate((self.bonds,self.angles,self.dihedrals,self.vsites)):
+            table.tile([t[k] for t in templates],shifts)
+
         # The rubber bands are best applied outside of the chain class, as that gives
         # more control when chains need to be merged. The possibility to do it on the 
         # chain level is retained to allow building a complete chain topology in 
@@ -4368,7 +5955,7 @@ class Topology:
                 ElasticLowerBound,ElasticUpperBound,
                 ElasticDecayFactor,ElasticDecayPower,
                 ElasticMaximumForce,ElasticMinimumForce)
-            self.bonds.extend([Bond(i,options=self.options,type=6,category="Rubber band") for i in rubberList])
+            self.bonds.extend(Bond(i,options=self.options,type=6,category="Rubber band") for i in rubberList)
         
         # Note the equivalent of atomistic atoms that have been processed 
         if chain and self.multiscale:
@@ -4583,15 +6170,530 @@ class Topology:
                 del self.angles[i]
 
 
+    # Read a moleculetype topology as written by martinize. The parameters of
+    # the bonded terms are kept as text, so that they are written unchanged.
+    def fromItp(self,stream):
+        categories = {
+            "bonds":       dict([(j,i) for i,j in self.bondCategories]),
+            "constraints": dict([(j,i) for i,j in self.constraintCategories]),
+            "angles":      dict([(j,i) for i,j in self.angleCategories]),
+            "dihedrals":   dict([(j,i) for i,j in self.dihedralCategories])}
+        classes = {"bonds": Bond, "constraints": Bond, "angles": Angle, "dihedrals": Dihedral,
+                   "virtual_sites2": Vsite, "exclusions": Exclusion}
+        # Number of atoms listed for a term
+        counts  = {"bonds": 2, "constraints": 2, "angles": 3, "dihedrals": 4, "virtual_sites2": 3}
+        section, category, rubber = None, None, False
+        for line in stream:
+            line = line.rstrip("\n")
+            if line.startswith("; MARTINI (") and section is None:
+                name = line[11:line.index(")")]
+                if name != self.options['ForceField'].name:
+                    logging.error("The topology was made with the %s force field, not with %s."%(name,self.options['ForceField'].name))
+                    sys.exit(1)
+            if not line.strip():
+                continue
+            if line.strip().startswith("["):
+                section  = line.strip()[1:-1].strip()
+                category = {"constraints": "Constraint", "virtual_sites2": "SC"}.get(section)
+                if section == "mapping":
+                    logging.error("Multiscale topologies can not be read.")
+                    sys.exit(1)
+                if section == "moleculetype" and self.atoms:
+                    logging.error("The topology lists more than one moleculetype.")
+                    sys.exit(1)
+            elif line.startswith("#"):
+                if line.startswith("#ifndef NO_RUBBER_BANDS"):
+                    rubber = True
+                elif line.startswith("#endif"):
+                    rubber = False
+            elif line.startswith(";"):
+                category = categories.get(section,{}).get(line[1:].strip(),category)
+            elif section == "moleculetype":
+                self.name, nrexcl = line.split()
+                self.nrexcl = int(nrexcl)
+            elif section == "atoms":
+                fields, ss = line.split(" ; ",1)
+                fields = fields.split()
+                self.atoms.append(tuple([int(fields[0]),fields[1],int(fields[2]),fields[3],fields[4],int(fields[5])]+
+                                        [float(i) for i in fields[6:]]+[ss]))
+            elif section == "position_restraints":
+                self.posres.append(int(line.split()[0]))
+            elif section in classes:
+                text, comments = (line.split(" ; ",1)+[[]])[:2]
+                if section == "exclusions":
+                    atoms, bondType, parameters = text.split(), -1, (None,)
+                else:
+                    n          = counts[section]
+                    atoms      = text[:6*n-1].split()
+                    bondType   = int(text[6*n:6*n+7])
+                    parameters = text[6*n+8:]
+                    if section == "bonds":
+                        # Two parts, to tell bonds from constraints
+                        parameters = parameters.rsplit(" ",1)
+                    elif section == "constraints":
+                        parameters = [parameters,None]
+                    else:
+                        parameters = [parameters]
+                getattr(self,{"virtual_sites2": "vsites", "constraints": "bonds"}.get(section,section)).append(
+                    classes[section](options=self.options,atoms=tuple([int(i) for i in atoms]),type=bondType,
+                                     parameters=parameters,comments=comments,category=rubber and "Rubber band" or category))
+        # The sequence and secondary structure follow from the atoms
+        residues      = [atom for k,atom in enumerate(self.atoms) if k == 0 or atom[2] != self.atoms[k-1][2]]
+        self.sequence = [atom[3] for atom in residues]
+        self.secstruc = "".join([atom[-1] for atom in residues])
+
+    # Replace the amino acid at the given position (counting from 0) in a
+    # topology read with fromItp. Only the terms starting in the residue or
+    # in the three residues before it can change. These are taken from the 
+    # topology of a stretch of the sequence around the residue, which gives 
+    # enough context on both sides. The other terms are kept, with the atoms
+    # renumbered. Elastic bonds, cystine bridges and links to the residue
+    # are kept for the beads that have the same name in the new residue.
+    def mutate(self,position,resname):
+        i      = position
+        atoms  = list(self.atoms)
+        starts = [k for k,atom in enumerate(atoms) if k == 0 or atom[2] != atoms[k-1][2]]+[len(atoms)]
+        lo, hi = starts[i], starts[i+1]
+
+        # Up to four residues on either side, connected by backbone bonds
+        ws, we = i, i+1
+        while ws > max(0,i-4) and (starts[ws-1]+1,starts[ws]+1) in self.bonds:
+            ws -= 1
+        while we < min(len(starts)-1,i+4) and (starts[we-1]+1,starts[we]+1) in self.bonds:
+            we += 1
+
+        # A charged backbone bead means that the residue is a terminus or 
+        # is next to a break, and then it is also at the end of the stretch.
+        options = dict(self.options)
+        options['NeutralTermini']  = atoms[lo][1] not in ("Qd","Qa")
+        options['ChargesAtBreaks'] = False
+        sequence  = self.sequence[:i]+[resname]+self.sequence[i+1:]
+        # Placeholder positions for force fields taking the backbone parameters 
+        # from the structure. Those parameters are taken from the old terms.
+        structure = options['ForceField'].ElasticNetwork
+        positions = structure and [(4.0*k,0.0,0.0) for k in range(we-ws)] or None
+        # The atom and residue numbers continue from before the stretch
+        window = Topology(options=options)
+        window.natoms = starts[ws]
+        window.atoms.append((starts[ws],None,atoms[0][2]+ws-1))
+        window.fromAminoAcidSequence(sequence[ws:we],self.secstruc[ws:we],positions=positions)
+        del window.atoms[0]
+        new   = [atom for atom in window.atoms if atom[2] == atoms[lo][2]]
+        delta = len(new)-(hi-lo)
+        index = dict([(atom[4],atom[0]) for atom in new])
+
+        # New atom number, or None for a bead of the residue that is gone
+        def renumber(k):
+            if k <= lo:
+                return k
+            if k > hi:
+                return k+delta
+            return index.get(atoms[k-1][4])
+
+        for attrib in ("bonds","angles","dihedrals","vsites","exclusions"):
+            # Exclusions depend on the charges, which only change for the residue
+            first = attrib == "exclusions" and lo or starts[max(ws,i-3)]
+            # Backbone parameters from the structure are taken from the old terms
+            kept = {}
+            for term in structure and getattr(self,attrib) or []:
+                if term.category in ("BB","BBB") and first < term.atoms[0] <= hi:
+                    kept[(term.category,tuple([renumber(k) for k in term.atoms]))] = term.parameters
+            terms = {}
+            for term in getattr(window,attrib):
+                if first < term.atoms[0] <= hi+delta:
+                    term.parameters = kept.get((term.category,tuple(term.atoms)),term.parameters)
+                    terms.setdefault(term.category,[]).append(term)
+            table = TermTable()
+            for term in getattr(self,attrib):
+                if term.category in terms and term.atoms[0] > first:
+                    table.extend(terms.pop(term.category))
+                if term.category not in ("Rubber band","Cystine","Link") and first < term.atoms[0] <= hi:
+                    continue
+                moved = tuple([renumber(k) for k in term.atoms])
+                if None in moved:
+                    gone = [atoms[k-1][4] for k in term.atoms if renumber(k) is None]
+                    logging.warning("Removed %s term %s, as %s has no bead %s."%(
+                        term.category.lower(),"-".join([str(k) for k in term.atoms]),resname,gone[0]))
+                    continue
+                if term.category == "Rubber band":
+                    # These list the residue names
+                    for k in term.atoms:
+                        if lo < k <= hi:
+                            term.comments = term.comments.replace("%s%d%s("%(atoms[lo][3],atoms[lo][2],atoms[k-1][4]),
+                                                                  "%s%d%s("%(resname,atoms[lo][2],atoms[k-1][4]))
+                if moved != term.atoms:
+                    if term.category in ("Elastic short","Elastic long"):
+                        # These list the atom numbers
+                        term.comments = re.sub(r"\((\d+)\)",lambda m: "(%d)"%renumber(int(m.group(1))),term.comments)
+                    term.atoms = moved
+                table.append(term)
+            for category in terms:
+                table.extend(terms[category])
+            setattr(self,attrib,table)
+
+        self.posres   = CategorizedList(sorted([renumber(k) for k in self.posres if not lo < k <= hi]+
+                                               [k for k in window.posres if lo < k <= hi+delta]))
+        self.atoms    = CategorizedList(atoms[:lo]+new+[(a[0]+delta,)+a[1:5]+(a[5]+delta,)+a[6:] for a in atoms[hi:]])
+        self.sequence = sequence
+
     def fromMoleculeList(self,other):
         pass
 
+
+# On-disk cache of moleculetype topologies. Topologies are stored without
+# their header, in files named after a hash of everything that determines
+# the contents. When the total size exceeds the maximum (in MB), the least
+# recently used files are removed. Files are written under a temporary name
+# and renamed, so that several processes can share a cache directory.
+class TopologyCache:
+    def __init__(self,directory,maxsize=100):
+        self.directory = directory
+        self.maxsize   = maxsize*1024*1024
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                logging.error("Can not create topology cache directory %s."%directory)
+                sys.exit(1)
+
+    def key(self,*items):
+        return hashlib.sha1(repr(items)).hexdigest()
+
+    def path(self,key):
+        return os.path.join(self.directory,key+".itp")
+
+    # Open a cached topology, returning None if it is not in the cache
+    def fetch(self,key):
+        try:
+            cached = open(self.path(key))
+            # Mark the file as recently used
+            os.utime(self.path(key),None)
+        except (IOError,OSError):
+            return None
+        return cached
+
+    # Write the topology to the stream and store it in the cache
+    def store(self,key,topology,stream):
+        handle,temporary = tempfile.mkstemp(suffix=".tmp",dir=self.directory)
+        cached = os.fdopen(handle,"w")
+        lines  = topology.lines()
+        for line in lines:
+            stream.write(line)
+            break
+        for line in lines:
+            stream.write("\n")
+            stream.write(line)
+            cached.write("\n")
+            cached.write(line)
+        cached.close()
+        os.chmod(temporary,0644)
+        os.rename(temporary,self.path(key))
+        self.prune()
+
+    # Remove the least recently used topologies until the cache fits
+    def prune(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".itp"):
+                try:
+                    stat = os.stat(os.path.join(self.directory,name))
+                except OSError:
+                    # Removed by another process
+                    continue
+                files.append((stat.st_mtime,stat.st_size,name))
+        files.sort()
+        total = sum([i[1] for i in files])
+        while files and total > self.maxsize:
+            mtime,size,name = files.pop(0)
+            try:
+                os.remove(os.path.join(self.directory,name))
+            except OSError:
+                pass
+            total -= size
+
 #############
 ## 8 # MAIN #  -> @MAIN <-
 #############
-import sys,logging,random,math,os,re
+import sys,logging,random,math,numpy,os,re,hashlib,shutil,json,shlex,signal,socket,tempfile,time,traceback
+import cProfile,resource
+
+
+# Timing of the stages of a run, written with -profile. For each stage, the
+# wall time, the CPU time (including that of finished worker processes), 
+# the increase of the peak memory use of the process (kB) and counts of the
+# items processed are kept. A stage can be entered several times, e.g. once
+# per frame, adding up the times. While in a stage entered from another one,
+# the time and memory are not counted for the latter. If asked for, the 
+# function calls are profiled per stage as well, to be written as cProfile
+# statistics.
+class StageProfile:
+    def __init__(self,calls=False):
+        self.calls     = calls
+        self.stages    = []
+        self.totals    = {}
+        self.profilers = {}
+        self.counts    = {}
+        # Stages entered, with the wall and CPU time at the start
+        self.stack     = []
+        self.wall, self.cpu = self.clock()
+
+    def clock(self):
+        t = os.times()
+        return time.time(), t[0]+t[1]+t[2]+t[3]
+
+    # The peak memory use of the process, in kB (given in bytes on OS X)
+    def maxrss(self):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss//(sys.platform == "darwin" and 1024 or 1)
+
+    def _pause(self):
+        name, wall, cpu, rss = self.stack[-1]
+        now = self.clock()
+        self.totals[name]["wall"] += now[0]-wall
+        self.totals[name]["cpu"]  += now[1]-cpu
+        self.totals[name]["maxrss increase"] += self.maxrss()-rss
+        if self.calls:
+            self.profilers[name].disable()
+
+    def _resume(self):
+        self.stack[-1][1:] = self.clock()+(self.maxrss(),)
+        if self.calls:
+            self.profilers[self.stack[-1][0]].enable()
+
+    def enter(self,name):
+        if self.stack:
+            self._pause()
+        if not name in self.totals:
+            self.stages.append(name)
+            self.totals[name] = {"name": name, "wall": 0.0, "cpu": 0.0, "entries": 0, "maxrss increase": 0, "counts": {}}
+            self.profilers[name] = self.calls and cProfile.Profile()
+        self.totals[name]["entries"] += 1
+        self.stack.append([name,0,0,0])
+        self._resume()
+
+    def leave(self):
+        self._pause()
+        self.stack.pop()
+        if self.stack:
+            self._resume()
+
+    # Add to the count of items, for the current stage and the run
+    def count(self,item,n=1):
+        for counts in [self.counts]+[self.totals[entry[0]]["counts"] for entry in self.stack[-1:]]:
+            counts[item] = counts.get(item,0)+n
+
+    # Iterate over items, counting the time to get them for the stage
+    def iterate(self,name,items):
+        items = iter(items)
+        while True:
+            self.enter(name)
+            try:
+                item = items.next()
+            except StopIteration:
+                return
+            finally:
+                self.leave()
+            yield item
+
+    # Write the report as JSON, and the call statistics per stage to files
+    # named after the report, e.g. profile.read.prof for profile.json.
+    def write(self,filename):
+        wall, cpu = self.clock()
+        report = {"wall": wall-self.wall, "cpu": cpu-self.cpu, "counts": self.counts,
+                  "maxrss": self.maxrss(),
+                  "stages": [self.totals[name] for name in self.stages]}
+        out = open(filename,"w")
+        json.dump(report,out,indent=2,sort_keys=True)
+        out.close()
+        if self.calls:
+            for name in self.stages:
+                self.profilers[name].dump_stats("%s.%s.prof"%(os.path.splitext(filename)[0],name.replace(" ","_")))
+
+
+# Coarse grain a chain for writing the structure. Apart from the coarse
+# grained structure, the attributes of the chain that are changed in the
+# process are returned, so that they can be set on the chain again when 
+# this is run in a worker process.
+def chainCG(chain):
+    cg = chain.cg(com=True)
+    return cg, chain.residues, chain.mapping
+
+
+# Everything that determines the topology of a moleculetype, apart from
+# the header, to be hashed for the topology cache. Coordinates only matter
+# with an elastic network (which includes the Elnedyn bonded parameters).
+def topologyKey(mol,name,options,frames=None):
+    ids = set([chain.id for chain in mol])
+    key = [options['Version'],options['ForceField'].name,name,
+           bool(options['NeutralTermini']),bool(options['ChargesAtBreaks']),bool(options['ExtendedDihedrals']),
+           options['PosRes'],options['PosResForce'],bool(options['multi'])]
+    for chain in mol:
+        key.append((chain.type(),chain.sequence,chain.ss,chain.sstypes,chain.breaks,chain.links,chain.multiscale))
+        # Multiscaled topologies map onto the atoms
+        if chain.multiscale:
+            key.append(chain.atoms())
+    # Links pertaining to the chains in the moleculetype
+    key.append([link for link in options['linkListCG'] if link[0][3] in ids and link[1][3] in ids])
+    if options['ElasticNetwork']:
+        key.extend([options[i] for i in ('ElasticLowerBound','ElasticUpperBound','ElasticDecayFactor',
+                                         'ElasticDecayPower','ElasticMaximumForce','ElasticMinimumForce','ElasticBeads')])
+        key.append([atom for chain in mol for residue in chain.residues for atom in residue])
+        if frames is not None:
+            key.extend([options['ElasticDeviation'],options['ElasticTemperature'],hashlib.sha1(frames.tostring()).hexdigest()])
+    return key
+
+
+# Build the topology of a moleculetype, consisting of one or more chains,
+# including links and the elastic network, and write it to the ITP file
+# given, or to stdout. With a topology cache, a stored topology is used if
+# there is one. The coordinates of the beads over the frames can be given,
+# as an array (frames,beads,3), to set up the elastic network from the
+# ensemble. Returns the counts of beads and terms, for the profile.
+def moleculeTopology(mol,name,options,frames=None,filename=None):
+    profile = options['Profile']
+    cache = options["-cache"] and TopologyCache(options["-cache"].value,options["-cachesize"].value)
+    if cache:
+        key    = cache.key(*topologyKey(mol,name,options,frames))
+        cached = cache.fetch(key)
+        if cached:
+            logging.info("Topology for %s taken from cache (%s)."%(name,key))
+            profile.enter("writing")
+            destination = filename and open(filename,'w') or sys.stdout
+            destination.write(itpHeader(name,options,options['multi'] or True in [chain.multiscale for chain in mol]))
+            shutil.copyfileobj(cached,destination)
+            cached.close()
+            if destination != sys.stdout:
+                destination.close()
+            profile.leave()
+            return {"cached topologies": 1}
+
+    top = Topology(mol[0],options=options,name=name)
+    for m in mol[1:]:
+        top += Topology(m,options=options)
+
+    # Have to add the connections, like the connecting network
+    # Gather coordinates
+    mcg, coords, mci = zip(*[(j[:4],j[4:7],k) for k,m in enumerate(mol) for j in m.cg(force=True)])
+    mcg         = list(mcg)
+    # Index of the first bead matching a (name,resn,resi,chain) tuple
+    mcgIndex    = {}
+    for i,bead in enumerate(mcg):
+        mcgIndex.setdefault(bead,i)
+
+    # Run through the link list and add connections (links = cys bridges or hand specified links)
+    for atomA,atomB,bondlength,forceconst in options['linkListCG']:
+        if bondlength == -1 and forceconst == -1:
+            bondlength, forceconst = options['ForceField'].special[(atomA[:2],atomB[:2])]
+        # Check whether this link applies to this group
+        atomA = mcgIndex.get(atomA,False)
+        atomB = mcgIndex.get(atomB,False)
+        if atomA and atomB:
+            cat = (mcg[atomA][1] == "CYS" and mcg[atomB][1] == "CYS") and "Cystine" or "Link"
+            top.bonds.append(Bond((atomA+1,atomB+1),options=options,type=1,parameters=(bondlength,forceconst),category=cat))
+
+    # Elastic Network
+    # The elastic network is added after the topology is constructed, since that
+    # is where the correct atom list with numbering and the full set of 
+    # coordinates for the merged chains are available. 
+    rubberList = []
+    if options['ElasticNetwork']:
+        profile.enter("elastic network")
+        rubberType = options['ForceField'].EBondType
+        # The number of beads per chain is passed to treat copies of chains at once
+        beads      = [(i,j,k) for i,j,k in zip(top.atoms,coords,mci) if i[4] in options['ElasticBeads']]
+        sizes      = len(mol)*[0]
+        for i,j,k in beads:
+            sizes[k] += 1
+        if frames is not None:
+            frames = frames[:,[n for n,(i,j) in enumerate(zip(top.atoms,coords)) if i[4] in options['ElasticBeads']]]
+        rubberList = rubberBands(
+            [(i,j) for i,j,k in beads],
+            options['ElasticLowerBound'],options['ElasticUpperBound'],
+            options['ElasticDecayFactor'],options['ElasticDecayPower'],
+            options['ElasticMaximumForce'],options['ElasticMinimumForce'],sizes,
+            frames,options['ElasticDeviation'],options['ElasticTemperature'])
+        top.bonds.extend(Bond(i,options=options,type=rubberType,category="Rubber band") for i in rubberList)
+        profile.leave()
+
+    # Write out the MoleculeType topology
+    profile.enter("writing")
+    destination = filename and open(filename,'w') or sys.stdout
+    if cache:
+        cache.store(key,top,destination)
+    else:
+        top.write(destination)
+    if destination != sys.stdout:
+        destination.close()
+    profile.leave()
+
+    return {"beads": len(top.atoms), "bonds": len(top.bonds), "angles": len(top.angles),
+            "dihedrals": len(top.dihedrals), "rubber bands": len(rubberList)}
+
+
+# Derive the topology for a mutant from the topology of an earlier run, 
+# without reading a structure. The mutations are applied in turn and the
+# moleculetype and master topology are written as in a normal run.
+def reuseTopology(options):
+    if not os.path.isfile(options['-reuse'].value):
+        logging.error("Topology %s given with -reuse does not exist."%options['-reuse'].value)
+        sys.exit(1)
+    top = Topology(options=options)
+    top.fromItp(open(options['-reuse'].value))
+    # One letter codes to residue names, taking HIS for H
+    names = dict(zip(AA1,AA3)[::-1])
+    for mutation in options['mutations']:
+        match = re.match(r"^([A-Z])(\d+)([A-Z])$",mutation.upper())
+        if not match:
+            logging.error("Mutation %s should be given as residue, number and new residue, e.g. A123W."%mutation)
+            sys.exit(1)
+        old, resi, new = match.groups()
+        i = int(resi)-top.atoms[0][2]
+        if not 0 <= i < len(top.sequence) or AA321.get(top.sequence[i]) != old:
+            logging.error("Residue %s%s of mutation %s is not in the topology."%(old,resi,mutation))
+            sys.exit(1)
+        if not names.get(new) in options['ForceField'].sidechains:
+            logging.error("Residue %s of mutation %s is not defined in the %s force field."%(new,mutation,options['ForceField'].name))
+            sys.exit(1)
+        logging.info("Mutating %s%s to %s"%(top.sequence[i],resi,names[new]))
+        top.mutate(i,names[new])
+
+    name = options['-name'].value or top.name
+    top.name = name
+    destination = options["-o"] and open(name+".itp",'w') or sys.stdout
+    top.write(destination)
+    if destination != sys.stdout:
+        destination.close()
+    logging.info('Written 1 ITP file')
+
+    useRubber = options['ElasticNetwork'] and "#define RUBBER_BANDS" or ""
+    top = options["-o"] and open(options['-o'].value,'w') or sys.stdout
+    top.write(
+'''#include "martini.itp"
+    
+%s
+  
+#include "%s.itp"
+    
+[ system ]
+; name
+Martini system from %s
+    
+[ molecules ]
+; name        number
+%s \t 1''' % (useRubber, name, options['-reuse'].value, name))
+    logging.info('Written topology files')
+
 
 def main(options):
+    # Timing of the stages, written with -profile
+    profile = options['Profile'] = StageProfile(options['-cprofile'])
+
+    if options['-reuse']:
+        profile.enter("topology")
+        reuseTopology(options)
+        profile.leave()
+        finish(options)
+        return
+
     # Check whether to read from a gro/pdb file or from stdin
     # We use an iterator to wrap around the stream to allow
     # inferring the file type, without consuming lines already
@@ -4611,21 +6713,31 @@ def main(options):
 
     # Now iterate over the frames in the stream
     # This should become a StructureFile class with a nice .next method
+    # Only what is needed from the frames is kept, so that the memory use does
+    # not grow with the number of frames: the counts of secondary structure 
+    # types per residue, and the minimal distances of cysteine sulphurs that
+    # come within the cutoff.
     model     = 1
-    cgOutPDB  = None
-    ssTotal   = []
+    cgOut     = None
+    ssCounts  = SSCounts()
     cysteines = []
-    for title,atoms,box in frameIterator(inStream):
-    
+    cysContacts = {}
+    # Coarse grained coordinates of the chains per frame, for -eavg
+    ensemble  = []
+    for title,atoms,box in profile.iterate("read",frameIterator(inStream)):
+
+        profile.enter("chains")
+        profile.count("frames")
+        profile.count("atoms",len(atoms))
         if fileType == "PDB":
             # The PDB file can have chains, in which case we list and process them specifically
             # TER statements are also interpreted as chain separators
             # A chain may have breaks in which case the breaking residues are flagged
-            chains = [ Chain(options,[i for i in residues(chain)]) for chain in pdbChains(atoms) ]        
+            chains = [ Chain(options,residuelist) for residuelist in atoms.chains() ]
         else:
             # The GRO file does not define chains. Here breaks in the backbone are
             # interpreted as chain separators. 
-            residuelist = [residue for residue in residues(atoms)]
+            residuelist = atoms.residues()
             # The breaks are indices to residues
             broken = breaks(residuelist)
             # Reorder, such that each chain is specified with (i,j,k)
@@ -4693,9 +6805,12 @@ def main(options):
         # Get the total length of the sequence
         seqlength = sum([len(chain) for chain in chains])
         logging.info('Total size of the system: %s residues.'%seqlength)
+        profile.count("residues",seqlength)
+        profile.leave()
     
 
         ## SECONDARY STRUCTURE
+        profile.enter("secondary structure")
         ss = '' 
         if options['Collagen']:
             for chain in chains:
@@ -4732,7 +6847,9 @@ def main(options):
                 chain.set_ss(sstmp[:ln])
                 sstmp = ss[:ln]                         
         else:
-            if options["-dssp"]:
+            if options["-dssp"].value == "builtin":
+                method, executable = "builtin", None
+            elif options["-dssp"]:
                 method, executable = "dssp", options["-dssp"].value
             #elif options["-pymol"]:
             #    method, executable = "pymol", options["-pymol"].value
@@ -4740,65 +6857,110 @@ def main(options):
                 logging.warning("No secondary structure or determination method speficied. Protein chains will be set to 'COIL'.")
                 method, executable = None, None
         
-            for chain in chains:
-                ss += chain.dss(method, executable)
+            # The determination is done for all chains in parallel if requested
+            chainss = method and poolMap([(chain.dss,(method,executable)) for chain in chains],options["-j"].value) or len(chains)*[None]
+            for chain,chss in zip(chains,chainss):
+                ss += chain.dss(method, executable, chss)
         
             # Used to be: if method in ("dssp","pymol"): but pymol is not supported
-            if method in ["dssp"]:
+            if method in ["dssp","builtin"]:
                 logging.debug('%s determined secondary structure:\n'%method.upper()+ss)
         
-        # Collect the secondary structure classifications for different frames
-        ssTotal.append(ss)    
+        # Count the secondary structure classifications over the frames
+        ssCounts.add(ss)
+        profile.leave()
     
         # Write the coarse grained structure if requested
         if options["-x"].value:
+            profile.enter("mapping")
             logging.info("Writing coarse grained structure.")
-            if cgOutPDB == None:
-                cgOutPDB = open(options["-x"].value,"w")
-            cgOutPDB.write("MODEL %8d\n"%model)
-            cgOutPDB.write(title)
-            cgOutPDB.write(pdbBoxString(box))
-            atid = 1
+            if cgOut == None:
+                cgOut = StructureWriter(options["-x"].value)
+            # The chains can be coarse grained in parallel; the results are 
+            # set on the chains when writing.
+            cgs   = options["-j"].value > 1 and dict(zip(order,poolMap([(chainCG,(chains[i],)) for i in order],options["-j"].value))) or {}
+            beads = []
+            ter   = []
             for i in order:
                 ci = chains[i]
                 if ci.multiscale:
-                    for r in ci.residues:
-                        for name,resn,resi,chain,x,y,z in r:
-                            insc  = resi>>20
-                            resid = resi - (insc<<20)
-                            if resid > 1000000:
-                                insc += 1
-                                resid = resi - (insc<<20)
-                            cgOutPDB.write(pdbAtomLine%(atid,name,resn[:3],chain,resid,chr(insc),x,y,z,1,0))
-                            atid += 1
-                coarseGrained = ci.cg(com=True)
+                    beads.extend([tuple(atom[:7])+(0,) for r in ci.residues for atom in r])
+                if i in cgs:
+                    coarseGrained, ci.residues, ci.mapping = cgs[i]
+                    ci._cg = coarseGrained
+                else:
+                    coarseGrained = ci.cg(com=True)
                 if coarseGrained:
-                    for name,resn,resi,chain,x,y,z,ssid in coarseGrained:
-                        insc  = resi>>20
-                        resid = resi - (insc<<20)
-                        if resid > 1000000:
-                            insc += 1
-                            resid = resi - (insc<<20)
-                        if ci.multiscale:
-                            name = "v"+name
-                        cgOutPDB.write(pdbAtomLine%(atid,name,resn[:3],chain,resid,chr(insc),x,y,z,1,ssid))
-                        atid += 1 
-                    cgOutPDB.write("TER\n")          
+                    if ci.multiscale:
+                        coarseGrained = [("v"+bead[0],)+bead[1:] for bead in coarseGrained]
+                    beads.extend(coarseGrained)
+                    ter.append(len(beads)-1)
                 else:
                     logging.warning("No mapping for coarse graining chain %s (%s); chain is skipped."%(ci.id,ci.type()))
-            cgOutPDB.write("ENDMDL\n")
+            cgOut.write(title,box,beads,ter)
+            profile.leave()
+
+        # Keep the coarse grained coordinates for an elastic network over the frames
+        if options['ElasticNetwork'] and options['ElasticAverage']:
+            profile.enter("mapping")
+            frame = [numpy.array([bead[4:7] for bead in chain.cg(force=True)],dtype=float).reshape((-1,3)) for chain in chains]
+            if ensemble and [len(i) for i in frame] != [len(i) for i in ensemble[0]]:
+                logging.error("The coarse grained structure of frame %d differs from that of the first frame."%model)
+                sys.exit(1)
+            ensemble.append(frame)
+            profile.leave()
     
-        # Gather cysteine sulphur coordinates
-        cyslist = [cys["SG"] for chain in chains for cys in chain["CYS"]]
-        cysteines.append([cys for cys in cyslist if cys])
+        # Check the distances between cysteine sulphurs, keeping the minimal 
+        # distance over the frames for pairs within the cutoff
+        if options['CystineCheckBonds']:
+            profile.enter("cystines")
+            cyslist = [cys["SG"] for chain in chains for cys in chain["CYS"]]
+            cyslist = [cys for cys in cyslist if cys]
+            if model == 1:
+                cysteines = [i[:4] for i in cyslist]
+            elif len(cyslist) != len(cysteines):
+                logging.error("The number of cysteines in frame %d differs from that in the first frame."%model)
+                sys.exit(1)
+            if cyslist:
+                for i,j,d2 in zip(*[k.tolist() for k in contactPairs([[c[4:7] for c in cyslist]],options['CystineMaxDist2'])]):
+                    cysContacts[(i,j)] = min(d2,cysContacts.get((i,j),d2))
+            profile.leave()
     
         model += 1
+
+    if cgOut:
+        cgOut.close()
+
+    # Add the secondary structure counts of other runs
+    for filename in options['SSCounts']:
+        other = SSCounts()
+        other.read(open(filename))
+        if len(other) != len(ssCounts):
+            logging.warning("The secondary structure counts in %s are for %d residues, rather than %d."%(filename,len(other),len(ssCounts)))
+        ssCounts += other
+    if options["-sso"].value:
+        ssCounts.write(open(options["-sso"].value,"w"))
     
     
+    # Coarse grain the atomistic trajectory if requested.
+    # The mapping is set up from the (last) frame of the input structure.
+    if options["-traj"].value:
+        if not options["-xo"].value:
+            logging.error("No output file (-xo) given for coarse grained trajectory.")
+            sys.exit(1)
+        logging.info("Coarse graining trajectory %s."%options["-traj"].value)
+        profile.enter("trajectory")
+        mapping = TrajectoryMapping([chains[i] for i in order],atoms,options['ForceField'])
+        nframes = mapTrajectory(options["-traj"].value,options["-xo"].value,mapping)
+        profile.count("trajectory frames",nframes)
+        profile.leave()
+        logging.info("Written %d coarse grained frame%s to %s."%(nframes,nframes != 1 and "s" or "",options["-xo"].value))
+
     # Write the index file if requested.
     # Mainly of interest for multiscaling.
     # Could be improved by adding separte groups for BB, SC, etc.
     if options["-n"].value:
+        profile.enter("index")
         logging.info("Writing index file.")
         # Lists for All-atom, Virtual sites and Coarse Grain.
         NAA,NVZ,NCG = [],[],[]
@@ -4820,10 +6982,12 @@ def main(options):
         outNDX.write("\n[ VZ ]\n"+"\n".join([" ".join(NVZ[i:i+15]) for i in range(0,len(NVZ),15)]))
         outNDX.write("\n[ CG ]\n"+"\n".join([" ".join(NCG[i:i+15]) for i in range(0,len(NCG),15)]))
         outNDX.close()
+        profile.leave()
 
     
     # Write the index file for mapping AA trajectory if requested
     if options["-nmap"].value:
+        profile.enter("index")
         logging.info("Writing trajectory index file.")
         atid = 1
         outNDX   = open(options["-nmap"].value,"w")
@@ -4842,7 +7006,7 @@ def main(options):
             # This gives out a list of atoms in residue, each tuple has other 
             # stuff in it that's needed elsewhere so we just take the last 
             # element which is the atom index (in that residue)
-            for j_count, j in enumerate(mapIndex(i)):
+            for j_count, j in enumerate(mapIndex(i,ca2bb=options['ForceField'].ca2bb)):
                 outNDX.write('[ Bead %i of residue %i ]\n'%(j_count+1,i_count+1))
                 line = ''
                 for k in j:
@@ -4855,31 +7019,15 @@ def main(options):
                 nra += len(j)
                 outNDX.write(line)
             atid += nra
+        profile.leave()
 
     
     # Evertything below here we only need, if we need to write a Topology
     if options['-o']:
+        profile.enter("topology")
 
         # Collect the secondary structure stuff and decide what to do with it
-        # First rearrange by the residue
-        ssTotal = zip(*ssTotal)
-        ssAver  = []
-        for i in ssTotal:
-            si = list(set(i))
-            if len(si) == 1:
-                # Only one type -- consensus
-                ssAver.append(si[0])
-            else:
-                # Transitions between secondary structure types
-                i = list(i)
-                si = [(1.0*i.count(j)/len(i),j) for j in si]
-                si.sort()
-                if si[-1][0] > options["-ssc"].value:
-                    ssAver.append(si[-1][1])
-                else:
-                    ssAver.append(" ")
-        
-        ssAver = "".join(ssAver)
+        ssAver = ssCounts.consensus(options["-ssc"].value)
         logging.info('(Average) Secondary structure has been determined (see head of .itp-file).')
         
 
@@ -4905,28 +7053,21 @@ def main(options):
         # case the coarse grained structure will not match with the topology...
         
         ## CYSTINE BRIDGES ##
-        # Extract the cysteine coordinates (for all frames) and the cysteine identifiers
+        # The cysteine pairs with the minimal sulphur (SG) distances over the 
+        # frames were gathered while reading the frames
         if options['CystineCheckBonds']:
             logging.info("Checking for cystine bridges, based on sulphur (SG) atoms lying closer than %.4f nm"%math.sqrt(options['CystineMaxDist2']/100))
         
-            cyscoord  = zip(*[[j[4:7] for j in i] for i in cysteines])
-            cysteines = [i[:4] for i in cysteines[0]]
-        
             bl, kb    = options['ForceField'].special[(("SC1","CYS"),("SC1","CYS"))]
         
-            # Check the distances and add the cysteines to the link list if the 
-            # SG atoms have a distance smaller than the cutoff.
-            rlc = range(len(cysteines))
-            for i in rlc[:-1]:
-                for j in rlc[i+1:]:
-                    # Checking the minimum distance over all frames
-                    # But we could also take the maximum, or the mean
-                    d2 = min([distance2(a,b) for a,b in zip(cyscoord[i],cyscoord[j])])
-                    if d2 <= options['CystineMaxDist2']:
-                        a, b = cysteines[i], cysteines[j]
-                        options['linkListCG'].append((("SC1","CYS",a[2],a[3]),("SC1","CYS",b[2],b[3]),bl,kb))
-                        a,b = (a[0],a[1],a[2]-(32<<20),a[3]),(b[0],b[1],b[2]-(32<<20),b[3])
-                        logging.info("Detected SS bridge between %s and %s (%f nm)"%(a,b,math.sqrt(d2)/10))
+            # Add the cysteines to the link list if the SG atoms have a distance 
+            # smaller than the cutoff. Checking the minimum distance over all frames
+            # But we could also take the maximum, or the mean
+            for (i,j),d2 in sorted(cysContacts.items()):
+                a, b = cysteines[i], cysteines[j]
+                options['linkListCG'].append((("SC1","CYS",a[2],a[3]),("SC1","CYS",b[2],b[3]),bl,kb))
+                a,b = (a[0],a[1],a[2]-(32<<20),a[3]),(b[0],b[1],b[2]-(32<<20),b[3])
+                logging.info("Detected SS bridge between %s and %s (%f nm)"%(a,b,math.sqrt(d2)/10))
         
         
         ## REAL ITP STUFF ##
@@ -4947,70 +7088,70 @@ def main(options):
         # options["-o"], with an added extension ".top" if not given.
         
         # XXX *NOTE*: This should probably be gathered in a 'Universe' class
-        itp = 0
+        # First the unique moleculetypes are listed, after which their 
+        # topologies are built, in parallel if requested.
+        # Moleculetypes are registered by the signatures of their chains, so
+        # that identical molecules are found with a single lookup. With 
+        # separate topologies, every molecule gets a moleculetype.
+        build = []
         moleculeTypes = {}
+        names = []
         for mi in range(len(molecules)):
             mol = molecules[mi]
+            if options['SeparateTop']:
+                signature = mi
+            else:
+                signature = tuple([chain.signature() for chain in mol])
             # Check if the moleculetype is already listed
-            # If not, generate the topology from the chain definition
-            if not mol in moleculeTypes or options['SeparateTop']:
+            # If not, the topology is generated from the chain definition
+            if not signature in moleculeTypes:
                 # Name of the moleculetype
                 # XXX: The naming should be changed; now it becomes Protein_X+Protein_Y+...
                 name = "+".join([chain.getname(options['-name'].value) for chain in mol])
-                moleculeTypes[mol] = name
-    
-                # Write the molecule type topology
-                top = Topology(mol[0],options=options,name=name)
-                for m in mol[1:]:
-                    top += Topology(m,options=options)
-    
-                # Have to add the connections, like the connecting network
-                # Gather coordinates
-                mcg, coords = zip(*[(j[:4],j[4:7]) for m in mol for j in m.cg(force=True)])
-                mcg         = list(mcg)
-        
-                # Run through the link list and add connections (links = cys bridges or hand specified links)
-                for atomA,atomB,bondlength,forceconst in options['linkListCG']:
-                    if bondlength == -1 and forceconst == -1:
-                        bondlength, forceconst = options['ForceField'].special[(atomA[:2],atomB[:2])]
-                    # Check whether this link applies to this group
-                    atomA = atomA in mcg and mcg.index(atomA)
-                    atomB = atomB in mcg and mcg.index(atomB)
-                    if atomA and atomB:
-                        cat = (mcg[atomA][1] == "CYS" and mcg[atomB][1] == "CYS") and "Cystine" or "Link"
-                        top.bonds.append(Bond((atomA+1,atomB+1),options=options,type=1,parameters=(bondlength,forceconst),category=cat))
-        
-                # Elastic Network
-                # The elastic network is added after the topology is constructed, since that
-                # is where the correct atom list with numbering and the full set of 
-                # coordinates for the merged chains are available. 
-                if options['ElasticNetwork']:
-                    rubberType = options['ForceField'].EBondType
-                    rubberList = rubberBands(
-                        [(i,j) for i,j in zip(top.atoms,coords) if i[4] in options['ElasticBeads']],
-                        options['ElasticLowerBound'],options['ElasticUpperBound'],
-                        options['ElasticDecayFactor'],options['ElasticDecayPower'],
-                        options['ElasticMaximumForce'],options['ElasticMinimumForce'])
-                    top.bonds.extend([Bond(i,options=options,type=rubberType,category="Rubber band") for i in rubberList])
-    
-                # Write out the MoleculeType topology
-                destination = options["-o"] and open(moleculeTypes[mol]+".itp",'w') or sys.stdout
-                destination.write(str(top))        
-        
-                itp += 1
-        
-            # Check whether other chains are equal to this one 
-            # Skip this step if we are to write all chains to separate moleculetypes
-            if not options['SeparateTop']:
-                for j in range(mi+1,len(molecules)):
-                    if not molecules[j] in moleculeTypes and mol == molecules[j]:
-                        # Molecule j is equal to a molecule mi
-                        # Set the name of the moleculetype to the one of that molecule
-                        moleculeTypes[molecules[j]] = moleculeTypes[mol]
+                moleculeTypes[signature] = name
+                # The coordinates of the beads over the frames
+                frames = None
+                if ensemble:
+                    frames = numpy.array([numpy.concatenate([frame[i] for i in merge[mi]]) for frame in ensemble])
+                build.append((mol,name,frames))
+            names.append(moleculeTypes[signature])
+
+        # Moleculetypes may have the same name, in which case the last one
+        # is kept. In parallel, each topology is written to a temporary file,
+        # which is put in place in the order of the moleculetypes.
+        parallel = options["-j"].value > 1 and len(build) > 1
+        if parallel:
+            itps = []
+            for mol,name,frames in build:
+                handle,temporary = tempfile.mkstemp(prefix=name+".",suffix=".tmp",dir=".")
+                os.close(handle)
+                itps.append(temporary)
+        else:
+            itps = [options["-o"] and name+".itp" or None for mol,name,frames in build]
+        try:
+            for counts in poolMap([(moleculeTopology,(mol,name,options,frames,itp)) for (mol,name,frames),itp in zip(build,itps)],options["-j"].value):
+                for item,n in counts.items():
+                    profile.count(item,n)
+            if parallel:
+                profile.enter("writing")
+                for (mol,name,frames),itp in zip(build,itps):
+                    if options["-o"]:
+                        os.rename(itp,name+".itp")
+                    else:
+                        shutil.copyfileobj(open(itp),sys.stdout)
+                        os.remove(itp)
+                profile.leave()
+        finally:
+            if parallel:
+                for itp in itps:
+                    if os.path.exists(itp):
+                        os.remove(itp)
+        itp = len(build)
         
         logging.info('Written %d ITP file%s'%(itp,itp>1 and "s" or ""))
                 
         # WRITING THE MASTER TOPOLOGY
+        profile.enter("writing")
         # Output stream
         top  = options["-o"] and open(options['-o'].value,'w') or sys.stdout
         
@@ -5020,11 +7161,18 @@ def main(options):
         # Molecule listing
         logging.info("Output contains %d molecules:"%len(molecules))
         n = 1
-        for molecule in molecules:
-            chainInfo = (n, moleculeTypes[molecule], len(molecule)>1 and "s" or " ", " ".join([i.id for i in molecule]))
+        for molecule,name in zip(molecules,names):
+            chainInfo = (n, name, len(molecule)>1 and "s" or " ", " ".join([i.id for i in molecule]))
             logging.info("  %2d->  %s (chain%s %s)"%chainInfo)
             n += 1
-        molecules   = '\n'.join(['%s \t 1'%moleculeTypes[molecule] for molecule in molecules])
+        # Consecutive molecules of the same type are listed with their number
+        counts = []
+        for name in names:
+            if counts and counts[-1][0] == name:
+                counts[-1][1] += 1
+            else:
+                counts.append([name,1])
+        molecules   = '\n'.join(['%s \t %d'%(name,count) for name,count in counts])
         
         # Set a define if we are to use rubber bands
         useRubber   = options['ElasticNetwork'] and "#define RUBBER_BANDS" or ""
@@ -5045,9 +7193,19 @@ Martini system from %s
 [ molecules ]
 ; name        number
 %s''' % (useRubber, itps, options["-f"] and options["-f"].value or "stdin", molecules))
+        profile.leave()
     
         logging.info('Written topology files')
-    
+        profile.leave()
+
+    finish(options)
+
+
+def finish(options):
+    if options['-profile']:
+        options['Profile'].write(options['-profile'].value)
+        logging.info('Written profile to %s'%options['-profile'].value)
+
     # Maybe there are forcefield specific log messages?
     options['ForceField'].messages()
 
@@ -5055,6 +7213,272 @@ Martini system from %s
     print "\n\tThere you are. One MARTINI. Shaken, not stirred.\n"
     Q = martiniq.pop(random.randint(0,len(martiniq)-1))
     print "\n", Q[1], "\n%80s"%("--"+Q[0]), "\n"
+
+
+# Run martinize with the options given, in this process, which is forked
+# for the job. The output is written to the files given and logging is set
+# up again, to write to the new stderr with the level asked for by the job.
+# Returns the exit status.
+def runJob(args,stdout,stderr):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(os.open(os.devnull,os.O_RDONLY),0)
+    os.dup2(stdout.fileno(),1)
+    os.dup2(stderr.fileno(),2)
+    logging.root.handlers = []
+    try:
+        main(option_parser(args,options,lists,version))
+        status = 0
+    except SystemExit, e:
+        # sys.exit() may be given nothing, a number or a message
+        if e.code is None or type(e.code) == int:
+            status = e.code or 0
+        else:
+            status = 1
+    except:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return status
+
+
+# Set up the force fields before forking jobs, so that the jobs share them
+def loadForceFields():
+    for ff in forcefields:
+        forceField(ff)
+
+
+# Run a single job for the server, in a process forked from it. The request
+# is read from the connection, and the exit status and output are sent back.
+def serveJob(connection):
+    stream = connection.makefile("rw")
+    try:
+        request = json.loads(stream.readline())
+        args    = [str(i) for i in request["args"]]
+        os.chdir(request.get("cwd") or ".")
+        if not "-f" in args and not ("-h" in args or "--help" in args):
+            raise ValueError("an input file (-f) is required")
+    except (ValueError,KeyError,TypeError,OSError), e:
+        stream.write(json.dumps({"status": 1, "stdout": "", "stderr": "Invalid request: %s\n"%e})+"\n")
+        stream.close()
+        return
+
+    # The output of the job is gathered in temporary files
+    output = [tempfile.TemporaryFile(),tempfile.TemporaryFile()]
+    reply  = {"status": runJob(args,output[0],output[1])}
+    for name,f in zip(("stdout","stderr"),output):
+        f.seek(0)
+        reply[name] = f.read().decode("utf-8","replace")
+    stream.write(json.dumps(reply)+"\n")
+    stream.close()
+
+
+# Clean up the jobs that have finished, without waiting
+def reapJobs(running):
+    while running:
+        pid = os.waitpid(-1,os.WNOHANG)[0]
+        if not pid:
+            break
+        running.discard(pid)
+
+
+# Serve jobs on a Unix domain socket, forking a process for each job, with
+# at most nproc jobs running at once. The forked processes start from the
+# loaded program, with the force field modules imported, and changes made
+# by a job do not carry over to the server or other jobs.
+def serve(address,nproc=1):
+    logging.basicConfig(format='%(levelname)-7s    %(message)s',level=logging.INFO)
+    loadForceFields()
+
+    server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    if os.path.exists(address):
+        try:
+            server.connect(address)
+        except socket.error:
+            # A stale socket from an earlier server
+            os.remove(address)
+        else:
+            logging.error("Socket %s is in use by another server."%address)
+            sys.exit(1)
+        server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    server.bind(address)
+    server.listen(max(nproc,16))
+    logging.info("Serving martinize on %s with %d process%s."%(address,nproc,nproc > 1 and "es" or ""))
+
+    # Stop cleanly on a termination signal, removing the socket
+    signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+    # Finished jobs are cleaned up while waiting for a connection, so that
+    # they do not linger as zombies when the server is idle.
+    server.settimeout(1)
+    running = set()
+    try:
+        while True:
+            reapJobs(running)
+            try:
+                connection = server.accept()[0]
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            # Wait for a free slot
+            while len(running) >= nproc:
+                running.discard(os.wait()[0])
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM,signal.SIG_DFL)
+                server.close()
+                try:
+                    serveJob(connection)
+                finally:
+                    os._exit(0)
+            connection.close()
+            running.add(pid)
+    except (KeyboardInterrupt,SystemExit):
+        logging.info("Stopping server.")
+    finally:
+        server.close()
+        os.remove(address)
+
+
+# Read a batch manifest. Each line has an input structure, an output prefix
+# and, optionally, options for the job, separated by tabs. Empty lines and
+# lines starting with '#' are skipped.
+def readManifest(filename):
+    jobs = []
+    for n,line in enumerate(open(filename)):
+        if not line.strip() or line.startswith("#"):
+            continue
+        fields = [i.strip() for i in line.split("\t")]
+        if len(fields) < 2 or not fields[0] or not fields[1]:
+            logging.error("Line %d of batch manifest %s does not list an input and an output prefix."%(n+1,filename))
+            sys.exit(1)
+        jobs.append((fields[0],fields[1],shlex.split(" ".join(fields[2:]))))
+    return jobs
+
+
+# Batch jobs run in the directory of their output prefix. Input files
+# given with the options are therefore made absolute, and output files are
+# named after the job, e.g. prefix.cg.pdb for -x cg.pdb, so that jobs with
+# the same directory do not overwrite each other's files. The secondary
+# structure and the DSSP executable are only taken as files if they exist.
+batchInputs  = ("-f","-traj","-ssi","-reuse","-cache")
+batchFiles   = ("-ss","-dssp")
+batchOutputs = ("-x","-xo","-n","-nmap","-sso","-profile")
+
+def batchArgs(args,base):
+    numbers = dict([(i[0],i[1].num) for i in options if type(i) != str])
+    args    = list(args)
+    result  = []
+    while args:
+        ar = args.pop(0)
+        result.append(ar)
+        for value in [args.pop(0) for i in range(numbers.get(ar,0)) if args]:
+            if ar in batchInputs or (ar in batchFiles and os.path.exists(value)):
+                value = os.path.abspath(value)
+            elif ar in batchOutputs:
+                head, tail = os.path.split(value)
+                value = os.path.join(head and os.path.abspath(head),base+"."+tail)
+            result.append(value)
+    return result
+
+
+# A batch job is complete if its topology lists the molecules and
+# the topologies it includes and the other output files are present.
+def batchComplete(prefix,args=[]):
+    top = prefix+".top"
+    if not os.path.isfile(top):
+        return False
+    directory = os.path.dirname(top)
+    for i,ar in enumerate(args[:-1]):
+        if ar in batchOutputs and (ar != "-xo" or "-traj" in args):
+            if not os.path.isfile(os.path.join(directory,args[i+1])):
+                return False
+    text = open(top).read()
+    if not "[ molecules ]" in text:
+        return False
+    for itp in re.findall(r'#include "(.*)"',text):
+        if itp != "martini.itp" and not os.path.isfile(os.path.join(os.path.dirname(top),itp)):
+            return False
+    return True
+
+
+# Wait for a batch job to finish and write its status
+def batchWait(running,statusLog,counts):
+    pid, code = os.wait()
+    infile, prefix, start = running.pop(pid)
+    if os.WIFEXITED(code):
+        code = os.WEXITSTATUS(code)
+    else:
+        code = -os.WTERMSIG(code)
+    state = code == 0 and "done" or "failed"
+    counts[state] += 1
+    statusLog.write(json.dumps({"input": infile, "prefix": prefix, "status": state, "exit": code, "time": round(time.time()-start,3)})+"\n")
+    statusLog.flush()
+    if code:
+        logging.warning("Job %s failed (exit status %d), see %s.log"%(prefix,code,prefix))
+    else:
+        logging.info("Job %s done."%prefix)
+
+
+# Process the structures listed in a manifest, with at most nproc jobs at
+# once. Each job is run in a process forked from this one, in the directory
+# of its output prefix. The options are the common ones, the name of the 
+# prefix for the moleculetypes (-name), the input (-f), the topology 
+# (-o prefix.top) and the options from the manifest. The output of a job is 
+# written to prefix.log and its status as a line of JSON to manifest.status.
+# Jobs that completed in an earlier run of the manifest are skipped.
+def batch(manifest,nproc=1,common=[]):
+    logging.basicConfig(format='%(levelname)-7s    %(message)s',level=logging.INFO)
+    jobs = readManifest(manifest)
+
+    # Jobs done before, according to the status log
+    done = set()
+    if os.path.exists(manifest+".status"):
+        for line in open(manifest+".status"):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Incomplete line from an interrupted run
+                continue
+            if entry.get("status") in ("done","skipped"):
+                done.add(entry.get("prefix"))
+    statusLog = open(manifest+".status","a")
+
+    loadForceFields()
+    logging.info("Processing %d structure%s from %s with %d process%s."%(len(jobs),len(jobs) != 1 and "s" or "",manifest,nproc,nproc > 1 and "es" or ""))
+
+    counts  = {"done": 0, "failed": 0, "skipped": 0}
+    running = {}
+    for infile,prefix,extra in jobs:
+        directory, base = os.path.split(os.path.abspath(prefix))
+        args = batchArgs(["-name",base]+common+["-f",infile,"-o",base+".top"]+extra,base)
+        if prefix in done and batchComplete(prefix,args):
+            counts["skipped"] += 1
+            statusLog.write(json.dumps({"input": infile, "prefix": prefix, "status": "skipped"})+"\n")
+            continue
+        while len(running) >= nproc:
+            batchWait(running,statusLog,counts)
+        statusLog.flush()
+        pid  = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                os.chdir(directory)
+                log    = open(base+".log","w")
+                status = runJob(args,log,log)
+            finally:
+                os._exit(status)
+        running[pid] = (infile,prefix,time.time())
+    while running:
+        batchWait(running,statusLog,counts)
+    statusLog.close()
+
+    logging.info("Batch finished: %(done)d done, %(failed)d failed, %(skipped)d skipped."%counts)
+    return counts["failed"] and 1 or 0
+
+
 if __name__ == '__main__':
     import sys,logging
     args = sys.argv[1:]
@@ -5062,6 +7486,22 @@ if __name__ == '__main__':
     if '-cat' in args:
         cat('martinize-'+version+'.py')
         sys.exit()
+    # Run as a server, handling jobs sent over a socket
+    if '--serve' in args:
+        nproc = '-j' in args and int(args[args.index('-j')+1]) or 1
+        serve(args[args.index('--serve')+1],nproc)
+        sys.exit()
+    # Process a manifest of structures, passing the other options to each job
+    if '-batch' in args:
+        i        = args.index('-batch')
+        manifest = args[i+1]
+        args     = args[:i]+args[i+2:]
+        nproc    = 1
+        if '-j' in args:
+            i     = args.index('-j')
+            nproc = int(args[i+1])
+            args  = args[:i]+args[i+2:]
+        sys.exit(batch(manifest,nproc,args))
     # Get the possible commandline arguments arguments and help text. 
     options,lists = options,lists
     # Parse commandline options.
@@ -0,0 +1,181 @@
+"""Helpers for the tests of martinize.py.
+
+martinize.py is a python 2 program. The tests run it, and snippets of
+code using it as a module, with python 2, taken from $PYTHON2 when the
+tests are run with python 3.
+"""
+
+import os,sys,json,shutil,subprocess,tempfile,unittest
+
+here      = os.path.dirname(os.path.abspath(__file__))
+martinize = os.path.abspath(os.path.join(here,os.pardir,"martinize.py"))
+python    = sys.version_info[0] == 2 and sys.executable or os.environ.get("PYTHON2","python2")
+
+# Residues 1-10 of chain A of 1HVR, with the polar hydrogens
+fragment = """\
+ATOM      1  N   PRO A   1     -12.735  38.918  31.287
+ATOM      2  CA  PRO A   1     -12.709  39.097  29.830
+ATOM      3  C   PRO A   1     -13.575  38.051  29.162
+ATOM      4  O   PRO A   1     -14.097  37.126  29.753
+ATOM      5  CB  PRO A   1     -11.243  39.010  29.398
+ATOM      6  CG  PRO A   1     -10.636  38.128  30.469
+ATOM      7  CD  PRO A   1     -11.368  38.593  31.729
+ATOM      8  H2  PRO A   1     -13.142  39.756  31.758
+ATOM      9  H3  PRO A   1     -13.429  38.158  31.502
+ATOM     10  N   GLN A   2     -13.682  38.255  27.876
+ATOM     11  CA  GLN A   2     -14.320  37.303  26.995
+ATOM     12  C   GLN A   2     -13.161  36.667  26.252
+ATOM     13  O   GLN A   2     -12.199  37.328  25.864
+ATOM     14  CB  GLN A   2     -15.221  38.120  26.074
+ATOM     15  CG  GLN A   2     -16.190  37.395  25.158
+ATOM     16  CD  GLN A   2     -16.623  38.390  24.092
+ATOM     17  OE1 GLN A   2     -16.247  38.312  22.930
+ATOM     18  NE2 GLN A   2     -17.374  39.400  24.512
+ATOM     19  H   GLN A   2     -13.185  38.995  27.427
+ATOM     20 HE21 GLN A   2     -17.652  40.125  23.878
+ATOM     21 HE22 GLN A   2     -17.694  39.448  25.458
+ATOM     22  N   VAL A   3     -13.253  35.366  26.117
+ATOM     23  CA  VAL A   3     -12.269  34.588  25.374
+ATOM     24  C   VAL A   3     -13.029  33.962  24.196
+ATOM     25  O   VAL A   3     -14.003  33.234  24.394
+ATOM     26  CB  VAL A   3     -11.730  33.474  26.320
+ATOM     27  CG1 VAL A   3     -10.597  32.691  25.660
+ATOM     28  CG2 VAL A   3     -11.293  33.952  27.723
+ATOM     29  H   VAL A   3     -14.058  34.893  26.477
+ATOM     30  N   THR A   4     -12.612  34.301  22.976
+ATOM     31  CA  THR A   4     -13.127  33.558  21.845
+ATOM     32  C   THR A   4     -12.159  32.418  21.669
+ATOM     33  O   THR A   4     -11.038  32.479  22.141
+ATOM     34  CB  THR A   4     -13.237  34.425  20.555
+ATOM     35  OG1 THR A   4     -11.953  34.894  20.130
+ATOM     36  CG2 THR A   4     -14.202  35.617  20.673
+ATOM     37  H   THR A   4     -11.801  34.863  22.831
+ATOM     38  HG1 THR A   4     -12.071  35.428  19.325
+ATOM     39  N   LEU A   5     -12.618  31.395  21.004
+ATOM     40  CA  LEU A   5     -11.920  30.110  21.049
+ATOM     41  C   LEU A   5     -11.199  29.773  19.773
+ATOM     42  O   LEU A   5     -11.099  28.619  19.382
+ATOM     43  CB  LEU A   5     -12.954  29.000  21.285
+ATOM     44  CG  LEU A   5     -13.442  28.734  22.702
+ATOM     45  CD1 LEU A   5     -12.580  29.280  23.843
+ATOM     46  CD2 LEU A   5     -14.901  29.033  22.745
+ATOM     47  H   LEU A   5     -13.486  31.467  20.508
+ATOM     48  N   TRP A   6     -10.681  30.790  19.105
+ATOM     49  CA  TRP A   6      -9.891  30.544  17.902
+ATOM     50  C   TRP A   6      -8.489  30.171  18.246
+ATOM     51  O   TRP A   6      -7.745  29.659  17.420
+ATOM     52  CB  TRP A   6      -9.698  31.798  17.052
+ATOM     53  CG  TRP A   6     -11.048  32.302  16.696
+ATOM     54  CD1 TRP A   6     -11.858  33.131  17.471
+ATOM     55  CD2 TRP A   6     -11.804  31.923  15.616
+ATOM     56  NE1 TRP A   6     -13.092  33.287  16.966
+ATOM     57  CE2 TRP A   6     -13.130  32.566  15.812
+ATOM     58  CE3 TRP A   6     -11.538  31.151  14.478
+ATOM     59  CZ2 TRP A   6     -14.130  32.381  14.829
+ATOM     60  CZ3 TRP A   6     -12.567  31.005  13.511
+ATOM     61  CH2 TRP A   6     -13.839  31.606  13.679
+ATOM     62  H   TRP A   6     -10.745  31.705  19.499
+ATOM     63  HE1 TRP A   6     -13.804  33.839  17.351
+ATOM     64  N   GLN A   7      -8.144  30.475  19.476
+ATOM     65  CA  GLN A   7      -6.832  30.207  20.065
+ATOM     66  C   GLN A   7      -7.054  29.249  21.206
+ATOM     67  O   GLN A   7      -8.130  29.257  21.772
+ATOM     68  CB  GLN A   7      -6.392  31.535  20.721
+ATOM     69  CG  GLN A   7      -7.530  32.429  21.389
+ATOM     70  CD  GLN A   7      -8.068  32.183  22.843
+ATOM     71  OE1 GLN A   7      -8.919  31.355  23.168
+ATOM     72  NE2 GLN A   7      -7.573  33.053  23.740
+ATOM     73  H   GLN A   7      -8.835  30.773  20.136
+ATOM     74 HE21 GLN A   7      -7.917  33.064  24.676
+ATOM     75 HE22 GLN A   7      -6.852  33.693  23.485
+ATOM     76  N   ARG A   8      -6.043  28.501  21.611
+ATOM     77  CA  ARG A   8      -6.232  27.848  22.918
+ATOM     78  C   ARG A   8      -6.497  28.885  24.007
+ATOM     79  O   ARG A   8      -5.768  29.873  24.059
+ATOM     80  CB  ARG A   8      -4.994  27.014  23.341
+ATOM     81  CG  ARG A   8      -4.893  25.664  22.642
+ATOM     82  CD  ARG A   8      -3.726  24.784  23.138
+ATOM     83  NE  ARG A   8      -3.819  23.390  22.632
+ATOM     84  CZ  ARG A   8      -3.288  22.328  23.296
+ATOM     85  NH1 ARG A   8      -2.552  22.483  24.391
+ATOM     86  NH2 ARG A   8      -3.494  21.076  22.873
+ATOM     87  H   ARG A   8      -5.213  28.378  21.064
+ATOM     88  HE  ARG A   8      -4.324  23.228  21.784
+ATOM     89 HH11 ARG A   8      -2.374  23.397  24.755
+ATOM     90 HH12 ARG A   8      -2.175  21.681  24.854
+ATOM     91 HH21 ARG A   8      -4.047  20.907  22.057
+ATOM     92 HH22 ARG A   8      -3.095  20.309  23.374
+ATOM     93  N   PRO A   9      -7.536  28.661  24.834
+ATOM     94  CA  PRO A   9      -7.769  29.631  25.882
+ATOM     95  C   PRO A   9      -6.747  29.433  26.994
+ATOM     96  O   PRO A   9      -6.969  28.695  27.938
+ATOM     97  CB  PRO A   9      -9.251  29.345  26.223
+ATOM     98  CG  PRO A   9      -9.429  27.855  26.000
+ATOM     99  CD  PRO A   9      -8.542  27.595  24.797
+ATOM    100  N   LEU A  10      -5.587  30.070  26.850
+ATOM    101  CA  LEU A  10      -4.573  29.932  27.892
+ATOM    102  C   LEU A  10      -4.515  31.109  28.780
+ATOM    103  O   LEU A  10      -4.677  32.228  28.318
+ATOM    104  CB  LEU A  10      -3.202  29.954  27.285
+ATOM    105  CG  LEU A  10      -2.781  28.744  26.503
+ATOM    106  CD1 LEU A  10      -1.439  29.103  25.866
+ATOM    107  CD2 LEU A  10      -2.698  27.496  27.399
+ATOM    108  H   LEU A  10      -5.431  30.673  26.068
+"""
+
+
+
+def available():
+    try:
+        return subprocess.call([python,"-c","pass"]) == 0
+    except OSError:
+        return False
+
+
+requirePython2 = unittest.skipUnless(available(),"python2 not found")
+
+
+class MartinizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self,*names):
+        return os.path.join(self.tmp,*names)
+
+    def write(self,name,text):
+        with open(self.path(name),"w") as f:
+            f.write(text)
+        return self.path(name)
+
+    def read(self,*names):
+        with open(self.path(*names),"rb") as f:
+            return f.read()
+
+    # Run martinize.py with the arguments in a new directory, returning the
+    # files written there. The run should end with the status given.
+    def run_martinize(self,name,*args,**kwargs):
+        cwd = self.path(name)
+        if not os.path.isdir(cwd):
+            os.mkdir(cwd)
+        with open(os.path.join(cwd,"stdout"),"w") as out:
+            with open(os.path.join(cwd,"stderr"),"w") as err:
+                status = subprocess.call([python,martinize]+list(args),cwd=cwd,stdout=out,stderr=err)
+        self.assertEqual(status,kwargs.get("status",0),self.read(name,"stderr").decode("utf-8","replace"))
+        files = {}
+        for fn in sorted(os.listdir(cwd)):
+            if fn not in ("stdout","stderr") and os.path.isfile(os.path.join(cwd,fn)):
+                files[fn] = self.read(name,fn)
+        return files
+
+    # Run a snippet of code, with martinize.py loaded as the module M, and
+    # return what it writes to stdout, as JSON.
+    def call(self,code):
+        script = "import imp,json,os,sys\nsys.path.insert(0,%r)\nM = imp.load_source('martinize',%r)\n%s\n" % (os.path.dirname(martinize),martinize,code)
+        process = subprocess.Popen([python,"-c",script],cwd=self.tmp,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        self.assertEqual(process.returncode,0,err.decode("utf-8","replace"))
+        return json.loads(out.decode("utf-8"))
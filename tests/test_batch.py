@@ -0,0 +1,56 @@
+"""Checks batch processing (-batch): the paths given to the jobs, and
+skipping the jobs that completed before when the manifest is processed
+again.
+"""
+
+import json,os,unittest
+from common import MartinizeTest,requirePython2,fragment
+
+
+# The secondary structure listed in the header of an ITP file
+def secondaryStructure(itp):
+    lines = itp.splitlines()
+    return lines[lines.index(b"; Secondary Structure:")+1]
+
+
+@requirePython2
+class TestBatch(MartinizeTest):
+
+    def setUp(self):
+        MartinizeTest.setUp(self)
+        os.mkdir(self.path("run"))
+        self.write(os.path.join("run","frag.pdb"),fragment)
+        # Secondary structure as a Gromacs ssdump file
+        self.write(os.path.join("run","ss.dat"),"10\nHHHHHHHHHH\n")
+        # Two jobs writing to the same directory, with a relative path
+        self.write(os.path.join("run","jobs.tsv"),"frag.pdb\tout/a\nfrag.pdb\tout/b\t-ss ss.dat\n")
+
+    def batch(self):
+        self.run_martinize("run","-batch","jobs.tsv","-j","2","-x","cg.pdb")
+        with open(self.path("run","jobs.tsv.status")) as f:
+            return [json.loads(line) for line in f]
+
+    def test_paths(self):
+        status = self.batch()
+        self.assertEqual(sorted([(i["prefix"],i["status"]) for i in status]),[("out/a","done"),("out/b","done")])
+        out = os.listdir(self.path("run","out"))
+        for fn in ("a.top","b.top","a.cg.pdb","b.cg.pdb"):
+            self.assertIn(fn,out)
+        self.assertNotIn("cg.pdb",out)
+        # The secondary structure was read for the second job only
+        self.assertIn(b"H",secondaryStructure(self.read("run","out","b_A.itp")))
+        self.assertNotIn(b"H",secondaryStructure(self.read("run","out","a_A.itp")))
+
+    def test_resume(self):
+        self.batch()
+        status = self.batch()
+        self.assertEqual(sorted([(i["prefix"],i["status"]) for i in status[2:]]),[("out/a","skipped"),("out/b","skipped")])
+        # A job with an output file missing is run again
+        os.remove(self.path("run","out","b.cg.pdb"))
+        status = self.batch()
+        self.assertEqual(sorted([(i["prefix"],i["status"]) for i in status[4:]]),[("out/a","skipped"),("out/b","done")])
+        self.assertIn("b.cg.pdb",os.listdir(self.path("run","out")))
+
+
+if __name__ == "__main__":
+    unittest.main()
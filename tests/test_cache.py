@@ -0,0 +1,44 @@
+"""Checks that topologies taken from the cache (-cache) are the same as
+topologies built for the structure.
+"""
+
+import os,unittest
+from common import MartinizeTest,requirePython2,fragment
+
+
+@requirePython2
+class TestCache(MartinizeTest):
+
+    def run_cached(self,name,*args):
+        files = self.run_martinize(name,"-f",self.path("frag.pdb"),"-o","topol.top","-x","cg.pdb",
+                                   "-elastic","-cache",self.path("cache"),*args)
+        return files, b"taken from cache" in self.read(name,"stderr")
+
+    def test_hit(self):
+        self.write("frag.pdb",fragment)
+        miss, cached = self.run_cached("miss")
+        self.assertFalse(cached)
+        self.assertEqual(len([i for i in os.listdir(self.path("cache")) if i.endswith(".itp")]),1)
+        hit, cached = self.run_cached("hit")
+        self.assertTrue(cached)
+        self.assertEqual(miss,hit)
+
+    def test_options(self):
+        # A change in the options affecting the topology gives a new entry
+        self.write("frag.pdb",fragment)
+        self.run_cached("miss")
+        other, cached = self.run_cached("other","-ef","700")
+        self.assertFalse(cached)
+        self.assertEqual(len([i for i in os.listdir(self.path("cache")) if i.endswith(".itp")]),2)
+        uncached = self.run_martinize("uncached","-f",self.path("frag.pdb"),"-o","topol.top","-x","cg.pdb","-elastic","-ef","700")
+        self.assertEqual(sorted(other),sorted(uncached))
+        for fn in uncached:
+            if fn != "Protein_A.itp":
+                self.assertEqual(other[fn],uncached[fn],fn)
+        # The headers list the options, which only include -cache for the first
+        strip = lambda itp: [line for line in itp.splitlines() if not line.startswith(b"; Using the following options")]
+        self.assertEqual(strip(other["Protein_A.itp"]),strip(uncached["Protein_A.itp"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+"""Checks the builtin DSSP (-dssp builtin) against DSSP.
+
+data/1pdoA.pdb has the heavy atoms of chain A of 1PDO. The reference
+is the assignment by DSSP, reduced to helix (H, G, I), strand (E, B) and
+other.
+"""
+
+import os,unittest
+from common import MartinizeTest,requirePython2,here
+
+structure = os.path.join(here,"data","1pdoA.pdb")
+reference = "--EEEEE--E-HHHHHHHHHHHHH-----EEEE-E-----HHHHHHHHHHHH--------EEEEE-----HHHHHHHHHH-----EEEEE---HHHHHHHHHHH-----HHHHHHHHHHHHHH------"
+
+
+def reduced(ss):
+    return "".join([x in "HGI" and "H" or x in "EB" and "E" or "-" for x in ss])
+
+
+@requirePython2
+class TestDSSP(MartinizeTest):
+
+    def test_call_builtin(self):
+        ss = self.call(
+            "atoms = [M.pdbAtom(line) for line in open(%r) if line.startswith('ATOM')]\n"
+            "chain = M.Chain({},list(M.residues(atoms)))\n"
+            "print json.dumps(M.call_builtin(chain))" % structure)
+        self.assertEqual(len(ss),len(reference))
+        self.assertEqual(reduced(ss),reference)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+"""Checks that the output of martinize.py does not depend on -j.
+
+The structure has two chains with chain identifier A and two with B,
+so that moleculetypes get the same name and the order in which they
+are written matters.
+"""
+
+import unittest
+from common import MartinizeTest,requirePython2,fragment
+
+
+def duplicateChains():
+    # Residues 1-5 and 6-10 as chains A, B, A and B, each displaced,
+    # giving two different moleculetypes for each chain identifier.
+    out = []
+    for chain,shift,first,last in (("A",0,1,5),("B",40,1,5),("A",80,6,10),("B",120,6,10)):
+        for line in fragment.splitlines():
+            if first <= int(line[22:26]) <= last:
+                x = float(line[30:38])+shift
+                out.append("%s%s%s%8.3f%s  1.00  0.00" % (line[:21],chain,line[22:30],x,line[38:54]))
+        out.append("TER")
+    out.append("END")
+    return "\n".join(out)+"\n"
+
+
+@requirePython2
+class TestParallel(MartinizeTest):
+
+    def setUp(self):
+        MartinizeTest.setUp(self)
+        self.pdb = self.write("dup.pdb",duplicateChains())
+
+    def run_jobs(self,name,*args):
+        return self.run_martinize(name,"-f",self.pdb,"-o","topol.top","-x","cg.pdb","-elastic",*args)
+
+    def check(self,*args):
+        serial = self.run_jobs("serial","-j","1",*args)
+        self.assertIn("topol.top",serial)
+        self.assertIn("cg.pdb",serial)
+        for i in range(3):
+            parallel = self.run_jobs("parallel%d" % i,"-j","4",*args)
+            self.assertEqual(sorted(serial),sorted(parallel))
+            for fn in serial:
+                self.assertEqual(serial[fn],parallel[fn],fn)
+
+    def test_duplicate_names(self):
+        self.check()
+
+    def test_duplicate_names_sep(self):
+        self.check("-sep")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Checks the column-wise reading of structure frames (pdbAtoms and
+groAtoms) against reading the lines one by one (pdbAtom and groAtom).
+"""
+
+import unittest
+from common import MartinizeTest,requirePython2,fragment
+
+# Atom lines that are not in the usual form: insertion codes, negative
+# residue numbers, four character atom names, large and negative numbers,
+# and coordinates with other precisions.
+pdbLines = [
+    "ATOM      1  N   ALA A  -3     -12.735  38.918  -0.000  1.00  0.00           N\n",
+    "ATOM      2 HD21 ASN A  12A      1.000-999.999  12.000\n",
+    "HETATM    3  O   HOH W9999    1234.567   0.001  -0.010\n",
+    "ATOM      4 1HB  ALA B 100       0.000   0.000   0.000  1.00  0.00\n",
+]
+pdbOtherPrecision = [
+    "ATOM      1  N   ALA A   1     -12.73   38.918  31.287\n",
+    "ATOM      2  CA  ALA A   1       1.5e1  39.097  29.830\n",
+]
+groLines = [
+    "    1ALA      N    1   1.234  -5.678   0.000\n",
+    "   12ASN   HD21    2 -12.345   0.001  -0.000\n",
+    "99999SOL     OW99999   0.100 123.456   7.890\n",
+]
+
+
+def pdb(lines):
+    return [line[:54]+"\n" for line in lines]
+
+
+def gro(lines):
+    out = []
+    for k,line in enumerate(lines):
+        x, y, z = [float(line[i:i+8])/10 for i in (30,38,46)]
+        out.append("%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n" % (int(line[22:26]),line[17:20],line[12:16].strip(),k+1,x,y,z))
+    return out
+
+
+@requirePython2
+class TestParser(MartinizeTest):
+
+    def compare(self,reader,lines):
+        columns, single = self.call(
+            "lines = %r\n"
+            "print json.dumps([list(M.%ss(lines)),[M.%s(line) for line in lines]])" % (lines,reader,reader))
+        self.assertEqual(len(columns),len(lines))
+        self.assertEqual(columns,single)
+
+    def test_pdb(self):
+        self.compare("pdbAtom",pdb(fragment.splitlines()))
+        self.compare("pdbAtom",pdbLines)
+        self.compare("pdbAtom",pdbOtherPrecision)
+
+    def test_gro(self):
+        self.compare("groAtom",gro(fragment.splitlines()))
+        self.compare("groAtom",groLines)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Checks topologies derived with -reuse/-mutate against a full run.
+
+The mutant structure has valine 3 of the fragment renamed to threonine,
+with CG1 as OG1, so that the beads of the full run are at the same
+positions as those of the earlier topology.
+"""
+
+import unittest
+from common import MartinizeTest,requirePython2,fragment
+
+
+def mutant():
+    out = []
+    for line in fragment.splitlines():
+        if int(line[22:26]) == 3:
+            name = line[12:16] == " CG1" and " OG1" or line[12:16]
+            line = line[:12]+name+" THR"+line[20:]
+        out.append(line)
+    return "\n".join(out)+"\n"
+
+
+# The terms of each section of an ITP file, without comment lines. The
+# order of the terms within a section can differ.
+def sections(itp):
+    out, section = {}, None
+    for line in itp.decode("utf-8").splitlines():
+        if line.startswith("["):
+            section = line.strip()
+        elif line.strip() and not line.startswith(";"):
+            out.setdefault(section,[]).append(line)
+    return dict([(key,sorted(lines)) for key,lines in out.items()])
+
+
+@requirePython2
+class TestReuse(MartinizeTest):
+
+    def check(self,*args):
+        self.run_martinize("wt","-f",self.write("wt.pdb",fragment),"-o","topol.top",*args)
+        full   = self.run_martinize("full","-f",self.write("mut.pdb",mutant()),"-o","topol.top",*args)
+        reused = self.run_martinize("reuse","-reuse",self.path("wt","Protein_A.itp"),"-mutate","V3T","-o","topol.top",*args)
+        self.assertEqual(sections(full["Protein_A.itp"]),sections(reused["Protein_A.itp"]))
+
+    def test_mutation(self):
+        self.check()
+
+    def test_mutation_elastic(self):
+        self.check("-elastic")
+
+    def test_wrong_residue(self):
+        self.run_martinize("wt","-f",self.write("wt.pdb",fragment),"-o","topol.top")
+        self.run_martinize("reuse","-reuse",self.path("wt","Protein_A.itp"),"-mutate","A3T","-o","topol.top",status=1)
+
+    def test_missing_topology(self):
+        self.run_martinize("reuse","-reuse",self.path("missing.itp"),"-mutate","V3T","-o","topol.top",status=1)
+        self.assertIn(b"does not exist",self.read("reuse","stderr"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Checks the secondary structure counts over frames (-sso/-ssi).
+
+The counts written for the first frames of an ensemble, added to a run
+over the other frames, should give the same topology as a run over all
+frames. The frames are chain A of 1PDO with random displacements, which
+change the secondary structure from frame to frame.
+"""
+
+import os,random,unittest
+from common import MartinizeTest,requirePython2,here
+
+structure = os.path.join(here,"data","1pdoA.pdb")
+
+
+def models(n,seed=1):
+    rng   = random.Random(seed)
+    lines = [line for line in open(structure) if line.startswith("ATOM")]
+    out   = []
+    for k in range(n):
+        model = ["MODEL %8d\n" % (k+1)]
+        for line in lines:
+            xyz = tuple([float(line[i:i+8])+rng.gauss(0,0.3) for i in (30,38,46)])
+            model.append(line[:30]+"%8.3f%8.3f%8.3f" % xyz+line[54:])
+        model.append("ENDMDL\n")
+        out.append("".join(model))
+    return out
+
+
+# The ITP file without the line listing the options
+def topology(itp):
+    return [line for line in itp.splitlines() if not line.startswith(b"; Using the following options")]
+
+
+@requirePython2
+class TestSSCounts(MartinizeTest):
+
+    def test_split(self):
+        frames = models(4)
+        self.write("all.pdb","".join(frames))
+        self.write("first.pdb","".join(frames[:2]))
+        self.write("last.pdb","".join(frames[2:]))
+        full  = self.run_martinize("full","-f",self.path("all.pdb"),"-dssp","builtin","-o","topol.top")
+        self.run_martinize("first","-f",self.path("first.pdb"),"-dssp","builtin","-o","topol.top","-sso","counts.json")
+        last  = self.run_martinize("last","-f",self.path("last.pdb"),"-dssp","builtin","-o","topol.top")
+        added = self.run_martinize("added","-f",self.path("last.pdb"),"-dssp","builtin","-o","topol.top",
+                                   "-ssi",self.path("first","counts.json"))
+        self.assertEqual(topology(full["Protein_A.itp"]),topology(added["Protein_A.itp"]))
+        # Without the counts of the first frames the consensus differs
+        self.assertNotEqual(topology(full["Protein_A.itp"]),topology(last["Protein_A.itp"]))
+
+    def test_round_trip(self):
+        # No frames, a frame without residues, and frames with residues
+        result = self.call(
+            "import StringIO\n"
+            "out = []\n"
+            "for frames in ([],[''],['HHE','HEE']):\n"
+            "    counts = M.SSCounts()\n"
+            "    for ss in frames:\n"
+            "        counts.add(ss)\n"
+            "    stream = StringIO.StringIO()\n"
+            "    counts.write(stream)\n"
+            "    stream.seek(0)\n"
+            "    other = M.SSCounts()\n"
+            "    other.read(stream)\n"
+            "    out.append([(i.types,i.frames,list(i.counts.shape),i.counts.tolist()) for i in (counts,other)])\n"
+            "print json.dumps(out)")
+        for written,read in result:
+            self.assertEqual(written,read)
+        self.assertEqual(result[2][1][0],"EH")
+        self.assertEqual(result[2][1][3],[[0,2],[1,1],[2,0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
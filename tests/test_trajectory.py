@@ -0,0 +1,61 @@
+"""Checks the coarse graining of trajectories (-traj/-xo).
+
+Each frame of the coarse grained trajectory should match the structure
+written with -x for the same coordinates. The frames are the test
+fragment, rotated and displaced.
+"""
+
+import math,unittest
+from common import MartinizeTest,requirePython2,fragment
+
+
+def frame(k):
+    c, s = math.cos(0.5*k), math.sin(0.5*k)
+    out  = []
+    for line in fragment.splitlines():
+        x, y, z = [float(line[i:i+8]) for i in (30,38,46)]
+        out.append((c*x-s*y+3*k,s*x+c*y,z-2*k))
+    return out
+
+
+def structure(coordinates):
+    return "".join(["%s%8.3f%8.3f%8.3f\n" % ((line[:30],)+tuple(xyz)) for line,xyz in zip(fragment.splitlines(),coordinates)])
+
+
+@requirePython2
+class TestTrajectory(MartinizeTest):
+
+    frames = 3
+
+    # Coordinates from a TRR file, in nm
+    def coordinates(self,filename):
+        return self.call(
+            "from gmx.trr import TRR\n"
+            "print json.dumps([frame.x().tolist() for frame in TRR(%r)])" % filename)
+
+    def test_frames(self):
+        # The trajectory has the coordinates of the structures, in nm
+        structures = [[[round(i,3) for i in xyz] for xyz in frame(k)] for k in range(self.frames)]
+        trajectory = [[[i/10 for i in xyz] for xyz in coordinates] for coordinates in structures]
+        self.call(
+            "from gmx.trr import TRRWriter\n"
+            "out = TRRWriter(%r,precision=8)\n"
+            "for k,x in enumerate(%r):\n"
+            "    out.write(x,step=k,time=k)\n"
+            "out.close()\n"
+            "print 0" % (self.path("aa.trr"),trajectory))
+        self.run_martinize("traj","-f",self.write("aa0.pdb",structure(structures[0])),
+                           "-traj",self.path("aa.trr"),"-xo","cg.trr","-o","topol.top")
+        frames = self.coordinates(self.path("traj","cg.trr"))
+        self.assertEqual(len(frames),self.frames)
+        for k in range(self.frames):
+            self.run_martinize("x%d"%k,"-f",self.write("aa%d.pdb"%k,structure(structures[k])),"-x","cg.trr","-o","topol.top")
+            beads = self.coordinates(self.path("x%d"%k,"cg.trr"))[0]
+            self.assertEqual(len(frames[k]),len(beads))
+            for a,b in zip(frames[k],beads):
+                for i,j in zip(a,b):
+                    self.assertAlmostEqual(i,j,places=5)
+
+
+if __name__ == "__main__":
+    unittest.main()